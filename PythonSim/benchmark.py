@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+
+import numpy as np
+
+from recorder import to_builtin
+
+MODES = ('light', 'Dresner', 'Xu')
+FLOWS = (720, 1440, 2880, 4320, 5760)
+
+def make_scenarios(modes=MODES, total_flows=FLOWS, seed=0, simu_t=600, **overrides):
+    '''
+    The benchmark scenarios: every control mode at every total flow, with the balanced turn split of headless.scenario_settings,
+    a fixed seed and no fault (a crash would end the run early). overrides are extra settings shared by all scenarios.
+    '''
+    scenarios = []
+    for mode in modes:
+        for total_flow in total_flows:
+            scenarios.append({'mode': mode, 'total_flow': total_flow, 'seed': seed, 'simu_t': simu_t, 'overrides': overrides})
+    return scenarios
+
+def scenario_key(scenario):
+    '''Identifies a scenario in a results file, the baseline is matched by it'''
+    return '%s %d seed %d simu_t %d %s' % (scenario['mode'], scenario['total_flow'], scenario['seed'], scenario['simu_t'],
+        json.dumps(scenario['overrides'], sort_keys=True))
+
+def peak_memory_mb():
+    '''Peak resident memory of this process in MB, nan where the resource module does not exist (Windows)'''
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def time_requests(ctx):
+    '''
+    Make ctx.inter_manager record how long it takes to answer each reservation request ('request' V2I message),
+    returns the list the durations (s) are appended to
+    '''
+    manager = ctx.inter_manager
+    receive_V2I = manager.receive_V2I
+    clock = time.perf_counter
+    latencies = []
+    def timed_receive_V2I(sender, message):
+        if message['type'] != 'request':
+            return receive_V2I(sender, message)
+        start = clock()
+        receive_V2I(sender, message)
+        latencies.append(clock() - start)
+    manager.receive_V2I = timed_receive_V2I
+    return latencies
+
+def bench_one(scenario, repeat=1):
+    '''
+    Run a scenario repeat times in this process without any log and return the best simulated seconds per wall second,
+    the reservation request latency of that run (ms), the peak memory of the process and the run's metrics
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    from context import SimulationContext
+    from headless import scenario_settings, run_context
+
+    best = None
+    for _ in range(repeat):
+        settings = scenario_settings(scenario['mode'], scenario['total_flow'])
+        settings.update(fault_veh_range=None, log_format='none', simu_t=scenario['simu_t'])
+        settings.update(scenario['overrides'])
+        ctx = SimulationContext(seed=scenario['seed'], **settings)
+        latencies = time_requests(ctx)
+        start = time.perf_counter()
+        run_context(ctx)
+        wall_time = time.perf_counter() - start
+        ctx.close()
+        if best is None or wall_time < best[0]:
+            best = (wall_time, ctx, latencies)
+
+    wall_time, ctx, latencies = best
+    simulated_time = ctx.simulator.timestep * ctx.settings.veh_dt
+    latencies = np.array(latencies) * 1000
+    metrics = ctx.simulator.metrics.summary()
+    result = dict(scenario)
+    result.update({
+        'wall_time': wall_time,
+        'simulated_time': simulated_time,
+        'speed': simulated_time / wall_time,
+        'peak_memory_mb': peak_memory_mb(),
+        'requests': len(latencies),
+        'request_p50_ms': np.percentile(latencies, 50) if len(latencies) else np.nan,
+        'request_p95_ms': np.percentile(latencies, 95) if len(latencies) else np.nan,
+        'request_max_ms': latencies.max() if len(latencies) else np.nan,
+        'metrics': {key: metrics[key] for key in ('avg_delay', 'max_delay', 'finish_count')}
+    })
+    return to_builtin(result)
+
+def machine():
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'processor': platform.processor(), 'numpy': np.__version__}
+
+def run_benchmarks(scenarios, repeat=3):
+    '''
+    Run the scenarios one after the other, each in a fresh process (so that the peak memory is its own, and no cache is warm),
+    and return their results
+    '''
+    results = []
+    pool_context = multiprocessing.get_context('spawn')
+    for (i, scenario) in enumerate(scenarios):
+        with pool_context.Pool(1) as pool:
+            result = pool.apply(bench_one, (scenario, repeat))
+        results.append(result)
+        print('[%d/%d] %s %d: %.1f simulated s / wall s, %.0f MB, %d requests, p95 %.3f ms' % (i + 1, len(scenarios),
+            result['mode'], result['total_flow'], result['speed'], result['peak_memory_mb'], result['requests'], result['request_p95_ms']))
+        sys.stdout.flush()
+    return results
+
+def save_results(results, fname):
+    with open(fname, 'w') as f:
+        json.dump({'machine': machine(), 'results': results}, f, indent=1)
+
+def load_results(fname):
+    with open(fname) as f:
+        return json.load(f)
+
+def compare(results, baseline, tolerance=0.1):
+    '''
+    One row per scenario found in both: speed and request p95 latency relative to the baseline, the peak memory difference,
+    and whether the simulation itself changed (the metrics differ). A row is a regression when the speed dropped, or the latency
+    or the memory grew, by more than tolerance (relative)
+    '''
+    base = {scenario_key(result): result for result in baseline['results']}
+    rows = []
+    for result in results:
+        old = base.get(scenario_key(result))
+        if old is None:
+            continue
+        speed_ratio = result['speed'] / old['speed']
+        latency_ratio = result['request_p95_ms'] / old['request_p95_ms'] if old['requests'] and result['requests'] else np.nan
+        memory_ratio = result['peak_memory_mb'] / old['peak_memory_mb'] if old['peak_memory_mb'] else np.nan
+        rows.append({
+            'mode': result['mode'],
+            'total_flow': result['total_flow'],
+            'speed': result['speed'],
+            'speed_ratio': speed_ratio,
+            'request_p95_ratio': latency_ratio,
+            'peak_memory_diff_mb': result['peak_memory_mb'] - old['peak_memory_mb'],
+            # As json text, so that nan (no vehicle has left yet) equals nan
+            'metrics_changed': json.dumps(result['metrics'], sort_keys=True) != json.dumps(old['metrics'], sort_keys=True),
+            'regression': speed_ratio < 1 - tolerance or latency_ratio > 1 + tolerance or memory_ratio > 1 + tolerance
+        })
+    return rows
+
+def format_ratio(ratio):
+    return '-' if np.isnan(ratio) else '%.2fx' % ratio
+
+def print_comparison(rows):
+    print('%-8s %6s %12s %8s %12s %10s %8s' % ('mode', 'flow', 'sim s/wall s', 'speed', 'request p95', 'memory MB', 'metrics'))
+    for row in rows:
+        print('%-8s %6d %12.1f %8s %12s %+10.1f %8s%s' % (row['mode'], row['total_flow'], row['speed'], format_ratio(row['speed_ratio']),
+            format_ratio(row['request_p95_ratio']), row['peak_memory_diff_mb'], 'changed' if row['metrics_changed'] else 'same',
+            '  REGRESSION' if row['regression'] else ''))
+
+if __name__ == '__main__':
+    # python benchmark.py                         run all scenarios and compare with log/benchmark_baseline.json
+    # python benchmark.py --save-baseline         run all scenarios and store them as the baseline
+    # python benchmark.py --modes Dresner --flows 2880 5760 --simu-t 300 --repeat 1
+    parser = argparse.ArgumentParser(description='Simulation speed, memory and reservation request latency of each intersection manager')
+    parser.add_argument('--modes', nargs='+', default=list(MODES))
+    parser.add_argument('--flows', nargs='+', type=int, default=list(FLOWS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--simu-t', type=int, default=600, help='simulated seconds of each run')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each scenario, the fastest one counts')
+    parser.add_argument('--baseline', default=os.path.join('log', 'benchmark_baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline instead of comparing')
+    parser.add_argument('--out', default=None, help='also save the results to this file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change that counts as a regression')
+    args = parser.parse_args()
+
+    results = run_benchmarks(make_scenarios(args.modes, args.flows, args.seed, args.simu_t), args.repeat)
+    if args.out:
+        save_results(results, args.out)
+    if args.save_baseline:
+        save_results(results, args.baseline)
+        print('Baseline saved to %s' % args.baseline)
+    elif os.path.exists(args.baseline):
+        baseline = load_results(args.baseline)
+        if baseline['machine'] != machine():
+            print('The baseline was measured on another machine: %s' % baseline['machine'])
+        rows = compare(results, baseline, args.tolerance)
+        print_comparison(rows)
+        if any(row['regression'] for row in rows):
+            sys.exit(1)
+    else:
+        print('No baseline at %s, run with --save-baseline to store one' % args.baseline)
@@ -1,11 +1,22 @@
+import os
 import csv
 import sys
-from lib.settings import veh_param, cf_param, inter_v_lim, arm_len, veh_dt, simu_t
+import lib.settings
 
 import numpy as np
 import matplotlib.pyplot as plt
 
-def cal_metrics(fname):
+from recorder import ZONE_CODE, is_binary_log, load_trajectory
+
+def cal_metrics(fname, settings=None):
+    '''
+    fname: a text log, or the directory of a binary log (recorder.BinaryRecorder)
+    settings: the settings the log was produced with (SimulationContext.settings), lib.settings by default
+    '''
+    s = settings or lib.settings
+    if is_binary_log(fname):
+        return cal_metrics_binary(fname, s)
+    veh_dt, arm_len = s.veh_dt, s.arm_len
     file = open(fname)
     reader = csv.reader(file)
     
@@ -46,8 +57,11 @@ def cal_metrics(fname):
                 continue  # Continue to the next row
 
         t, veh_id, zone, x = int(row[0]), int(row[1]), row[2].strip(), float(row[4])
-        if t >= simu_t / veh_dt:
+        if t >= s.simu_t / veh_dt:
             break
+        if veh_id + 1 >= len(veh_info_table):
+            # Double the table, keeping at least one unfinished row at the end for metrics_from_table
+            veh_info_table = np.vstack([veh_info_table, - np.ones((max(len(veh_info_table), veh_id + 2 - len(veh_info_table)), 4))])
         if zone == 'ap':
             if veh_info_table[veh_id, 0] == -1:
                 veh_info_table[veh_id, 0] = t
@@ -55,9 +69,52 @@ def cal_metrics(fname):
             veh_info_table[veh_id, 1] = max(veh_info_table[veh_id, 1], x)
         if zone == 'ex':
             veh_info_table[veh_id, 2] = max(veh_info_table[veh_id, 2], t)
-            if x >= arm_len + (veh_param['veh_len'] - veh_param['veh_len_front']):
+            if x >= arm_len + (s.veh_param['veh_len'] - s.veh_param['veh_len_front']):
                 veh_info_table[veh_id, 3] = 1
 
+    return metrics_from_table(veh_info_table, t, longest_crash_list, s, fname[:-4]+'.png')
+
+def cal_metrics_binary(path, s):
+    '''cal_metrics of a binary log, the per-vehicle table is filled with array operations chunk by chunk instead of parsing lines'''
+    chunks, events, meta = load_trajectory(path)
+    veh_dt, arm_len = s.veh_dt, s.arm_len
+
+    # As the text log is read up to the first row of the simu_t timestep, t is the last timestep read
+    parts, t = [], None
+    for chunk in chunks:
+        past_end = np.searchsorted(chunk['t'], s.simu_t / veh_dt)
+        if past_end < len(chunk):
+            t = int(chunk['t'][past_end])
+            parts.append(chunk[:past_end])
+            break
+        parts.append(chunk)
+    if t is None:
+        t = int(chunks[-1]['t'][-1])
+
+    # The columns are start_time, ju_track_len, removed_time, is_removed, one more row than vehicles so that one never finishes
+    veh_info_table = - np.ones((max(int(part['veh_id'].max()) for part in parts if len(part)) + 2, 4))
+    start = np.full(len(veh_info_table), np.inf)
+    removed_x = arm_len + (s.veh_param['veh_len'] - s.veh_param['veh_len_front'])
+    for part in parts:
+        ids, ts, zones, xs = part['veh_id'], part['t'].astype(float), part['zone'], part['x']
+        ap, ju, ex = zones == ZONE_CODE['ap'], zones == ZONE_CODE['ju'], zones == ZONE_CODE['ex']
+        np.minimum.at(start, ids[ap], ts[ap])
+        np.maximum.at(veh_info_table[:, 1], ids[ju], xs[ju])
+        np.maximum.at(veh_info_table[:, 2], ids[ex], ts[ex])
+        removed = ex & (xs >= removed_x)
+        veh_info_table[ids[removed], 3] = 1
+    veh_info_table[:, 0] = np.where(np.isinf(start), -1, start)
+
+    longest_crash_list = []
+    for event in events.get('crash', []):
+        if len(event['veh_ids']) > len(longest_crash_list):
+            longest_crash_list = event['veh_ids']
+
+    return metrics_from_table(veh_info_table, t, longest_crash_list, s, os.path.splitext(path.rstrip(os.sep))[0] + '.png')
+
+def metrics_from_table(veh_info_table, t, longest_crash_list, s, png_fname):
+    '''Throughput and delays from the per-vehicle table (start_time, ju_track_len, removed_time, is_removed), t is the last timestep'''
+    veh_dt, arm_len = s.veh_dt, s.arm_len
     metrics = {}
 
     # Find the smallest vehicle that has not completed the entire journey
@@ -75,21 +132,24 @@ def cal_metrics(fname):
     # real time
     actual_time = (veh_info_table[:, 2] - veh_info_table[:, 0]) * veh_dt
     #Ideal passing time, ignore intersections and other vehicles, and pass at a constant speed
-    ideal_time = (arm_len * 2 + veh_info_table[:, 1]) / cf_param['v0']
+    ideal_time = (arm_len * 2 + veh_info_table[:, 1]) / s.cf_param['v0']
     delay = actual_time - ideal_time
     metrics['avg_delay'] = np.mean(delay)
     metrics['max_delay'] = np.max(delay)
     metrics['longest_crash_list'] = longest_crash_list  
 
+    plt.figure()
     plt.plot(delay)
     plt.xlabel('Vehicle Id')
     plt.ylabel('Delay / s')
     plt.grid(True)
-    plt.savefig(fname[:-4]+'.png')
+    plt.savefig(png_fname)
+    plt.close()
 
     return metrics
 
 def see_veh_avx(fname, id):
+    veh_dt = lib.settings.veh_dt
     file = open(fname)
     reader = csv.reader(file)
     x_ap = []
@@ -0,0 +1,166 @@
+import io
+import os
+import sys
+import copy
+import pickle
+import traceback
+
+def detached_objects(ctx):
+    '''
+    id: name of the objects that a checkpoint or a fork does not carry over: the logger and the recorder (the copy writes its own log)
+    and the footprint cache, which only holds values computed from the map and is rebuilt on demand (or shared by in-process forks)
+    '''
+    detached = {id(ctx.logger): 'logger', id(ctx.recorder): 'recorder'}
+    footprints = getattr(ctx.inter_manager, 'footprints', None)
+    if footprints is not None:
+        detached[id(footprints.tracks)] = 'footprint tracks'
+        detached[id(footprints.footprints)] = 'footprints'
+    return detached
+
+class CheckpointPickler(pickle.Pickler):
+    def __init__(self, file, ctx):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.detached = detached_objects(ctx)
+
+    def persistent_id(self, obj):
+        return self.detached.get(id(obj))
+
+    def reducer_override(self, obj):
+        # The fleet-backed vehicle classes are made at run time (fleet.fleet_vehicle_class), they cannot be found by name
+        from fleet import fleet_classes, fleet_vehicle_class
+        for (vehicle_cls, fleet_cls) in fleet_classes.items():
+            if obj is fleet_cls:
+                return fleet_vehicle_class, (vehicle_cls,)
+        return NotImplemented
+
+class CheckpointUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        if pid in ('footprint tracks', 'footprints'):
+            return {}
+        return None
+
+def save(ctx, fname=None):
+    '''
+    The full state of a context (settings with crashValues, random states, vehicles, point queues, reservation grid with
+    ex_lane_record, queued messages, metrics) as bytes, also written to the file fname if given
+    '''
+    f = io.BytesIO()
+    CheckpointPickler(f, ctx).dump(ctx)
+    data = f.getvalue()
+    if fname:
+        with open(fname, 'wb') as f:
+            f.write(data)
+    return data
+
+def load(data=None, fname=None, log_fname=None):
+    '''A context from the bytes (or the file) of save, it writes its log to log_fname from now on'''
+    if fname:
+        with open(fname, 'rb') as f:
+            data = f.read()
+    ctx = CheckpointUnpickler(io.BytesIO(data)).load()
+    ctx.open_log(log_fname)
+    return ctx
+
+def setup_fork(ctx, fault_veh=None, fault_time=None, seed=None, log_fname=None):
+    '''
+    Change a copied context before it continues
+    fault_veh   the vehicleCount of the vehicle that will be faulty (Simulator.random_count), None keeps the snapshot's
+    fault_time  fault_time_frac of the fork, None keeps the snapshot's
+    seed        reseeds the random generators for the rest of the run, None continues the snapshot's random streams
+    log_fname   where the fork writes its log, None means no log at all
+    '''
+    sim = ctx.simulator
+    if fault_veh is not None:
+        if fault_veh <= sim.vehicleCount:
+            raise ValueError('Vehicle %d has already been generated (%d so far), it cannot become faulty' % (fault_veh, sim.vehicleCount))
+        sim.random_count = fault_veh
+    if fault_time is not None:
+        ctx.settings.fault_time_frac = fault_time
+    if seed is not None:
+        ctx.seed = seed
+        ctx.random.seed(seed)
+        ctx.np_random.seed(seed)
+        ctx.com.random.seed('com %s' % seed)
+        if sim.demand:
+            sim.demand.discard_after(sim.timestep)
+        if sim.route_random:
+            sim.route_random.seed('route %s' % seed)
+    if log_fname is None:
+        ctx.settings.log_format = 'none'
+    ctx.open_log(log_fname)
+    return ctx
+
+def fork(ctx, fault_veh=None, fault_time=None, seed=None, log_fname=None):
+    '''An independent copy of ctx in this process, changed by setup_fork. The footprint cache is shared with ctx'''
+    memo = {obj_id: None for obj_id in detached_objects(ctx)}
+    footprints = getattr(ctx.inter_manager, 'footprints', None)
+    if footprints is not None:
+        memo[id(footprints.tracks)] = footprints.tracks
+        memo[id(footprints.footprints)] = footprints.footprints
+    new_ctx = copy.deepcopy(ctx, memo)
+    return setup_fork(new_ctx, fault_veh, fault_time, seed, log_fname)
+
+def run_campaign(ctx, scenarios, workers=None, use_fork=None):
+    '''
+    Run every scenario (a dict of setup_fork arguments) from the current state of ctx until the end of the simulation and
+    return their metrics (MetricsAccumulator.summary) in order. ctx itself does not move on.
+    With os.fork (the default where it exists) each scenario runs in a child process that shares the warm state copy-on-write,
+    up to workers (all cores) at a time, otherwise the scenarios run one after the other on in-process copies (fork).
+    For a fault campaign, warm the context up without faults (fault_veh_range = None) first:
+        ctx = SimulationContext(seed=0, fault_veh_range=None, **scenario_settings('Dresner', 2880))
+        while ctx.simulator.timestep < 1000:
+            ctx.simulator.update()
+        results = run_campaign(ctx, [{'fault_veh': ctx.simulator.vehicleCount + k, 'fault_time': 0.5} for k in range(1, 11)])
+    '''
+    from headless import run_context
+
+    use_fork = hasattr(os, 'fork') if use_fork is None else use_fork
+    if not use_fork:
+        results = []
+        for scenario in scenarios:
+            fork_ctx = fork(ctx, **scenario)
+            run_context(fork_ctx)
+            fork_ctx.close()
+            results.append(fork_ctx.simulator.metrics.summary())
+        return results
+
+    workers = workers or os.cpu_count()
+    results = [None] * len(scenarios)
+    running = [] # (pid, scenario index, read end of its pipe), oldest first
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for (index, scenario) in enumerate(scenarios):
+        if len(running) >= workers:
+            collect_child(running.pop(0), results)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                setup_fork(ctx, **scenario)
+                run_context(ctx)
+                ctx.close()
+                result = {'metrics': ctx.simulator.metrics.summary()}
+            except BaseException:
+                result = {'error': traceback.format_exc()}
+            with os.fdopen(write_fd, 'wb') as f:
+                pickle.dump(result, f)
+            os._exit(0)
+        os.close(write_fd)
+        running.append((pid, index, read_fd))
+    while running:
+        collect_child(running.pop(0), results)
+    return results
+
+def collect_child(child, results):
+    '''Wait for a child of run_campaign and put its metrics in results'''
+    pid, index, read_fd = child
+    with os.fdopen(read_fd, 'rb') as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError('Fault scenario %d exited without a result' % index)
+    result = pickle.loads(data)
+    if 'error' in result:
+        raise RuntimeError('Fault scenario %d failed:\n%s' % (index, result['error']))
+    results[index] = result['metrics']
@@ -0,0 +1,75 @@
+import math
+
+def veh_corners(x, y, angle, veh_wid, veh_len, veh_len_front, buf=0):
+    '''
+    Corners of a vehicle's rectangle, grown by buf on every side, in the logical coordinate system (x to the right, y downward).
+    As in DresnerManager.gen_veh_dots, (x, y) is the center of the front wheels and angle is the heading in degrees clockwise from north.
+    '''
+    cos, sin = math.cos(angle * math.pi / 180), math.sin(angle * math.pi / 180)
+    half_wid = veh_wid / 2 + buf
+    front, back = - veh_len_front - buf, veh_len - veh_len_front + buf
+    return [(dx * cos - dy * sin + x, dy * cos + dx * sin + y) for (dx, dy) in ((-half_wid, front), (half_wid, front), (half_wid, back), (-half_wid, back))]
+
+def bounding_box(corners):
+    xs, ys = [c[0] for c in corners], [c[1] for c in corners]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def rectangles_overlap(a, b):
+    '''Separating axis test of two rectangles given by their corners in order around them, touching counts as overlapping'''
+    for rect in (a, b):
+        for k in (0, 1):
+            axis_x, axis_y = rect[k][1] - rect[k + 1][1], rect[k + 1][0] - rect[k][0] # Normal of an edge
+            proj_a = [px * axis_x + py * axis_y for (px, py) in a]
+            proj_b = [px * axis_x + py * axis_y for (px, py) in b]
+            if max(proj_a) < min(proj_b) or max(proj_b) < min(proj_a):
+                return False
+    return True
+
+class SpatialHash:
+    '''Uniform grid of square buckets (cell_size m), each bucket holds the keys of the boxes that touch it'''
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.buckets = {}
+
+    def clear(self):
+        self.buckets.clear()
+
+    def cells(self, box):
+        x_min, y_min, x_max, y_max = box
+        i_min, i_max = math.floor(y_min / self.cell_size), math.floor(y_max / self.cell_size)
+        j_min, j_max = math.floor(x_min / self.cell_size), math.floor(x_max / self.cell_size)
+        return [(i, j) for i in range(i_min, i_max + 1) for j in range(j_min, j_max + 1)]
+
+    def insert(self, key, box):
+        for cell in self.cells(box):
+            self.buckets.setdefault(cell, []).append(key)
+
+    def query(self, box):
+        '''Keys of the boxes that share a bucket with box'''
+        keys = set()
+        for cell in self.cells(box):
+            keys.update(self.buckets.get(cell, ()))
+        return keys
+
+class CollisionDetector:
+    '''
+    Overlapping vehicle rectangles: the broad phase looks up the vehicles in the same SpatialHash buckets, the narrow phase runs
+    rectangles_overlap on those candidates only.
+    '''
+    def __init__(self, cell_size=5.0):
+        self.hash = SpatialHash(cell_size)
+
+    def find_pairs(self, rects):
+        '''
+        rects is a list of rectangles (corners), returns the overlapping pairs as (j, i) indices with j < i,
+        ordered by i and then by j
+        '''
+        self.hash.clear()
+        pairs = []
+        for (i, corners) in enumerate(rects):
+            box = bounding_box(corners)
+            for j in sorted(self.hash.query(box)):
+                if rectangles_overlap(rects[j], corners):
+                    pairs.append((j, i))
+            self.hash.insert(i, box)
+        return pairs
@@ -0,0 +1,108 @@
+import os
+import copy
+import types
+import random
+import logging
+
+import numpy as np
+
+import lib.settings
+from map import Map
+from inter_manager import ComSystem, make_inter_manager
+from vehicle import vehicle_class
+from simulator import Simulator
+from recorder import make_recorder
+
+def snapshot_settings(**overrides):
+    '''
+    Deep copy of the current values in lib.settings with overrides applied, so that a context never shares mutable settings
+    (veh_gen_rule_table, crashValues, ...) with another one. Derived values are recomputed when one of their inputs is overridden.
+    '''
+    values = {}
+    for key, value in vars(lib.settings).items():
+        if key.startswith('_') or isinstance(value, types.ModuleType):
+            continue
+        values[key] = copy.deepcopy(value)
+    for key, value in overrides.items():
+        values[key] = copy.deepcopy(value)
+    if 'gen_init_v' not in overrides and 'cf_param' in overrides:
+        values['gen_init_v'] = values['cf_param']['v0']
+    if 'min_gen_hs' not in overrides and ({'veh_param', 'cf_param', 'gen_init_v'} & set(overrides)):
+        values['min_gen_hs'] = values['veh_param']['veh_len'] + values['cf_param']['s0'] + values['gen_init_v']**2 / 2 / values['veh_param']['max_dec']
+    if 'min_gen_ht' not in overrides and ({'veh_param', 'cf_param', 'gen_init_v', 'min_gen_hs'} & set(overrides)):
+        values['min_gen_ht'] = values['min_gen_hs'] / values['gen_init_v']
+    return types.SimpleNamespace(**values)
+
+class SimulationContext:
+    '''
+    One independent simulation: its own settings, map, intersection manager, communication system,
+    simulator (which holds the vehicle registry), random generators and trajectory log.
+    Any number of contexts can live in the same process.
+    '''
+    _default = None
+
+    @staticmethod
+    def get_default():
+        '''The context used by the GUI and the getInstance() shortcuts, built from lib.settings on first use'''
+        if SimulationContext._default == None:
+            SimulationContext._default = SimulationContext()
+        return SimulationContext._default
+
+    def __init__(self, seed=None, log_fname=None, **overrides):
+        '''
+        seed        seeds both random generators of this context, None means unseeded
+        log_fname   the context writes its trajectory log to this file (a directory with log_format = 'binary'),
+                    None means the root logger (as configured by main.py)
+        overrides   values that replace the ones in lib.settings, e.g. inter_control_mode='Xu', arm_len=200
+        '''
+        self.settings = snapshot_settings(**overrides)
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.np_random = np.random.RandomState(seed)
+
+        self.open_log(log_fname)
+
+        self.map = Map(self)
+        self.com = ComSystem(self)
+        self.inter_manager = make_inter_manager(self)
+        if self.settings.vehicle_engine == 'fleet':
+            # Vehicle state in numpy arrays, updated for all vehicles at once
+            from fleet import FleetSimulator, fleet_vehicle_class
+            self.Vehicle = fleet_vehicle_class(vehicle_class(self.settings.inter_control_mode))
+            self.simulator = FleetSimulator(self)
+        else:
+            self.Vehicle = vehicle_class(self.settings.inter_control_mode)
+            self.simulator = Simulator(self)
+
+    def open_log(self, log_fname):
+        '''Set up the logger and the recorder that write this context's log to log_fname (see __init__)'''
+        self.log_fname = log_fname
+        if log_fname:
+            self.logger = logging.getLogger('PythonSim.%d' % id(self))
+            self.logger.propagate = False
+            # Handlers left on this name belong to another log (an earlier context, or the parent of a forked process),
+            # they are detached without closing them, closing would flush their buffers into that log
+            for handler in list(self.logger.handlers):
+                self.logger.removeHandler(handler)
+        if log_fname and self.settings.log_format in ('binary', 'none'):
+            # Trajectory and events all go to the recorder's files (or nowhere)
+            self.logger.addHandler(logging.NullHandler())
+        elif log_fname:
+            self.logger.setLevel(logging.DEBUG)
+            handler = logging.FileHandler(log_fname, mode='w')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.debug('t, veh._id, zone, lane, x, v, a')
+        else:
+            self.logger = logging.getLogger()
+        self.recorder = make_recorder(self)
+
+    def close(self):
+        '''Flush and detach the log file of this context, and save the profile (settings.profile) next to it'''
+        self.recorder.close()
+        if self.simulator.profiler and self.log_fname:
+            self.simulator.profiler.save(os.path.splitext(self.log_fname.rstrip(os.sep))[0] + '.profile.csv')
+        if self.log_fname:
+            for handler in list(self.logger.handlers):
+                handler.close()
+                self.logger.removeHandler(handler)
@@ -0,0 +1,154 @@
+import numpy as np
+
+class DemandSchedule:
+    '''
+    The arrivals of vehicles at the point queues of the approach lanes, generated ahead of the simulation (settings.demand):
+        'bernoulli'  every stream (arm, lane, turn) gets a vehicle with probability flow / 3600 * veh_dt at every timestep,
+                     the uniform numbers are drawn demand_chunk timesteps at a time from the context's np_random, in the order
+                     the per-timestep draws of Simulator.gen_new_veh take them, so the arrivals are the same
+        'poisson'    every stream gets vehicles with exponential gaps (mean 3600 / flow s) in continuous time, an arrival belongs
+                     to the first timestep at or after it
+        a file       the arrivals recorded by save (settings.demand_file), so that a scenario can be replayed under any manager
+    The arrivals do not depend on what happens in the simulation, so runs of the same seed under different managers get the same
+    vehicles at the same timesteps.
+    Arrivals are kept as arrays of timesteps and stream indices, sorted by timestep and, within a timestep, by stream
+    (by arrival time for 'poisson').
+    '''
+    def __init__(self, ctx, kind):
+        self.ctx = ctx
+        s = ctx.settings
+        self.kind = kind
+        self.veh_dt = s.veh_dt
+        self.chunk = s.demand_chunk
+        # One stream per (arm, turn, lane) of veh_gen_rule_table, in the order gen_new_veh draws them
+        self.streams = []
+        flows = []
+        for ap_arm in 'NSEW':
+            for turn_dir in 'lrt':
+                for (lane, flow) in enumerate(s.veh_gen_rule_table[ap_arm + turn_dir]):
+                    self.streams.append((ap_arm, lane, turn_dir))
+                    flows.append(flow)
+        self.flows = np.array(flows, dtype=float)
+        self.t = np.zeros(0, dtype=np.int64)
+        self.stream = np.zeros(0, dtype=np.int64)
+        self.k = 0 # The next arrival to hand out
+        self.generated_until = 0 # Arrivals are known for all timesteps up to this one
+        self.next_arrival = None # poisson: the next arrival time (s) of each stream
+
+    @staticmethod
+    def from_settings(ctx):
+        '''The schedule that the settings ask for, None for demand = 'per_tick' (gen_new_veh draws every timestep)'''
+        s = ctx.settings
+        if s.demand_file:
+            return DemandSchedule.load(ctx, s.demand_file)
+        if s.demand == 'per_tick':
+            return None
+        if s.demand not in ('bernoulli', 'poisson'):
+            raise ValueError('Unknown demand: %s' % s.demand)
+        return DemandSchedule(ctx, s.demand)
+
+    def arrivals(self, timestep):
+        '''The streams (ap_arm, lane, turn_dir) of the vehicles that arrive at timestep, in order'''
+        while self.generated_until < timestep and self.kind != 'file':
+            self.generate(self.generated_until + self.chunk)
+        start = self.k
+        while self.k < len(self.t) and self.t[self.k] <= timestep:
+            self.k += 1
+        return [self.streams[i] for i in self.stream[start:self.k].tolist()]
+
+    def generate(self, until):
+        '''Add the arrivals of the timesteps after generated_until up to until'''
+        first = self.generated_until + 1
+        if self.kind == 'bernoulli':
+            prob = self.flows / 3600 * self.veh_dt
+            hits = self.ctx.np_random.rand(until - first + 1, len(self.streams)) < prob
+            t, stream = np.nonzero(hits)
+            t += first
+        else:
+            t, stream = self.generate_poisson(until)
+        self.append(t, stream)
+        self.generated_until = until
+
+    def generate_poisson(self, until):
+        rng = self.ctx.np_random
+        if self.next_arrival is None:
+            # The gaps are memoryless, the first arrivals can be drawn from any point in time
+            self.next_arrival = np.full(len(self.streams), np.inf)
+            for (i, flow) in enumerate(self.flows):
+                if flow > 0:
+                    self.next_arrival[i] = self.generated_until * self.veh_dt + rng.exponential(3600 / flow)
+        end_time = until * self.veh_dt # Arrivals up to end_time belong to timesteps up to until
+        times, streams = [], []
+        for (i, flow) in enumerate(self.flows):
+            if flow <= 0:
+                continue
+            arrival = [self.next_arrival[i]]
+            while arrival[-1] <= end_time:
+                # Gaps in batches of about the expected number of arrivals
+                gaps = rng.exponential(3600 / flow, int((end_time - arrival[-1]) * flow / 3600) + 4)
+                arrival.extend((arrival[-1] + np.cumsum(gaps)).tolist())
+            arrival = np.array(arrival)
+            inside = arrival <= end_time
+            times.append(arrival[inside])
+            streams.append(np.full(inside.sum(), i))
+            self.next_arrival[i] = arrival[~inside][0]
+        if not times:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        times, streams = np.concatenate(times), np.concatenate(streams)
+        t = np.maximum(np.ceil(times / self.veh_dt - 1e-9).astype(np.int64), 1)
+        order = np.lexsort((times, t)) # By timestep, then by arrival time
+        return t[order], streams[order]
+
+    def append(self, t, stream):
+        # Arrivals that were handed out are not needed any more
+        self.t = np.concatenate([self.t[self.k:], t])
+        self.stream = np.concatenate([self.stream[self.k:], stream])
+        self.k = 0
+
+    def discard_after(self, timestep):
+        '''Forget the arrivals generated for the timesteps after timestep, they are drawn again (from a reseeded np_random)'''
+        if self.kind == 'file':
+            return
+        keep = self.t <= timestep
+        self.t, self.stream = self.t[keep], self.stream[keep]
+        self.generated_until = timestep
+        self.next_arrival = None
+
+    def save(self, fname, until=None):
+        '''
+        Write the arrivals that are not handed out yet, up to timestep until (simu_t by default), as lines "t, ap_arm, lane, turn_dir".
+        Called before the simulation starts, it records the whole demand of the run.
+        '''
+        s = self.ctx.settings
+        until = int(round(s.simu_t / s.veh_dt)) if until is None else until
+        if self.kind != 'file' and self.generated_until < until:
+            self.generate(until)
+        with open(fname, 'w') as f:
+            f.write('t, ap_arm, lane, turn_dir\n')
+            for (t, i) in zip(self.t[self.k:].tolist(), self.stream[self.k:].tolist()):
+                if t > until:
+                    break
+                ap_arm, lane, turn_dir = self.streams[i]
+                f.write('%d, %s, %d, %s\n' % (t, ap_arm, lane, turn_dir))
+
+    @staticmethod
+    def load(ctx, fname):
+        '''A schedule that replays the arrivals written by save'''
+        schedule = DemandSchedule(ctx, 'file')
+        index = {stream: i for (i, stream) in enumerate(schedule.streams)}
+        t, stream = [], []
+        with open(fname) as f:
+            for (n, line) in enumerate(f):
+                if n == 0 or not line.strip():
+                    continue
+                row = [value.strip() for value in line.split(',')]
+                key = (row[1], int(row[2]), row[3])
+                if key not in index or schedule.flows[index[key]] <= 0:
+                    # Map only builds the junction tracks of the streams with a flow in veh_gen_rule_table
+                    raise ValueError('%s line %d: stream %s has no flow in veh_gen_rule_table' % (fname, n + 1, key))
+                t.append(int(row[0]))
+                stream.append(index[key])
+        t, stream = np.array(t, dtype=np.int64), np.array(stream, dtype=np.int64)
+        order = np.argsort(t, kind='stable')
+        schedule.append(t[order], stream[order])
+        return schedule
@@ -0,0 +1,257 @@
+import numpy as np
+
+from recorder import ZONES, ZONE_CODE
+from simulator import Simulator
+from vehicle import BaseVehicle, CFModel, array_min
+
+class Fleet:
+    '''
+    Structure-of-arrays state of the vehicles of one context: every column is a numpy array and each vehicle owns one row (slot).
+    Rows of removed vehicles are reused, the arrays double in size when they are full.
+    '''
+    zones = ZONES
+    zone_code = ZONE_CODE
+    float_columns = ('x', 'v', 'a', 'veh_len', 'veh_len_front', 'veh_len_back', 'max_v', 'max_acc', 'max_dec',
+        'v0', 'T', 's0', 'cf_a', 'cf_b', 'ju_len')
+    int_columns = ('zone', 'lane', 'timestep', 'ex_lane', 'track_key')
+
+    def __init__(self, size=64):
+        self.size = size
+        for name in self.float_columns:
+            setattr(self, name, np.zeros(size))
+        for name in self.int_columns:
+            setattr(self, name, np.zeros(size, dtype=np.int64))
+        self.free = list(range(size - 1, -1, -1))
+        self.track_keys = {} # junction track ('Nl00', ...): integer id, vehicles on the same junction track follow each other
+
+    def add(self):
+        '''A free row for a new vehicle'''
+        if not self.free:
+            self.grow()
+        return self.free.pop()
+
+    def grow(self):
+        for name in self.float_columns + self.int_columns:
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate([column, np.zeros_like(column)]))
+        self.free = list(range(2 * self.size - 1, self.size - 1, -1))
+        self.size *= 2
+
+    def row(self, slot):
+        '''A one-row copy of a vehicle's state'''
+        fleet = Fleet(size=1)
+        for name in self.float_columns + self.int_columns:
+            getattr(fleet, name)[0] = getattr(self, name)[slot]
+        fleet.free = []
+        return fleet
+
+    def release(self, veh):
+        '''The vehicle leaves the fleet, it keeps a private copy of its last state so that references to it stay valid'''
+        slot = veh._slot
+        veh._fleet, veh._slot = self.row(slot), 0
+        self.free.append(slot)
+
+    def track_id(self, track_key):
+        if track_key not in self.track_keys:
+            self.track_keys[track_key] = len(self.track_keys)
+        return self.track_keys[track_key]
+
+def idm(v, s, v_l, v0, T, s0, a, b):
+    '''CFModel.acc_from_model on arrays'''
+    s_star = s0 + np.maximum(0, v * T + v * (v - v_l) / 2 / np.sqrt(a * b))
+    acc_free = np.where(v < v0, a * (1 - (v / v0)**4), a * (1 - v / v0))
+    dec = - a * (s_star / np.maximum(s, s0))**2
+    return acc_free + dec
+
+def fleet_column(name):
+    '''A vehicle attribute stored in its row of the fleet'''
+    def get(self):
+        return getattr(self._fleet, name).item(self._slot)
+    def set(self, value):
+        getattr(self._fleet, name)[self._slot] = value
+    return property(get, set)
+
+def cf_column(name):
+    '''A car-following parameter stored in the vehicle's row of the fleet'''
+    def get(self):
+        return getattr(self.veh._fleet, name).item(self.veh._slot)
+    def set(self, value):
+        getattr(self.veh._fleet, name)[self.veh._slot] = value
+    return property(get, set)
+
+class FleetCFModel(CFModel):
+    '''CFModel whose parameters live in the fleet, so that vectorised and per-vehicle car following use the same values'''
+    v0 = cf_column('v0')
+    T = cf_column('T')
+    s0 = cf_column('s0')
+    a = cf_column('cf_a')
+    b = cf_column('cf_b')
+    __slots__ = ('veh',)
+
+    def __init__(self, veh, cf_model):
+        self.veh = veh
+        self.v0, self.T, self.s0, self.a, self.b = cf_model.v0, cf_model.T, cf_model.s0, cf_model.a, cf_model.b
+        self.delta = cf_model.delta
+
+    def __getstate__(self):
+        # The parameters are in the fleet, which is saved with it, only the vehicle and delta are the model's own
+        return self.veh, self.delta
+
+    def __setstate__(self, state):
+        self.veh, self.delta = state
+
+class FleetBacked:
+    '''Mixin for the vehicle classes: the dynamic state is kept in the context's Fleet instead of instance attributes'''
+    inst_x = fleet_column('x')
+    inst_v = fleet_column('v')
+    inst_a = fleet_column('a')
+    inst_lane = fleet_column('lane')
+    timestep = fleet_column('timestep')
+    __slots__ = ()
+
+    @property
+    def zone(self):
+        return Fleet.zones[self._fleet.zone.item(self._slot)]
+
+    @zone.setter
+    def zone(self, value):
+        self._fleet.zone[self._slot] = Fleet.zone_code[value]
+
+    def __init__(self, ctx, *args, **kwargs):
+        self._fleet = ctx.simulator.fleet
+        self._slot = self._fleet.add()
+        super().__init__(ctx, *args, **kwargs)
+        f, k = self._fleet, self._slot
+        f.veh_len[k] = self.veh_len
+        f.veh_len_front[k] = self.veh_len_front
+        f.veh_len_back[k] = self.veh_len_back
+        f.max_v[k] = self.max_v
+        f.max_acc[k] = self.max_acc
+        f.max_dec[k] = self.max_dec
+        f.ju_len[k] = np.inf
+        self.cf_model = FleetCFModel(self, self.cf_model)
+
+    def change_cf_model(self, cf_model):
+        '''The vehicle keeps its FleetCFModel, the parameters of cf_model are written to its row of the fleet'''
+        self.cf_model.v0, self.cf_model.T, self.cf_model.s0, self.cf_model.a, self.cf_model.b = cf_model.v0, cf_model.T, cf_model.s0, cf_model.a, cf_model.b
+
+fleet_classes = {}
+def fleet_vehicle_class(vehicle_cls):
+    '''The fleet-backed version of a vehicle class'''
+    if vehicle_cls not in fleet_classes:
+        fleet_classes[vehicle_cls] = type('Fleet' + vehicle_cls.__name__, (FleetBacked, vehicle_cls), {'__slots__': ('_fleet', '_slot')})
+    return fleet_classes[vehicle_cls]
+
+class FleetSimulator(Simulator):
+    '''
+    Simulator whose kinematics, zone transitions and car following run on the Fleet arrays for all vehicles at once, with the
+    leaders taken from the ordered lane queues. Vehicle hooks (before_move, after_move) still run per vehicle in all_veh order,
+    and the control cases that need messages (fleet_control says which) in Simulator.control_order.
+    '''
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.fleet = Fleet()
+        # Skip the per-vehicle hook loops when the vehicle class does not use them
+        self.has_before_move = ctx.Vehicle.before_move is not BaseVehicle.before_move
+        self.has_after_move = ctx.Vehicle.after_move is not BaseVehicle.after_move
+
+    def vehicles_in_order(self):
+        '''All vehicles in all_veh order, their group names and their rows in the fleet'''
+        vehs, groups = [], []
+        for group, group_vehs in self.all_veh.items():
+            vehs.extend(group_vehs)
+            groups.extend([group] * len(group_vehs))
+        slots = np.array([veh._slot for veh in vehs], dtype=np.int64)
+        return vehs, groups, slots
+
+    def vehicles_by_queue(self):
+        '''All vehicles in Simulator.control_order, their rows in the fleet, and the index of the vehicle in front of each (-1 at the front of a queue)'''
+        order = list(self.control_order())
+        index = {id(veh): i for (i, (veh, _)) in enumerate(order)}
+        vehs = [veh for (veh, _) in order]
+        lead = [index[id(lead_veh)] if lead_veh is not None else -1 for (_, lead_veh) in order]
+        slots = np.array([veh._slot for veh in vehs], dtype=np.int64)
+        return vehs, slots, np.array(lead, dtype=np.int64)
+
+    def all_update_position(self):
+        vehs, groups, k = self.vehicles_in_order()
+        if not vehs:
+            return []
+        f = self.fleet
+        dt = self.ctx.settings.veh_dt
+        # BaseVehicle.move for everyone
+        a, v, x, zone, lane = f.a[k], f.v[k], f.x[k], f.zone[k], f.lane[k]
+        timestep = f.timestep[k] + 1
+        a[(v <= 0) & (a <= 0)] = 0 # When the vehicle is stopped, the vehicle cannot reverse even if the acceleration is negative.
+        x += a * (dt ** 2) / 2 + v * dt
+        v = array_min(np.maximum(v + a * dt, 0), f.max_v[k])
+        to_ju = (zone == Fleet.zone_code['ap']) & (x >= 0)
+        to_ex = (zone == Fleet.zone_code['ju']) & (x >= f.ju_len[k])
+        switched = to_ju | to_ex
+        metrics = self.metrics
+        for i in np.flatnonzero(to_ju):
+            # The junction track is fixed from now on
+            track, slot = vehs[i].track, k[i]
+            f.ju_len[slot] = track.ju_shape_end_x[-1]
+            f.ex_lane[slot] = track.ex_lane
+            f.track_key[slot] = f.track_id(track.key)
+            metrics.on_enter_junction(vehs[i]._id, timestep[i])
+        for i in np.flatnonzero(to_ex):
+            metrics.on_leave_junction(vehs[i]._id, timestep[i], f.x[k[i]]) # f.x still has the position before the move
+        zone[to_ju], lane[to_ju] = Fleet.zone_code['ju'], -1
+        zone[to_ex], lane[to_ex] = Fleet.zone_code['ex'], f.ex_lane[k[to_ex]]
+        x[to_ex] -= f.ju_len[k[to_ex]]
+
+        if self.has_before_move:
+            # A hook may look at the other vehicles (a new XuVehicle triggers a topology update), as in Simulator it has to see
+            # the vehicles before it in all_veh already moved and the ones after it not yet, so the new state is written row by row
+            for (i, veh) in enumerate(vehs):
+                veh.before_move(dt)
+                slot = k[i]
+                f.a[slot], f.v[slot], f.x[slot], f.zone[slot], f.lane[slot], f.timestep[slot] = a[i], v[i], x[i], zone[i], lane[i], timestep[i]
+        else:
+            f.a[k], f.v[k], f.x[k], f.zone[k], f.lane[k], f.timestep[k] = a, v, x, zone, lane, timestep
+
+        rows = np.flatnonzero(~switched)
+        veh_id = np.array([vehs[i]._id for i in rows], dtype=np.int64)
+        self.ctx.recorder.record_many(timestep[rows], veh_id, zone[rows], lane[rows], x[rows], v[rows], a[rows])
+
+        if self.has_after_move:
+            for (veh, switch_group) in zip(vehs, switched.tolist()):
+                veh.after_move(dt, switch_group)
+        return [[vehs[i], groups[i]] for i in np.flatnonzero(switched)]
+
+    def remove_out_veh(self):
+        arm_len = self.ctx.settings.arm_len
+        for group, vehs in self.all_veh.items():
+            if group[-2:] == 'ex' and vehs:
+                slots = [veh._slot for veh in vehs]
+                out = self.fleet.x[slots] >= arm_len + self.fleet.veh_len_back[slots]
+                if out.any():
+                    for i in np.flatnonzero(out)[::-1]:
+                        veh = vehs.pop(i)
+                        self.remove_from_queue(veh)
+                        self.metrics.on_remove(veh)
+                        self.hand_off(veh)
+                        self.fleet.release(veh)
+
+    def update_all_control(self):
+        vehs, k, lead = self.vehicles_by_queue()
+        if not vehs:
+            return
+        f = self.fleet
+
+        # Car following on arrays, no lead vehicle means one infinitely far away driving at the desired speed
+        has_lead = lead >= 0
+        lead_k = k[np.where(has_lead, lead, 0)]
+        x, v, v0 = f.x[k], f.v[k], f.v0[k]
+        gap = np.where(has_lead, f.x[lead_k] - x - f.veh_len[lead_k], 1e3)
+        v_l = np.where(has_lead, f.v[lead_k], v0)
+        T, s0, cf_a, cf_b = f.T[k], f.s0[k], f.cf_a[k], f.cf_b[k]
+        acc_lead = idm(v, gap, v_l, v0, T, s0, cf_a, cf_b)
+        acc_stop = idm(v, - x - f.veh_len_front[k], 0, v0, T, s0, cf_a, cf_b)
+
+        acc, own = self.ctx.Vehicle.fleet_control(f, k, lead, vehs, acc_lead, acc_stop)
+        f.a[k[~own]] = acc[~own]
+        for i in np.flatnonzero(own):
+            vehs[i].update_control(vehs[lead[i]] if lead[i] >= 0 else None)
@@ -0,0 +1,118 @@
+import sys
+import time
+import logging
+import os
+
+import lib.settings
+
+def turn_flows(total_flow, turn_split=(0.25, 0.5, 0.25)):
+    '''The (left, through, right) flow of each arm for a total flow spread evenly over the four arms'''
+    return tuple(total_flow / 4 * share for share in turn_split)
+
+def scenario_settings(mode, total_flow, turn_split=(0.25, 0.5, 0.25)):
+    '''
+    Settings overrides for a control mode and a total flow (pcu/hour) spread evenly over the four arms, see SimulationContext.
+    turn_split is the (left, through, right) share of each arm's flow, each turn uses its own lane.
+    '''
+    if mode == 'Dresner':
+        overrides = {'arm_len': 100, 'inter_control_mode': 'Dresner'}
+    elif mode == 'Xu':
+        overrides = {'arm_len': 200, 'inter_control_mode': 'Xu'}
+    else:
+        overrides = {'arm_len': 100, 'inter_control_mode': 'traffic light'}
+
+    # Balance by default: l_flow = total_flow / 16, t_flow = total_flow / 8, r_flow = total_flow / 16
+    l_flow, t_flow, r_flow = turn_flows(total_flow, turn_split)
+
+    overrides['veh_gen_rule_table'] = {
+        # Three lane balance
+        'Nl': [l_flow, 0, 0],
+        'Nt': [0, t_flow, 0],
+        'Nr': [0, 0, r_flow],
+        'Sl': [l_flow, 0, 0],
+        'St': [0, t_flow, 0],
+        'Sr': [0, 0, r_flow],
+        'El': [l_flow, 0, 0],
+        'Et': [0, t_flow, 0],
+        'Er': [0, 0, r_flow],
+        'Wl': [l_flow, 0, 0],
+        'Wt': [0, t_flow, 0],
+        'Wr': [0, 0, r_flow]
+    }
+    return overrides
+
+def configure(mode, total_flow, turn_split=(0.25, 0.5, 0.25)):
+    '''Write the scenario into lib.settings, which the default context (GUI) is built from. Returns the per-lane flows (left, through, right)'''
+    for key, value in scenario_settings(mode, total_flow, turn_split).items():
+        setattr(lib.settings, key, value)
+    return turn_flows(total_flow, turn_split)
+
+def init_log(log_dir='log'):
+    '''Create the log file that the default context writes trajectories to, and return its name'''
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    log_fname = os.path.join(log_dir, 'log %s.log' % time.strftime("%Y-%m-%d %H-%M-%S"))
+    logging.basicConfig(filename=log_fname, format='%(message)s', level=logging.DEBUG)
+    logging.debug('t, veh._id, zone, lane, x, v, a')
+    return log_fname
+
+def run_context(ctx):
+    '''
+    Advance ctx.simulator.update() in a plain loop, as fast as the CPU allows, with the same stop conditions as the GUI
+    (simu_t reached, or check_for_finish after a crash)
+    '''
+    sim = ctx.simulator
+    max_timestep = ctx.settings.simu_t / ctx.settings.veh_dt
+    while sim.timestep < max_timestep and not sim.get_sim_over():
+        sim.update()
+    return ctx
+
+def run_headless(mode, total_flow, seed=None, log_dir='log', turn_split=(0.25, 0.5, 0.25), **overrides):
+    '''
+    Run one scenario in its own SimulationContext without any GUI and return its metrics (metrics.MetricsAccumulator.summary,
+    the same values as cal_delay.cal_metrics of the run's log, plus the keys only the summary has).
+    Several runs can share one process, each gets its own log file (or directory, with log_format='binary', or none with 'none').
+    '''
+    # No window will ever be shown, so keep matplotlib away from any GUI backend
+    import matplotlib
+    matplotlib.use('Agg')
+    from context import SimulationContext
+
+    settings = scenario_settings(mode, total_flow, turn_split)
+    settings.update(overrides)
+    log_format = settings.get('log_format', lib.settings.log_format)
+    if log_format == 'none':
+        log_fname = None
+    else:
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        # A binary log is a directory of numpy chunks, see recorder.BinaryRecorder
+        ext = '.traj' if log_format == 'binary' else '.log'
+        log_fname = os.path.join(log_dir, 'log %s %s %d %s%s' % (time.strftime("%Y-%m-%d %H-%M-%S"), mode, total_flow, seed, ext))
+    ctx = SimulationContext(seed=seed, log_fname=log_fname, **settings)
+    run_context(ctx)
+    ctx.close()
+
+    metrics = ctx.simulator.metrics.summary()
+    metrics['log_fname'] = log_fname
+    if ctx.simulator.profiler:
+        metrics['profile'] = ctx.simulator.profiler.summary()
+    return metrics
+
+if __name__ == '__main__':
+    # python headless.py Dresner 2880 [seed] [text|binary|none] [profile]
+    mode = sys.argv[1]
+    total_flow = int(sys.argv[2])
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    log_format = sys.argv[4] if len(sys.argv) > 4 else lib.settings.log_format
+    profile = len(sys.argv) > 5 and sys.argv[5] == 'profile'
+    print('## %d = 4 * (%d + %d + %d)' % ((total_flow,) + turn_flows(total_flow)))
+
+    start = time.time()
+    metrics = run_headless(mode, total_flow, seed, log_format=log_format, profile=profile)
+    if profile:
+        from profiler import PhaseProfiler
+        print(PhaseProfiler.format_table(metrics.pop('profile')))
+    for key, value in metrics.items():
+        print(key, '=', value)
+    print('wall_time = %.1f s' % (time.time() - start))
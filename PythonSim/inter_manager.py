@@ -1,31 +1,61 @@
 import math
-import logging
+import heapq
+import bisect
+import random
 
-from lib.settings import inter_control_mode, lane_width, turn_radius, arm_len, NS_lane_count, EW_lane_count, veh_dt, inter_v_lim, inter_v_lim_min, min_gen_ht, conflict_movements, virtual_lead_v, desired_cf_distance, phase, yellow_time,crashValues
-from map import Map, Track
+from collision import CollisionDetector, veh_corners
 
 import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
 
 class BaseInterManager:
-    def __init__(self):
+    def __init__(self, ctx):
+        # The simulation context this manager serves (settings, map, communication system)
+        self.ctx = ctx
         self.timestep = 0
+        self.collision_detector = CollisionDetector() # For check_for_collision_sat
     def update(self):
         self.timestep += 1
     def receive_V2I(self, sender, message):
         pass
+    def receive_V2I_batch(self, messages):
+        '''The V2I messages that ComSystem delivers together, as (sender, message) in the order they were sent'''
+        for (sender, message) in messages:
+            self.receive_V2I(sender, message)
 
         
     def check_for_collision(self,all_vehicles):
-        pass
+        return []
+
+    def check_for_collision_sat(self, all_vehicles):
+        '''
+        The vehicles in the junction whose rectangles (grown by collision_buffer) overlap, found with collision.CollisionDetector.
+        Both vehicles of every overlapping pair get a collision message, returns their ids in the order check_for_collision lists them.
+        '''
+        buf = self.ctx.settings.collision_buffer
+        xs, ys, angles = self.ctx.map.veh_poses(all_vehicles)
+        rects = [veh_corners(x, y, angle, veh.veh_wid, veh.veh_len, veh.veh_len_front, buf) for (veh, x, y, angle) in zip(all_vehicles, xs, ys, angles)]
+        crashed_Vehicle_ID = []
+        reply_message = {'type': 'collision'}
+        for (j, i) in self.collision_detector.find_pairs(rects):
+            veh, other = all_vehicles[i], all_vehicles[j]
+            for veh_id in (other._id, veh._id):
+                if veh_id not in crashed_Vehicle_ID:
+                    crashed_Vehicle_ID.append(veh_id)
+            self.ctx.com.I2V(veh, reply_message)
+            self.ctx.com.I2V(other, reply_message)
+        return crashed_Vehicle_ID
+
+    def check_for_collision_noCars(self):
+        return False
 
 class TrafficLightManager(BaseInterManager):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, ctx):
+        super().__init__(ctx)
         self.current_phase = 0
         self.current_elapsed_time = 0
-        self.phase = phase
+        self.phase = ctx.settings.phase
 
 
     def update(self):
@@ -39,14 +69,14 @@ class TrafficLightManager(BaseInterManager):
             # This phase is over, change to the next phase
             self.current_elapsed_time = 0
             self.current_phase = (self.current_phase + 1) % len(self.phase)
-        if self.current_elapsed_time >= self.phase[self.current_phase][0] - (yellow_time / veh_dt):
+        if self.current_elapsed_time >= self.phase[self.current_phase][0] - (self.ctx.settings.yellow_time / self.ctx.settings.veh_dt):
             # It's yellow light time
             for ap_arm_dir in ['Nl', 'Nt', 'Nr', 'Sl', 'St', 'Sr', 'El', 'Et', 'Er', 'Wl', 'Wt', 'Wr']:
                 if ap_arm_dir in self.phase[self.current_phase]:
                     message[ap_arm_dir] = 'Y'
                 else: 
                     message[ap_arm_dir] = 'R'
-            ComSystem.I_broadcast(message)
+            self.ctx.com.I_broadcast(message)
             # print('Yellow light = [%s]' % str(self.phase[self.current_phase][1:]))
         else:
             for ap_arm_dir in ['Nl', 'Nt', 'Nr', 'Sl', 'St', 'Sr', 'El', 'Et', 'Er', 'Wl', 'Wt', 'Wr']:
@@ -54,17 +84,18 @@ class TrafficLightManager(BaseInterManager):
                     message[ap_arm_dir] = 'G'
                 else: 
                     message[ap_arm_dir] = 'R'
-            ComSystem.I_broadcast(message)
+            self.ctx.com.I_broadcast(message)
             # print('Green light = [%s]' % str(self.phase[self.current_phase][1:]))
         
     def receive_V2I(self, sender, message):
         return 
 
 class DresnerManager(BaseInterManager):
-    def __init__(self):
-        super().__init__()
-        self.res_grid = DresnerResGrid(0.5) # Write to settings?
-        self.running_grid = DresnerResGrid(0.1)
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.res_grid = DresnerResGrid(ctx, 0.5) # Write to settings?
+        self.running_grid = DresnerResGrid(ctx, 0.1, horizon=1) # Only the current timestep is used for collision checks
+        self.footprints = FootprintCache(ctx, self.res_grid, self.gen_veh_dots)
         self.ex_lane_table = self.gen_ex_lane_table()
         self.res_registery = {}
         self.crash_happened = False
@@ -77,44 +108,7 @@ class DresnerManager(BaseInterManager):
         return self.running_grid.cells
     
     def get_grid_location(self,veh):
-        seg_idx = 0
-        for (i, end_x) in enumerate(veh.track.ju_shape_end_x):
-            if veh.inst_x > end_x: # is greater than the end point of the i-th segment, then it is in the (i+1) segment
-                seg_idx = i + 1
-                break
-        seg = veh.track.ju_track[seg_idx] #The shape of this segment
-        if seg_idx > 0:
-            seg_x = veh.inst_x - veh.track.ju_shape_end_x[seg_idx - 1] # The length of this segment
-        else:
-            seg_x = veh.inst_x
-        if seg[0] == 'line': # is a straight line
-            if abs(seg[1][0] - seg[2][0]) < 1e-5: # vertical bar
-                x = seg[1][0]
-                if seg[1][1] < seg[2][1]: # from top to bottom
-                    y = seg[1][1] + seg_x
-                    angle = 180 # angle is the number of degrees of clockwise rotation compared to "head to north"
-                else: # from bottom to top
-                    y = seg[1][1] - seg_x
-                    angle = 0
-            else: # Horizontal line
-                y = seg[1][1]
-                if seg[1][0] < seg[2][0]: # from left to right
-                    x = seg[1][0] + seg_x
-                    angle = 90 
-                else: # from right to left
-                    x = seg[1][0] - seg_x
-                    angle = 270
-        else:  # circular curve
-            if seg[5][0] < seg[5][1]: # Trajectory counterclockwise
-                rotation = seg[5][0] + seg_x / seg[4] * 180 / math.pi
-                angle = 180 - rotation
-                x = seg[3][0] + seg[4] * math.cos(-rotation / 180 * math.pi)
-                y = seg[3][1] + seg[4] * math.sin(-rotation / 180 * math.pi)
-            else:
-                rotation = seg[5][0] - seg_x / seg[4] * 180 / math.pi
-                angle = - rotation
-                x = seg[3][0] + seg[4] * math.cos(-rotation / 180 * math.pi)
-                y = seg[3][1] + seg[4] * math.sin(-rotation / 180 * math.pi)
+        x, y, angle = self.ctx.map.pose_at(veh.track.key, veh.inst_x)
 
         # Calculate the xy coordinates of the vehicle's dots in the logical coordinate system (first rotate, then place in xy)
         veh_dots_x, veh_dots_y = self.gen_veh_dots(veh.veh_wid, veh.veh_len, veh.veh_len_front, \
@@ -129,12 +123,15 @@ class DresnerManager(BaseInterManager):
     
     def check_for_collision(self,all_vehicles):
         crashed_Vehicle_ID=[]
-        if self.crash_happened:
+        if self.crash_happened and self.ctx.settings.collision_check == 'sat':
+            crashed_Vehicle_ID = self.check_for_collision_sat(all_vehicles)
+        elif self.crash_happened:
+            vehs_by_id = {veh._id: veh for veh in all_vehicles}
             for veh in all_vehicles:
                 i,j = self.get_grid_location(veh)
 
                 for idx in range(len(i)):
-                    current_cell = self.get_grid_cells()[i[idx], j[idx], 0]  # Access the current cell
+                    current_cell = int(self.get_grid_cells()[i[idx], j[idx], 0])  # Access the current cell (as a plain int, it ends up in the log)
                     
                     if current_cell != -1 and current_cell != veh._id:  # If the cell is occupied by another vehicle
                         if current_cell not in crashed_Vehicle_ID:  # If the occupying vehicle is not already in the list
@@ -144,16 +141,17 @@ class DresnerManager(BaseInterManager):
                             crashed_Vehicle_ID.append(veh._id)  # Add the current vehicle ID to the list
 
                         reply_message = {'type': 'collision'}
-                        ComSystem.I2V(veh, reply_message)  # Send a collision message to the current vehicle
+                        self.ctx.com.I2V(veh, reply_message)  # Send a collision message to the current vehicle
 
                         # Assuming you have a way to send messages to other vehicles by ID
-                        ComSystem.I2V(self.get_vehicle_by_id(current_cell,all_vehicles), reply_message)  # Send a collision message to the occupying vehicle
+                        self.ctx.com.I2V(vehs_by_id.get(current_cell), reply_message)  # Send a collision message to the occupying vehicle
 
                     # Update the cell to indicate it's now occupied by the current vehicle
                     self.get_grid_cells()[i[idx], j[idx], 0] = veh._id
             self.running_grid.reset_grid()
 
-        logging.debug('crashed_Vehicle_ID:%s', crashed_Vehicle_ID)
+        if crashed_Vehicle_ID:
+            self.ctx.recorder.event('crash', t=self.timestep, veh_ids=crashed_Vehicle_ID)
         return crashed_Vehicle_ID
     
     def check_for_collision_noCars(self):
@@ -176,21 +174,28 @@ class DresnerManager(BaseInterManager):
                     'type': 'reject',
                     'timeout': 1
                 }
-                ComSystem.I2V(sender, reply_message)
+                self.ctx.com.I2V(sender, reply_message)
             reservation = self.check_request(message)
+            reply_type = 'confirm'
+            if not reservation and self.ctx.settings.res_counter_offer:
+                # Rather than have the vehicle ask again every timestep, offer it the earliest later arrival that is free
+                reservation = self.earliest_slot(message)
+                reply_type = 'counter-offer'
             if reservation:
                 reply_message = {
-                    'type': 'confirm',
+                    'type': reply_type,
                     'reservation': reservation
                 }
-                self.res_registery[message['veh_id']] = reservation['res_id']
-                ComSystem.I2V(sender, reply_message)
+                self.res_registery[message['veh_id']] = reservation.res_id
+                self.ctx.recorder.event('reservation', t=self.timestep, veh_id=message['veh_id'], ex_lane=reservation.ex_lane,
+                    arr_t=reservation.arr_t, arr_v=reservation.arr_v, exit_time=reservation.exit_time, counter_offer=reply_type == 'counter-offer')
+                self.ctx.com.I2V(sender, reply_message)
             else: 
                 reply_message = {
                     'type': 'reject',
                     'timeout': 1
                 }
-                ComSystem.I2V(sender, reply_message)
+                self.ctx.com.I2V(sender, reply_message)
         elif message['type'] == 'change-request':
             pass
         elif message['type'] == 'cancel':
@@ -200,7 +205,7 @@ class DresnerManager(BaseInterManager):
             # record any statistics supplied in message
             # process cancel with P
             self.res_registery.pop(message['veh_id']) # dict.pop(key)返回value并删除
-            ComSystem.I2V(sender, {
+            self.ctx.com.I2V(sender, {
                 'type': 'acknowledge',
                 'res_id': message['res_id']
             })
@@ -209,12 +214,14 @@ class DresnerManager(BaseInterManager):
 
     def crash_occured(self):
         self.crash_happened=True
-        crashValues['crashOccured']=True
-        ComSystem.I_broadcast({'type': 'crash'})
+        self.ctx.settings.crashValues['crashOccured']=True
+        self.ctx.com.I_broadcast({'type': 'crash'})
 
     
 
     def gen_ex_lane_table(self):
+        NS_lane_count = self.ctx.settings.NS_lane_count
+        EW_lane_count = self.ctx.settings.EW_lane_count
         table = {}
         table['Nl'] = list(range(EW_lane_count))
         table['Sl'] = table['Nl']
@@ -284,17 +291,20 @@ class DresnerManager(BaseInterManager):
         return [xx.flatten(), yy.flatten()]
 
     def check_request(self, message): 
-        ex_arm = Map.getInstance().get_ex_arm(message['arr_arm'], message['turn_dir'])
+        inter_v_lim = self.ctx.settings.inter_v_lim
+        inter_v_lim_min = self.ctx.settings.inter_v_lim_min
+        ex_arm = self.ctx.map.get_ex_arm(message['arr_arm'], message['turn_dir'])
         ex_lane_list = self.get_ex_lane_list(message['arr_arm'], message['turn_dir'], message['arr_lane'])
+        check_cells = self.check_cells_batched if self.ctx.settings.res_check_batched else self.check_cells_stepwise
         for ex_lane in ex_lane_list:
-            ju_track = Map.getInstance().get_ju_track(message['arr_arm'], message['turn_dir'], message['arr_lane'], ex_lane)
-            ju_shape_end_x = Track.cal_ju_shape_end_x(ju_track)
+            track_key = message['arr_arm'] + message['turn_dir'] + str(message['arr_lane']) + str(ex_lane)
+            ju_shape_end_x = self.footprints.get_track(track_key)[1]
             acc_distance = (inter_v_lim**2 - message['arr_v']**2) / 2 / message['max_acc']
             exit_time = message['arr_t']  # Initialize exit time with the arrival time
 
             if acc_distance >= ju_shape_end_x[-1]: 
                 # Accelerate the whole process
-                acc_acc = [[message['arr_t'], message['max_acc']]]
+                acc_acc = ((message['arr_t'], message['max_acc']),)
                 # Estimate exit time assuming constant acceleration over the distance
                 exit_time += ((2 * ju_shape_end_x[-1]) / message['max_acc']) ** 0.5
             else:
@@ -304,15 +314,15 @@ class DresnerManager(BaseInterManager):
                 constant_speed_time = constant_speed_distance / inter_v_lim
                 exit_time += acc_time + constant_speed_time
 
-                acc_acc = [
-                    [message['arr_t'], message['max_acc']], 
-                    [message['arr_t'] + acc_time, 0]
-                ]
+                acc_acc = (
+                    (message['arr_t'], message['max_acc']),
+                    (message['arr_t'] + acc_time, 0)
+                )
 
             if message['arr_v'] < inter_v_lim_min:
                 acc_distance_c = (8**2 - message['arr_v']**2) / 2 / message['max_acc']
                 if acc_distance_c >= ju_shape_end_x[-1]: 
-                    acc_const_v = [[message['arr_t'], message['max_acc']]]
+                    acc_const_v = ((message['arr_t'], message['max_acc']),)
                     exit_time += ((2 * ju_shape_end_x[-1]) / message['max_acc']) ** 0.5
                 else:
                     acc_time_c = (8 - message['arr_v']) / message['max_acc']
@@ -320,130 +330,260 @@ class DresnerManager(BaseInterManager):
                     constant_speed_time_c = constant_speed_distance_c / 8
                     exit_time += acc_time_c + constant_speed_time_c
 
-                    acc_const_v = [
-                        [message['arr_t'], message['max_acc']], 
-                        [message['arr_t'] + acc_time_c, 0]
-                    ]
+                    acc_const_v = (
+                        (message['arr_t'], message['max_acc']),
+                        (message['arr_t'] + acc_time_c, 0)
+                    )
             else:
-                acc_const_v = [[message['arr_t'], 0]]
+                acc_const_v = ((message['arr_t'], 0),)
                 constant_speed_distance = ju_shape_end_x[-1]
                 constant_speed_time = constant_speed_distance / message['arr_v']
                 exit_time += constant_speed_time
 
-            if self.check_cells_stepwise(message, ju_track, ju_shape_end_x, ex_arm, ex_lane, acc_acc):
-                return {
-                    'res_id': 0,  # Todo: Generate a unique reservation ID
-                    'ex_lane': ex_lane,
-                    'arr_t': message['arr_t'],
-                    'arr_v': message['arr_v'],
-                    'acc': acc_acc,
-                    'exit_time': exit_time  # Include the calculated exit time
-                }
-            elif self.check_cells_stepwise(message, ju_track, ju_shape_end_x, ex_arm, ex_lane, acc_const_v):
-                return {
-                    'res_id': 0,  # Todo: Generate a unique reservation ID
-                    'ex_lane': ex_lane,
-                    'arr_t': message['arr_t'],
-                    'arr_v': message['arr_v'],
-                    'acc': acc_const_v,
-                    'exit_time': exit_time  # Include the calculated exit time
-                }
+            if check_cells(message, track_key, ju_shape_end_x, ex_arm, ex_lane, acc_acc):
+                # Todo: Generate a unique reservation ID
+                return Reservation(0, ex_lane, message['arr_t'], message['arr_v'], acc_acc, exit_time)
+            elif check_cells(message, track_key, ju_shape_end_x, ex_arm, ex_lane, acc_const_v):
+                return Reservation(0, ex_lane, message['arr_t'], message['arr_v'], acc_const_v, exit_time)
         return None
 
             
-    def check_cells_stepwise(self, message, ju_track, ju_shape_end_x, ex_arm, ex_lane, acc):
+    def earliest_slot(self, message):
+        '''
+        Counter-offer for a request that cannot be granted as proposed: the arrival times every res_search_step after the proposed
+        one (up to res_search_horizon) are tried in turn, each with the arrival speed the vehicle can reach by then (approach_profile).
+        Returns the first reservation that fits, with the approach profile the vehicle has to follow (ap_acc), or None
+        '''
+        s = self.ctx.settings
+        step = s.res_search_step / s.veh_dt
+        for k in range(1, int(round(s.res_search_horizon / s.res_search_step)) + 1):
+            arr_t = message['arr_t'] + k * step
+            profile = self.approach_profile(message, arr_t)
+            if not profile:
+                continue
+            arr_v, ap_acc = profile
+            reservation = self.check_request(dict(message, arr_t=arr_t, arr_v=arr_v))
+            if reservation:
+                reservation.ap_acc = ap_acc
+                return reservation
+        return None
+
+    def approach_profile(self, message, arr_t):
+        '''
+        Arrival speed and approach acceleration profile (((timestep, acc), ...) as in DresnerVehicle.plan_arr) that take the requesting
+        vehicle to the stop bar at arr_t: change speed at max_acc or max_dec to a constant speed between inter_v_lim_min and inter_v_lim
+        and drive on at it, or when that is too slow, brake to a stop before the bar, wait, and start again at max_acc.
+        None if neither is possible, or if the start is so close to the bar that the vehicle would cross it below inter_v_lim_min.
+        The profile starts at the current timestep, a request that arrived late (com_latency) is taken to have driven on at its speed since.
+        '''
+        s = self.ctx.settings
+        t0 = self.ctx.simulator.timestep
+        v = message['inst_v']
+        d = - message['inst_x'] - v * (t0 - message['timestep']) * s.veh_dt # Distance to the stop bar
+        acc, dec = message['max_acc'], message['max_dec']
+        tau = (arr_t - t0) * s.veh_dt
+        if tau <= 0 or d < 0:
+            return None
+        # Changing the speed by dv at rate a and driving on at the new speed covers (v + dv) * tau - dv**2 / 2 / a (dv < 0 when braking)
+        speed_up = d >= v * tau
+        a = acc if speed_up else dec
+        disc = (a * tau)**2 - 2 * a * abs(d - v * tau)
+        if disc >= 0:
+            dv = a * tau - math.sqrt(disc)
+            arr_v = v + dv if speed_up else v - dv
+            if s.inter_v_lim_min <= arr_v <= s.inter_v_lim:
+                return arr_v, ((t0, a if speed_up else - a), (t0 + dv / a / s.veh_dt, 0))
+        # Stop and go: brake to a stop, wait, and cover the rest from standstill at max_acc (up to inter_v_lim)
+        stop_time = v / dec
+        d_rest = d - v**2 / 2 / dec
+        if d_rest < 0:
+            return None
+        arr_v = min(math.sqrt(2 * acc * d_rest), s.inter_v_lim)
+        if arr_v < s.inter_v_lim_min:
+            return None
+        acc_time = arr_v / acc
+        go_time = acc_time + (d_rest - arr_v**2 / 2 / acc) / arr_v
+        if tau < stop_time + go_time:
+            return None
+        t_go = arr_t - go_time / s.veh_dt
+        return arr_v, ((t0, - dec), (t0 + stop_time / s.veh_dt, 0), (t_go, acc), (t_go + acc_time / s.veh_dt, 0))
+
+    def trajectory(self, message, ju_shape_end_x, acc):
+        '''
+        Follow the acceleration plan acc through the junction. Returns the (t, x_1d, v) of every timestep spent on the track,
+        and the speed and time at which the vehicle leaves it.
+        '''
+        veh_dt = self.ctx.settings.veh_dt
         t = message['arr_t'] #Currtent time
         v = message['arr_v'] #Current speed
         x_1d = 0 # One dimensional positon along junciton path
         a_idx = 0 # Acceleration index
-        seg_idx = 0 # Segment index
-
+        samples = []
         while x_1d <= ju_shape_end_x[-1]:
-            # Calculate the vehicle xy coordinates and direction
-            seg = ju_track[seg_idx]
-            if seg_idx > 0:
-                seg_x = x_1d - ju_shape_end_x[seg_idx - 1]  
-            else:
-                seg_x = x_1d
-            if seg[0] == 'line': # is a straight line
-                if abs(seg[1][0] - seg[2][0]) < 1e-5: # vertical bar
-                    x = seg[1][0]
-                    if seg[1][1] < seg[2][1]: # from top to bottom
-                        y = seg[1][1] + seg_x
-                        angle = 180 # angle is the number of degrees of clockwise rotation compared to "head to north"
-                    else: # from bottom to top
-                        y = seg[1][1] - seg_x
-                        angle = 0
-                else: # Horizontal line
-                    y = seg[1][1]
-                    if seg[1][0] < seg[2][0]: # from left to right
-                        x = seg[1][0] + seg_x
-                        angle = 90 
-                    else: # from right to left
-                        x = seg[1][0] - seg_x
-                        angle = 270
-            else:  # circular curve
-                if seg[5][0] < seg[5][1]: # Trajectory counterclockwise
-                    rotation = seg[5][0] + seg_x / seg[4] * 180 / math.pi
-                    angle = 180 - rotation
-                    x = seg[3][0] + seg[4] * math.cos(-rotation / 180 * math.pi)
-                    y = seg[3][1] + seg[4] * math.sin(-rotation / 180 * math.pi)
-                else:
-                    rotation = seg[5][0] - seg_x / seg[4] * 180 / math.pi
-                    angle = - rotation
-                    x = seg[3][0] + seg[4] * math.cos(-rotation / 180 * math.pi)
-                    y = seg[3][1] + seg[4] * math.sin(-rotation / 180 * math.pi)
-            
-            # Calculate the xy coordinates of the vehicle's dots in the logical coordinate system (first rotate, then place in xy)
-            veh_dots_x, veh_dots_y = self.gen_veh_dots(message['veh_wid'], message['veh_len'], message['veh_len_front'], \
-                0.4, v * 0.1)
-            veh_dots_x_rt = veh_dots_x * math.cos(angle*math.pi/180) - veh_dots_y * math.sin(angle*math.pi/180)
-            veh_dots_y_rt = veh_dots_y * math.cos(angle*math.pi/180) + veh_dots_x * math.sin(angle*math.pi/180)
-            veh_dots_x_rt += x
-            veh_dots_y_rt += y
-            
-            #Use grid.xy_to_ij to convert into the cell occupied by the vehicle at this time
-            i, j = self.res_grid.xy_to_ij(veh_dots_x_rt, veh_dots_y_rt)
-            t_slice = np.ones(i.shape, dtype=np.int16) * (round(t-self.res_grid.t_start))
-            while t_slice[0] >= self.res_grid.cells.shape[2]:
-                self.res_grid.add_time_dimension()
-            
-            # Check whether all occupied grid points are empty
-            if np.sum(self.res_grid.cells[i, j, t_slice] != -1) == 0:
-                self.res_grid.cells[i, j, t_slice] = message['veh_id']
-            else:
-                # Planning failed, return False after clearing traces
-                self.res_grid.clear_veh_cell(message['veh_id'])
-                return False
-
-            # Update position, velocity, acceleration, and shape
+            samples.append((t, x_1d, v))
+            # Update position, velocity and acceleration
             x_1d += v * veh_dt + acc[a_idx][1] / 2 * veh_dt ** 2
             v += acc[a_idx][1] * veh_dt
             t += 1
             if a_idx+1 < len(acc) and t >= acc[a_idx+1][0]:
                 a_idx += 1
-            if x_1d > ju_shape_end_x[seg_idx]:
-                seg_idx += 1 # If it is the last shape, it will exit the loop, it’s okay
+        return samples, v, t
 
-        occ_dura = max((v-inter_v_lim_min)/message['max_dec'] + message['veh_len']/v, min_gen_ht)
-        occ_start = math.floor(t - (occ_dura / veh_dt))
+    def check_ex_lane(self, message, ex_arm, ex_lane, v, t):
+        '''The [veh_id, occ_start, occ_end] record the vehicle would add to its exit lane, or None if it overlaps one already there'''
+        s = self.ctx.settings
+        occ_dura = max((v-s.inter_v_lim_min)/message['max_dec'] + message['veh_len']/v, s.min_gen_ht)
+        occ_start = math.floor(t - (occ_dura / s.veh_dt))
         occ_end = math.ceil(t)
-        for record in self.res_grid.ex_lane_record[ex_arm + str(ex_lane)]:
-            if not (record[1] > occ_end or record[2] < occ_start):
+        if self.res_grid.ex_lane_record[ex_arm + str(ex_lane)].overlaps(occ_start, occ_end):
+            return None
+        return [message['veh_id'], occ_start, occ_end]
+
+    def check_cells_stepwise(self, message, track_key, ju_shape_end_x, ex_arm, ex_lane, acc):
+        samples, v, t = self.trajectory(message, ju_shape_end_x, acc)
+        for (t, x_1d, v_step) in samples:
+            # Cells occupied by the vehicle at this position and speed (computed once per bucket, see FootprintCache)
+            i, j = self.footprints.get(track_key, x_1d, v_step, message['veh_wid'], message['veh_len'], message['veh_len_front'])
+            t_idx = self.res_grid.time_index(t)
+            
+            # Check whether all occupied grid points are empty
+            if self.res_grid.is_free(i, j, t_idx):
+                self.res_grid.reserve(message['veh_id'], i, j, t_idx)
+            else:
+                # Planning failed, return False after clearing traces
                 self.res_grid.clear_veh_cell(message['veh_id'])
                 return False
 
-        self.res_grid.ex_lane_record[ex_arm + str(ex_lane)].append([message['veh_id'], occ_start, occ_end])
+        record = self.check_ex_lane(message, ex_arm, ex_lane, v, t)
+        if record is None:
+            self.res_grid.clear_veh_cell(message['veh_id'])
+            return False
+        self.res_grid.ex_lane_record[ex_arm + str(ex_lane)].append(record)
+        return True
+
+    def check_cells_batched(self, message, track_key, ju_shape_end_x, ex_arm, ex_lane, acc):
+        '''
+        Same test as check_cells_stepwise, but the (i, j, t) cells of the whole trajectory are gathered into one array,
+        tested against the grid in a single lookup and only written when the request succeeds, so a rejection leaves nothing to undo.
+        '''
+        samples, v, t = self.trajectory(message, ju_shape_end_x, acc)
+        record = self.check_ex_lane(message, ex_arm, ex_lane, v, t)
+        if record is None:
+            return False
+
+        if samples:
+            i_list, j_list, t_list, n_list = [], [], [], []
+            for (t_step, x_1d, v_step) in samples:
+                i, j = self.footprints.get(track_key, x_1d, v_step, message['veh_wid'], message['veh_len'], message['veh_len_front'])
+                i_list.append(i)
+                j_list.append(j)
+                t_list.append(self.res_grid.time_index(t_step))
+                n_list.append(len(i))
+            i = np.concatenate(i_list)
+            j = np.concatenate(j_list)
+            t_idx = np.repeat(np.array(t_list, dtype=np.int32), n_list)
+            if not self.res_grid.is_free(i, j, t_idx):
+                return False
+            self.res_grid.reserve(message['veh_id'], i, j, t_idx)
+
+        self.res_grid.ex_lane_record[ex_arm + str(ex_lane)].append(record)
         return True
     
+class Reservation:
+    '''
+    A reservation granted by DresnerManager.check_request, sent to the vehicle in the confirm or counter-offer message:
+    the exit lane, arrival timestep and speed, the acceleration profile through the junction (((timestep, acc), ...)), the exit time,
+    and for a counter-offer the approach profile to the stop bar (ap_acc, set by earliest_slot)
+    '''
+    __slots__ = ('res_id', 'ex_lane', 'arr_t', 'arr_v', 'acc', 'exit_time', 'ap_acc')
+
+    def __init__(self, res_id, ex_lane, arr_t, arr_v, acc, exit_time, ap_acc=None):
+        self.res_id = res_id
+        self.ex_lane = ex_lane
+        self.arr_t = arr_t
+        self.arr_v = arr_v
+        self.acc = acc
+        self.exit_time = exit_time
+        self.ap_acc = ap_acc
+
+class FootprintCache:
+    '''
+    Grid cells swept by a vehicle on a junction track, keyed by (track key, arc-length bucket, speed bucket, vehicle dims).
+    The pose along the track and the time buffer of gen_veh_dots only depend on those, so each footprint is rasterised once
+    (lazily, or up front with warm_up) and a reservation request only looks up the unique (i, j) arrays.
+    The arc length is rounded to the nearest footprint_ds and the speed is rounded up to footprint_dv, so the time buffer never shrinks.
+    With settings.footprint_cache = False every footprint is computed exactly and nothing is stored.
+    '''
+    def __init__(self, ctx, grid, gen_veh_dots):
+        self.ctx = ctx
+        self.grid = grid
+        self.gen_veh_dots = gen_veh_dots
+        s = ctx.settings
+        self.enabled = s.footprint_cache
+        self.ds = s.footprint_ds
+        self.dv = s.footprint_dv
+        self.max_size = s.footprint_cache_size
+        self.tracks = {} # track key: (ju_track, ju_shape_end_x)
+        self.footprints = {}
+
+    def get_track(self, track_key):
+        track = self.tracks.get(track_key)
+        if track is None:
+            track = self.tracks[track_key] = (self.ctx.map.ju_track_table[track_key], self.ctx.map.ju_shape_end_x_table[track_key])
+        return track
+
+    def get(self, track_key, x_1d, v, veh_wid, veh_len, veh_len_front):
+        '''The (i, j) arrays of the cells covered at arc length x_1d on the track, driving at speed v'''
+        if not self.enabled:
+            return self.build(track_key, x_1d, v, veh_wid, veh_len, veh_len_front)
+        s_idx = int(round(x_1d / self.ds))
+        v_idx = math.ceil(v / self.dv - 1e-9)
+        key = (track_key, s_idx, v_idx, veh_wid, veh_len, veh_len_front)
+        footprint = self.footprints.get(key)
+        if footprint is None:
+            if len(self.footprints) >= self.max_size:
+                self.footprints.clear()
+            footprint = self.footprints[key] = self.build(track_key, s_idx * self.ds, v_idx * self.dv, veh_wid, veh_len, veh_len_front)
+        return footprint
+
+    def build(self, track_key, x_1d, v, veh_wid, veh_len, veh_len_front):
+        x, y, angle = self.ctx.map.pose_at(track_key, x_1d)
+
+        # Calculate the xy coordinates of the vehicle's dots in the logical coordinate system (first rotate, then place in xy)
+        veh_dots_x, veh_dots_y = self.gen_veh_dots(veh_wid, veh_len, veh_len_front, 0.4, v * 0.1)
+        veh_dots_x_rt = veh_dots_x * math.cos(angle*math.pi/180) - veh_dots_y * math.sin(angle*math.pi/180)
+        veh_dots_y_rt = veh_dots_y * math.cos(angle*math.pi/180) + veh_dots_x * math.sin(angle*math.pi/180)
+        veh_dots_x_rt += x
+        veh_dots_y_rt += y
+
+        # Many dots fall into the same cell, keep each cell once
+        i, j = self.grid.xy_to_ij(veh_dots_x_rt, veh_dots_y_rt)
+        cells = np.unique(i.astype(np.int32) * self.grid.j_n + j)
+        return (cells // self.grid.j_n).astype(np.int16), (cells % self.grid.j_n).astype(np.int16)
+
+    def warm_up(self, speeds, veh_wid, veh_len, veh_len_front, track_keys=None):
+        '''Build the footprints of every arc-length bucket of the tracks (all of Map.ju_track_table by default) at the given speeds'''
+        for track_key in track_keys or self.ctx.map.ju_track_table:
+            ju_shape_end_x = self.get_track(track_key)[1]
+            for s_idx in range(int(round(ju_shape_end_x[-1] / self.ds)) + 2):
+                for v in speeds:
+                    self.get(track_key, s_idx * self.ds, v, veh_wid, veh_len, veh_len_front)
+
 class DresnerResGrid:
-    '''a grid representation of intersection area'''
-    def __init__(self, cell_size):
-        self.lw = lane_width
-        self.tr = turn_radius
-        self.al = arm_len
-        self.NSl = NS_lane_count
-        self.EWl = EW_lane_count
+    '''
+    a grid representation of intersection area, with a time axis for reservations.
+    The time axis is a ring buffer: absolute timestep t lives in slice t % horizon, and each cell also stores the timestep it was
+    written for (stamps), so cells left over from the past never count as occupied and need no clearing when time moves on.
+    Which cells each vehicle holds is indexed, so that clearing a vehicle only touches its own cells.
+    '''
+    def __init__(self, ctx, cell_size, horizon=None):
+        s = ctx.settings
+        self.lw = s.lane_width
+        self.tr = s.turn_radius
+        self.al = s.arm_len
+        self.NSl = s.NS_lane_count
+        self.EWl = s.EW_lane_count
+        self.veh_dt = s.veh_dt
         # Half the intersection width and height, in m, that is (x2, y2)
         self.wid_m_half = self.lw * self.NSl + self.tr
         self.hgt_m_half = self.lw * self.EWl + self.tr
@@ -452,13 +592,21 @@ class DresnerResGrid:
         self.i_n = math.ceil(self.hgt_m_half * 2 / cell_size) # Number of rows
         self.j_n = math.ceil(self.wid_m_half * 2 / cell_size) #Number of columns
 
-        self.t_start = 0 # The timestep corresponding to the third dimension t=0
+        self.t_start = 0 # The earliest timestep that can still be reserved, everything before it has passed
 
-        self.cells = - np.ones(shape=(self.i_n, self.j_n, int(20/veh_dt)), dtype=np.int16)
+        # Number of timesteps the ring buffer can hold ahead of t_start, doubled whenever a reservation reaches further
+        self.horizon = horizon or int(20/self.veh_dt)
+        self.cells = - np.ones(shape=(self.i_n, self.j_n, self.horizon), dtype=np.int32) # veh_id, -1 is free
+        self.stamps = - np.ones(shape=(self.i_n, self.j_n, self.horizon), dtype=np.int32) # the timestep a cell was written for
+        self.veh_cells = {} # veh_id: [(i, j, t), ...] arrays of the cells it holds
+        self.veh_t_end = {} # veh_id: the last timestep it holds cells at, to forget vehicles whose reservation has passed
         self.ex_lane_record = self.init_ex_lane_record() # This is to avoid collision at the exit lane. No car can arrive within a certain period of time before each car arrives.
 
     def reset_grid(self):
-        self.cells = - np.ones(shape=(self.i_n, self.j_n, int(20/veh_dt)), dtype=np.int16)
+        self.cells.fill(-1)
+        self.stamps.fill(-1)
+        self.veh_cells.clear()
+        self.veh_t_end.clear()
 
     def xy_to_ij(self, x_arr, y_arr):
         '''
@@ -480,36 +628,129 @@ class DresnerResGrid:
 
     def init_ex_lane_record(self):
         ex_lane_record = {}
-        for i in range(NS_lane_count):
-            ex_lane_record['N' + str(i)] = [] # Each element is [veh_id, occ_start, occ_end]
-            ex_lane_record['S' + str(i)] = []
-        for i in range(EW_lane_count):
-            ex_lane_record['E' + str(i)] = []
-            ex_lane_record['W' + str(i)] = []
+        for i in range(self.NSl):
+            ex_lane_record['N' + str(i)] = ExLaneRecord()
+            ex_lane_record['S' + str(i)] = ExLaneRecord()
+        for i in range(self.EWl):
+            ex_lane_record['E' + str(i)] = ExLaneRecord()
+            ex_lane_record['W' + str(i)] = ExLaneRecord()
         return ex_lane_record
     
+    def time_index(self, t):
+        '''The (integer) timestep a planned time t is booked at'''
+        return self.t_start + round(t - self.t_start)
+
+    def is_free(self, i, j, t):
+        '''Whether none of the cells (i[k], j[k]) is reserved at timestep t[k]. t may also be a single timestep'''
+        t_max = t if np.ndim(t) == 0 else t.max(initial=self.t_start)
+        if t_max - self.t_start >= self.horizon:
+            self.add_time_dimension(t_max)
+        return not (self.stamps[i, j, t % self.horizon] == t).any()
+
+    def reserve(self, veh_id, i, j, t):
+        '''Book the cells (i[k], j[k]) at timestep t[k] for veh_id. t may also be a single timestep'''
+        if np.ndim(t) == 0:
+            t = np.full(np.shape(i), t, dtype=np.int32)
+        if t.size == 0:
+            return
+        t_max = int(t.max())
+        if t_max - self.t_start >= self.horizon:
+            self.add_time_dimension(t_max)
+        k = t % self.horizon
+        self.cells[i, j, k] = veh_id
+        self.stamps[i, j, k] = t
+        if veh_id in self.veh_cells:
+            self.veh_cells[veh_id].append((i, j, t))
+            self.veh_t_end[veh_id] = max(self.veh_t_end[veh_id], t_max)
+        else:
+            self.veh_cells[veh_id] = [(i, j, t)]
+            self.veh_t_end[veh_id] = t_max
+
     def clear_veh_cell(self, veh_id):
         '''Clear all grids occupied by a certain vehicle veh_id'''
-        self.cells[self.cells == veh_id] = -1
+        records = self.veh_cells.pop(veh_id, None)
+        self.veh_t_end.pop(veh_id, None)
+        if not records:
+            return
+        i = np.concatenate([r[0] for r in records])
+        j = np.concatenate([r[1] for r in records])
+        t = np.concatenate([r[2] for r in records])
+        k = t % self.horizon
+        mine = (self.cells[i, j, k] == veh_id) & (self.stamps[i, j, k] == t)
+        self.cells[i[mine], j[mine], k[mine]] = -1
+        self.stamps[i[mine], j[mine], k[mine]] = -1
 
-    def add_time_dimension(self):
-        '''When the third dimension t is not enough, just double the size'''
-        self.cells = np.concatenate((self.cells, -np.ones(self.cells.shape, dtype=np.int16)), axis=2)
+    def add_time_dimension(self, t_max=None):
+        '''When the ring buffer cannot reach timestep t_max, double its size (as often as needed), keeping every slice at its timestep'''
+        new_horizon = self.horizon * 2
+        while t_max is not None and t_max - self.t_start >= new_horizon:
+            new_horizon *= 2
+        old_k = np.arange(self.horizon)
+        new_k = (self.t_start + (old_k - self.t_start) % self.horizon) % new_horizon # the slice each timestep moves to
+        cells = - np.ones(shape=(self.i_n, self.j_n, new_horizon), dtype=np.int32)
+        stamps = - np.ones(shape=(self.i_n, self.j_n, new_horizon), dtype=np.int32)
+        cells[:, :, new_k] = self.cells[:, :, old_k]
+        stamps[:, :, new_k] = self.stamps[:, :, old_k]
+        self.cells, self.stamps, self.horizon = cells, stamps, new_horizon
     
     def dispose_passed_time(self, timestep):
-        '''Clear all information from the past time (you can't go back in time anyway)'''
-        if timestep - self.t_start > 20 and self.cells.shape[2] > (timestep - self.t_start) + 1: # If there is no latter condition, sometimes the third dimension of cells will be empty and there will be an infinite loop.
-            self.cells = self.cells[:, :, (timestep - self.t_start):]
-            self.t_start = timestep
-        for key, value in self.ex_lane_record.items():
-            for record in value:
-                if record[2] < timestep:
-                    value.remove(record) # Delete the time-lapsed information in the exit channel
+        '''Forget all information from the past time (you can't go back in time anyway). Passed slices are reused without clearing'''
+        self.t_start = max(self.t_start, timestep)
+        for veh_id in [veh_id for veh_id, t_end in self.veh_t_end.items() if t_end < timestep]:
+            # Its whole reservation has passed, the stamps already mark its cells as free
+            self.veh_cells.pop(veh_id)
+            self.veh_t_end.pop(veh_id)
+        for record in self.ex_lane_record.values():
+            record.dispose_before(timestep) # Delete the time-lapsed information in the exit channel
 
-class XuManager(BaseInterManager):
+class ExLaneRecord:
+    '''
+    The [veh_id, occ_start, occ_end] occupancy records of one exit lane. A record is only added when it overlaps none of the others,
+    so sorted by occ_start they are also sorted by occ_end, and overlap queries and expiry are binary searches.
+    '''
     def __init__(self):
-        super().__init__()
+        self.starts = []
+        self.ends = []
+        self.veh_ids = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for record in zip(self.veh_ids, self.starts, self.ends):
+            yield list(record)
+
+    def overlaps(self, occ_start, occ_end):
+        '''Whether a record overlaps occ_start .. occ_end (sharing an end timestep counts)'''
+        k = bisect.bisect_left(self.ends, occ_start) # The first record that does not end before occ_start
+        return k < len(self.ends) and self.starts[k] <= occ_end
+
+    def append(self, record):
+        veh_id, occ_start, occ_end = record
+        if self.overlaps(occ_start, occ_end):
+            raise ValueError('Exit lane record %s overlaps an existing one' % str(record))
+        k = bisect.bisect_left(self.starts, occ_start)
+        self.starts.insert(k, occ_start)
+        self.ends.insert(k, occ_end)
+        self.veh_ids.insert(k, veh_id)
+
+    def dispose_before(self, timestep):
+        '''Forget the records that end before timestep'''
+        k = bisect.bisect_left(self.ends, timestep)
+        if k:
+            del self.starts[:k], self.ends[:k], self.veh_ids[:k]
+
+class XuManager(BaseInterManager):
+    def __init__(self, ctx):
+        super().__init__(ctx)
         self.veh_info = [] # The element is (veh, report message)
+        self.conflict_tree = XuConflictTree(ctx.settings.conflict_movements)
+        self.sent_rows = {} # node: (vehicle, its depth, neighbours, their depths, its row of L + Q) of the last coordination message
+        self.topology_count = 0 # Calls of update_topology_incremental
+        self.swap_count = 0 # Places vehicles of the approach order moved up by passing others
+        self.coordination_count = 0 # Coordination messages sent by update_topology_incremental
+        if ctx.settings.com_queued and not ctx.settings.xu_incremental:
+            raise ValueError('xu_incremental = False needs the report replies within the same call, it cannot be used with com_queued')
         
     def receive_V2I(self, sender, message):
         if message['type'] == 'appear':
@@ -517,16 +758,91 @@ class XuManager(BaseInterManager):
         elif message['type'] == 'report':
             self.veh_info.append((sender, message))
 
+    def is_conflict(self, ap_arm_dir_1, ap_arm_dir_2):
+        return ap_arm_dir_1 in self.ctx.settings.conflict_movements[ap_arm_dir_2]
+
     @staticmethod
-    def is_conflict(ap_arm_dir_1, ap_arm_dir_2):
-        return ap_arm_dir_1 in conflict_movements[ap_arm_dir_2]
+    def approach_key(inst_x, ap_arm, ap_lane, veh_id):
+        '''Sort key of the approach order: x from large to small, vehicles at the same x by arm, lane and id'''
+        return -inst_x, ap_arm, ap_lane, veh_id
 
     def update_topology(self):
+        if self.ctx.settings.xu_incremental:
+            self.update_topology_incremental()
+        else:
+            self.update_topology_full()
+
+    def update_topology_incremental(self):
+        '''
+        Same coordination as update_topology_full, from the vehicles' own state and XuConflictTree instead of report messages and networkx.
+        The tree's nodes keep the approach order (the vehicles that would report, by x from large to small) instead of sorting it:
+        the vehicles that left the approach zone are removed, the new ones at the back of the approach lanes are added, and one pass
+        of insertion sort (by approach_key, as the full sort) moves the few vehicles that passed others (of other arms), the tree takes
+        the new order in one go.
+        Only the nodes whose row of L + Q changed get a coordination message. The virtual lead vehicle, which moved on, is the same
+        for all of them and goes out in one broadcast.
+        '''
+        s = self.ctx.settings
+        sim = self.ctx.simulator
+        tree = self.conflict_tree
+        self.topology_count += 1
+        departed = [node for node in tree.nodes if not (tree.vehs[node].zone == 'ap' and tree.vehs[node].inst_x < 0)]
+        tree.remove(departed)
+        for node in departed:
+            self.sent_rows.pop(node, None)
+        # New vehicles join their lane at the back
+        for group in sim.all_veh:
+            if group[-2:] != 'ap':
+                continue
+            for key in reversed(sim.group_queue_keys[group]):
+                for veh in sim.lane_queues[key]:
+                    if veh._id in tree.node_of:
+                        break
+                    if veh.inst_x < 0:
+                        tree.add(veh, veh.track.ap_arm + veh.track.turn_dir)
+        nodes = tree.nodes
+        if not nodes:
+            return
+        vehs = [tree.vehs[node] for node in nodes]
+        keys = [self.approach_key(veh.inst_x, veh.track.ap_arm, veh.track.ap_lane, veh._id) for veh in vehs]
+        for i in range(1, len(vehs)):
+            key = keys[i]
+            k = i
+            while k > 0 and keys[k - 1] > key:
+                k -= 1
+            if k < i:
+                vehs.insert(k, vehs.pop(i))
+                keys.insert(k, keys.pop(i))
+                self.swap_count += i - k
+        tree.reorder(vehs)
+
+        virtual_lead_x = tree.vehs[nodes[0]].inst_x + s.desired_cf_distance
+        self.ctx.com.I_broadcast({'type': 'virtual lead', 'virtual_lead_x': virtual_lead_x, 'virtual_lead_v': s.virtual_lead_v})
+        for node in tree.take_touched():
+            neighbor_nodes, l_q_list = tree.row(node)
+            row = (tree.vehs[node], tree.depth[node], [tree.vehs[n] for n in neighbor_nodes], [tree.depth[n] for n in neighbor_nodes], list(l_q_list))
+            if self.sent_rows.get(node) == row:
+                continue
+            self.sent_rows[node] = row
+            message = {
+                'type': 'coordination',
+                'self_depth': row[1], 
+                'virtual_lead_x': virtual_lead_x, 
+                'virtual_lead_v': s.virtual_lead_v, 
+                'neighbor_list': row[2], 
+                'neighbor_depth_list': row[3], 
+                'l_q_list': l_q_list
+            }
+            self.ctx.com.I2V(row[0], message)
+            self.coordination_count += 1
+
+    def update_topology_full(self):
+        desired_cf_distance = self.ctx.settings.desired_cf_distance
         # Collect vehicle location information
         self.veh_info.clear()
-        ComSystem.I_broadcast({'type': 'request report'})
+        self.ctx.com.I_broadcast({'type': 'request report'})
         # Sort by x from large to small
-        self.veh_info.sort(key=lambda e: -e[1]['inst_x'])
+        self.veh_info.sort(key=lambda e: self.approach_key(e[1]['inst_x'], e[1]['ap_arm'], e[1]['ap_lane'], e[1]['veh_id']))
         # Insert virtual head car 0
         virtual_lead_x = self.veh_info[0][1]['inst_x'] + desired_cf_distance
         self.veh_info.insert(0, (None, {
@@ -541,7 +857,7 @@ class XuManager(BaseInterManager):
                 continue
             cf_graph.add_node(i, ap_arm_dir = info[1]['ap_arm'] + info[1]['turn_dir'])
             for j in range(1, i): # car in front j
-                if XuManager.is_conflict(
+                if self.is_conflict(
                     cf_graph.nodes[j]['ap_arm_dir'], 
                     cf_graph.nodes[i]['ap_arm_dir']
                 ):
@@ -610,39 +926,316 @@ class XuManager(BaseInterManager):
                 'type': 'coordination',
                 'self_depth': tree.nodes[i]['depth'], 
                 'virtual_lead_x': virtual_lead_x, 
-                'virtual_lead_v': virtual_lead_v, 
+                'virtual_lead_v': self.ctx.settings.virtual_lead_v, 
                 'neighbor_list': neighbor_list, 
+                'neighbor_depth_list': [tree.nodes[int(n+1)]['depth'] for n in neighbor_index], 
                 'l_q_list': l_q_list
             }
-            ComSystem.I2V(info[0], message)
+            self.ctx.com.I2V(info[0], message)
+
+class XuConflictTree:
+    '''
+    Spanning tree of XuManager's conflict graph. Nodes are the positions of the approach order, numbered from front to back, node 0 is
+    the virtual lead vehicle. A vehicle's depth is one more than the deepest vehicle in front of it with a conflicting movement, which
+    is also its parent (the front-most one on a tie). Every movement conflicts with itself, so the last vehicle of a movement in front
+    of a node is the deepest of it, and a vehicle only has to look at one vehicle of each movement in its conflict bitmask, not at
+    every vehicle. A change only makes the nodes behind it that depend on it (dependents) look for their parent again.
+    The communication graph is the tree plus the links between vehicles of the same depth, row gives one row of L + Q, and
+    take_touched the nodes whose row may have changed.
+    '''
+    def __init__(self, conflict_movements):
+        self.movements = sorted(conflict_movements)
+        self.movement_index = {movement: i for (i, movement) in enumerate(self.movements)}
+        # conflict_mask[i] has bit j set when movement j is in the conflict list of movement i
+        self.conflict_mask = [sum(1 << self.movement_index[other] for other in set(conflict_movements[movement])) for movement in self.movements]
+        # conflicted_by[j] are the movements i that have movement j in their conflict list
+        self.conflicted_by = [[i for (i, mask) in enumerate(self.conflict_mask) if mask >> j & 1] for j in range(len(self.movements))]
+        self.clear()
+
+    def clear(self):
+        self.nodes = [] # The vehicles' nodes, front to back
+        self.next_node = 1
+        self.node_of = {} # veh._id: node
+        self.vehs = {0: None}
+        self.movement = {}
+        self.depth = {0: 0}
+        self.parent = {0: None}
+        self.children = {0: []}
+        self.same_depth = [[0]] # same_depth[d] is the sorted list of nodes of depth d
+        self.movement_nodes = [[] for _ in self.movements] # movement_nodes[i] is the sorted list of nodes of movement i
+        self.touched = set()
+        self.touched_depths = set()
+
+    def find_parent(self, node):
+        '''The deepest node in front of node with a conflicting movement, the front-most one on a tie, 0 if there is none'''
+        parent = 0
+        mask = self.conflict_mask[self.movement[node]]
+        while mask:
+            j = (mask & - mask).bit_length() - 1
+            mask &= mask - 1
+            nodes = self.movement_nodes[j]
+            k = bisect.bisect_left(nodes, node)
+            last = nodes[k - 1] if k else 0
+            if last and (self.depth[last] > self.depth[parent] or (self.depth[last] == self.depth[parent] and last < parent)):
+                parent = last
+        return parent
+
+    def dependents(self, node):
+        '''The nodes that node is a candidate parent of: those of a conflicting movement behind it, up to the next node of its own movement'''
+        i = self.movement[node]
+        own = self.movement_nodes[i]
+        k = bisect.bisect_right(own, node)
+        end = own[k] if k < len(own) else None
+        dependents = []
+        for j in self.conflicted_by[i]:
+            nodes = self.movement_nodes[j]
+            start = bisect.bisect_right(nodes, node)
+            stop = bisect.bisect_right(nodes, end, start) if end is not None else len(nodes)
+            if start < stop:
+                dependents.extend(nodes[start:stop])
+        return dependents
+
+    def touch(self, node):
+        '''Mark node and its neighbours in the communication graph, the rows that mention it. Its level is expanded in take_touched'''
+        self.touched.add(node)
+        self.touched.update(self.children[node])
+        self.touched.add(self.parent[node])
+        self.touched_depths.add(self.depth[node])
+
+    def take_touched(self):
+        '''The nodes in the tree whose row may have changed since the last call, front to back'''
+        touched = self.touched
+        for depth in self.touched_depths:
+            if depth < len(self.same_depth):
+                touched.update(self.same_depth[depth])
+        self.touched = set()
+        self.touched_depths = set()
+        return sorted(node for node in touched if node and node in self.vehs)
 
-# Choose an implementation based on your settings
-if inter_control_mode == 'traffic light':
-    inter_manager = TrafficLightManager()
-elif inter_control_mode == 'Dresner':
-    inter_manager = DresnerManager()
-elif inter_control_mode == 'Xu':
-    inter_manager = XuManager()
+    def link(self, node, parent):
+        self.parent[node] = parent
+        self.depth[node] = depth = self.depth[parent] + 1
+        bisect.insort(self.children[parent], node)
+        if depth == len(self.same_depth):
+            self.same_depth.append([])
+        bisect.insort(self.same_depth[depth], node)
+        self.touch(node)
 
-# This isn't the best idea, but let's do this for now
-import simulator
+    def unlink(self, node):
+        self.touch(node)
+        if self.parent[node] in self.children: # Not when its parent was removed before it
+            self.children[self.parent[node]].remove(node)
+        self.same_depth[self.depth[node]].remove(node)
+
+    def update_parents(self, dirty):
+        '''
+        Let the dirty nodes look for their parent again, front to back. When a node gets deeper its dependents look as well, when it
+        gets less deep only its children (a candidate that was not chosen stays so)
+        '''
+        pending = set(dirty)
+        dirty = sorted(pending)
+        while dirty:
+            node = heapq.heappop(dirty)
+            if node not in self.vehs:
+                continue
+            parent = self.find_parent(node)
+            depth = self.depth[node]
+            if parent == self.parent[node] and self.depth[parent] + 1 == depth:
+                continue
+            self.unlink(node)
+            self.link(node, parent)
+            if self.depth[node] != depth:
+                for other in (self.dependents(node) if self.depth[node] > depth else self.children[node]):
+                    if other not in pending:
+                        pending.add(other)
+                        heapq.heappush(dirty, other)
+
+    def add(self, veh, movement):
+        '''Add a vehicle behind all the others, returns its node'''
+        node = self.next_node
+        self.next_node += 1
+        i = self.movement_index[movement]
+        self.nodes.append(node)
+        self.node_of[veh._id] = node
+        self.vehs[node] = veh
+        self.movement[node] = i
+        self.children[node] = []
+        self.movement_nodes[i].append(node)
+        self.link(node, self.find_parent(node))
+        return node
+
+    def remove(self, nodes):
+        '''
+        Remove the nodes of the vehicles that left the approach zone. Only their children look for their parent again: another node
+        behind keeps its parent, the one it gets instead of a removed candidate is of the same movement and not as deep.
+        '''
+        if not nodes:
+            return
+        dirty = []
+        for node in nodes:
+            self.unlink(node)
+            self.movement_nodes[self.movement[node]].remove(node)
+            dirty.extend(self.children.pop(node))
+            del self.node_of[self.vehs[node]._id]
+            del self.vehs[node], self.movement[node], self.depth[node], self.parent[node]
+        self.nodes = [node for node in self.nodes if node in self.vehs]
+        self.update_parents(dirty)
+
+    def reorder(self, vehs):
+        '''
+        The vehicles passed each other and vehs is their new order, front to back: give the nodes their new vehicles, and let the nodes
+        whose vehicle changed and their dependents before and after look for their parent again
+        '''
+        changed = [node for (node, veh) in zip(self.nodes, vehs) if self.vehs[node] is not veh]
+        if not changed:
+            return
+        dirty = list(changed)
+        movement = {}
+        for node in changed:
+            dirty.extend(self.dependents(node))
+            movement[self.vehs[node]._id] = self.movement[node]
+            self.movement_nodes[self.movement[node]].remove(node)
+        for (node, veh) in zip(self.nodes, vehs):
+            if self.vehs[node] is not veh:
+                self.vehs[node] = veh
+                self.node_of[veh._id] = node
+                self.movement[node] = movement[veh._id]
+                bisect.insort(self.movement_nodes[self.movement[node]], node)
+        for node in changed:
+            dirty.extend(self.dependents(node))
+            self.touch(node)
+        self.update_parents(dirty)
+
+    def row(self, node):
+        '''The node's neighbours in the communication graph (itself included, front to back) and their entries in its row of L + Q'''
+        neighbors = self.same_depth[self.depth[node]] + self.children[node]
+        if self.parent[node]:
+            neighbors.append(self.parent[node])
+        neighbors.sort()
+        l_q_list = - np.ones(len(neighbors))
+        # Degree without the virtual lead vehicle (L), plus 1 when the virtual lead vehicle is a neighbour (Q)
+        l_q_list[neighbors.index(node)] = len(neighbors) - 1 + (self.parent[node] == 0)
+        return neighbors, l_q_list
+
+def make_inter_manager(ctx):
+    '''Choose an implementation based on your settings'''
+    inter_control_mode = ctx.settings.inter_control_mode
+    if inter_control_mode == 'traffic light':
+        return TrafficLightManager(ctx)
+    elif inter_control_mode == 'Dresner':
+        return DresnerManager(ctx)
+    elif inter_control_mode == 'Xu':
+        return XuManager(ctx)
+    raise ValueError('Unknown inter_control_mode: %s' % inter_control_mode)
 
 class ComSystem:
-    @staticmethod
-    def V2V(receiver, sender, message):
-        receiver.receive_V2V(sender, message)
+    '''
+    Message passing between the vehicles and the intersection manager of one simulation context.
+    With com_queued = False every message is a direct method call. With com_queued = True messages go through a queue and
+    Simulator.update calls deliver at the end of every timestep. A message sent in timestep t is delivered at the end of timestep
+    t + latency, unless it is lost, see latency and lost. The V2I messages due together are handed to the manager in one
+    receive_V2I_batch call, and replies sent during delivery with no latency are delivered in the same call.
+    '''
+    links = ('V2V', 'V2I', 'I2V', 'broadcast')
 
-    @staticmethod   
-    def V2I(sender, message):
-        inter_manager.receive_V2I(sender, message)
+    def __init__(self, ctx):
+        self.ctx = ctx
+        s = ctx.settings
+        self.queued = s.com_queued
+        self.latency_table = {link: s.com_latency.get(link, 0) for link in self.links}
+        self.loss_table = {link: s.com_loss.get(link, 0) for link in self.links}
+        # Its own random stream, so that message loss does not change the generated traffic of a seed
+        self.random = random.Random(None if ctx.seed is None else 'com %s' % ctx.seed)
+        self.queue = [] # Heap of (due timestep, sequence number, link, receiver, sender, message)
+        self.sent_count = 0
+        self.lost_count = {link: 0 for link in self.links}
+        # Messages sent, by link and by (link, message type), read by profiler.PhaseProfiler
+        self.message_count = {}
 
-    @staticmethod
-    def I2V(receiver, message):
-        receiver.receive_I2V(message)
+    def count(self, link, message):
+        key = (link, message.get('type'))
+        self.message_count[key] = self.message_count.get(key, 0) + 1
+        key = (link, None)
+        self.message_count[key] = self.message_count.get(key, 0) + 1
 
-    @staticmethod
-    def I_broadcast(message):
-        for group, vehs in simulator.Simulator.getInstance().all_veh.items():
-            for veh in vehs:
-                veh.receive_broadcast(message)
-        
+    def V2V(self, receiver, sender, message):
+        self.count('V2V', message)
+        if self.queued:
+            self.send('V2V', receiver, sender, message)
+        else:
+            receiver.receive_V2V(sender, message)
+
+    def V2I(self, sender, message):
+        self.count('V2I', message)
+        if self.queued:
+            self.send('V2I', None, sender, message)
+        else:
+            self.ctx.inter_manager.receive_V2I(sender, message)
+
+    def I2V(self, receiver, message):
+        self.count('I2V', message)
+        if self.queued:
+            self.send('I2V', receiver, None, message)
+        else:
+            receiver.receive_I2V(message)
+
+    def I_broadcast(self, message):
+        self.count('broadcast', message)
+        if self.queued:
+            # The receivers are the vehicles in the area when the broadcast arrives
+            self.send('broadcast', None, None, message)
+        else:
+            for group, vehs in self.ctx.simulator.all_veh.items():
+                for veh in vehs:
+                    veh.receive_broadcast(message)
+
+    def latency(self, link, receiver, sender):
+        '''
+        Delivery delay of a message in timesteps, from com_latency[link]: an int, or a (min, max) pair for a delay drawn uniformly
+        from min .. max for each message
+        '''
+        latency = self.latency_table[link]
+        if isinstance(latency, (tuple, list)):
+            return self.random.randint(*latency)
+        return latency
+
+    def lost(self, link, receiver, sender):
+        '''Whether a message is lost, with probability com_loss[link] (a broadcast may be lost for each receiver separately)'''
+        loss = self.loss_table[link]
+        if loss and self.random.random() < loss:
+            self.lost_count[link] += 1
+            return True
+        return False
+
+    def send(self, link, receiver, sender, message):
+        if link != 'broadcast' and self.lost(link, receiver, sender):
+            return
+        due = self.ctx.simulator.timestep + self.latency(link, receiver, sender)
+        heapq.heappush(self.queue, (due, self.sent_count, link, receiver, sender, message))
+        self.sent_count += 1
+
+    def deliver(self, timestep):
+        '''Deliver every queued message that is due by timestep, in the order they were sent'''
+        while self.queue and self.queue[0][0] <= timestep:
+            due_messages = []
+            while self.queue and self.queue[0][0] <= timestep:
+                due_messages.append(heapq.heappop(self.queue))
+            V2I_batch = []
+            for (due, seq, link, receiver, sender, message) in due_messages:
+                if link == 'V2I':
+                    V2I_batch.append((sender, message))
+                    continue
+                if V2I_batch:
+                    self.ctx.inter_manager.receive_V2I_batch(V2I_batch)
+                    V2I_batch = []
+                if link == 'I2V':
+                    receiver.receive_I2V(message)
+                elif link == 'V2V':
+                    receiver.receive_V2V(sender, message)
+                else:
+                    for group, vehs in self.ctx.simulator.all_veh.items():
+                        for veh in list(vehs):
+                            if not self.lost(link, veh, None):
+                                veh.receive_broadcast(message)
+            if V2I_batch:
+                self.ctx.inter_manager.receive_V2I_batch(V2I_batch)
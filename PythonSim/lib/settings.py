@@ -3,13 +3,24 @@ veh_dt = 0.1
 disp_dt = 0.04
 simu_t = 600 # simulation time = 10 min
 time_wrap = 4
+# Who steps the simulation of the GUI: 'thread' or 'process' (a forked worker, needs os.fork) steps it at time_wrap times real time
+# and publishes snapshots that the canvas draws the latest of (snapshot.py), 'timer' steps it on the GUI thread between paints
+gui_runner = 'thread'
+# replay.py reads the trajectory rows of a binary log this many timesteps at a time around the one shown
+replay_window = 600
 
 ########################## Simulation Crash Params##################### #####
 crashValues={"crashOccured": False}
+# The faulty vehicle is drawn uniformly from this range of generated vehicle counts (inclusive). None disables fault injection
+fault_veh_range = (25, 35)
+# Where in its reservation window (0 = arrival, 1 = exit) the faulty vehicle stops, None draws it uniformly
+fault_time_frac = None
 ########################## Scene parameter settings##################### #####
 lane_width = 3.5
 turn_radius = 6 # The American Urban Street Design Guidelines require that the corner radius of general urban road intersections should be 3~4.5m
 arm_len = 100
+track_lookup = True # Poses along the junction tracks are interpolated in tables sampled when the map is built (Map.pose_at), False evaluates the line and arc segments exactly
+track_ds = 0.05 # Arc-length spacing of those tables, unit: m
 NS_lane_count = 3
 EW_lane_count = 3
 arm_v_lim = 16.66 # 60 km/h
@@ -53,6 +64,16 @@ veh_gen_rule_table = {
     'Wt': [0    , 0    , 0    ], 
     'Wr': [0    , 0    , 0    ],
 }
+# How arrivals are drawn from veh_gen_rule_table (demand.py): 'bernoulli' ahead in chunks of demand_chunk timesteps (the same arrivals
+# as 'per_tick', which draws every timestep in Simulator.gen_new_veh), 'poisson' exponential gaps in continuous time
+demand = 'bernoulli'
+demand_chunk = 1000
+# Replay the arrivals saved by DemandSchedule.save instead, None draws them
+demand_file = None
+# Set per intersection by network.Network: approach arms whose vehicles come from the upstream intersection (instead of the demand,
+# their turns are drawn with the weights of veh_gen_rule_table) and exit arms whose vehicles are handed off downstream, e.g. 'WE'
+fed_arms = ''
+linked_arms = ''
 # The initial speed when the vehicle is generated (the speed of driving on the road segment)
 gen_init_v = cf_param['v0']
 # The shortest distance and time distance between two consecutive vehicles on a lane, unit: meters, seconds
@@ -61,6 +82,13 @@ min_gen_ht = min_gen_hs / gen_init_v
         
 ######################### Intersection control scheme settings################### #######
 inter_control_mode = 'Dresner' # 'traffic light', 'Dresner', 'Xu'
+vehicle_engine = 'object' # 'object': every vehicle updates itself, 'fleet': vehicle state in numpy arrays updated for all vehicles at once (fleet.py)
+net_workers = 1 # Worker processes that step the intersections of a network.Network, each owns a strip of them, 1 steps them all in one process
+profile = False # Record the wall time of each phase of Simulator.update and the messages sent at every timestep (profiler.py), saved next to the log as .profile.csv
+log_format = 'text' # 'text': trajectory lines in the log file (cal_delay.cal_metrics), 'binary': numpy chunks and event streams in a directory (recorder.py), 'none': no log
+# Stop a run once the average delay (metrics.py) changed by less than this fraction over the last metrics_converge_window vehicles, None runs to the end
+metrics_converge_tol = None
+metrics_converge_window = 100
 
 ########################## Simulation parameters of the signal light#################### ######
 phase = [
@@ -86,12 +114,29 @@ yellow_time = 1.5
 
 ########################## Dresner’s simulation parameters#################### ######
 inter_v_lim_min = 4 # The slowest speed through the intersection in the Dresner scheme
+footprint_cache = True # Reuse the cells a vehicle sweeps on a junction track between requests, False computes them exactly every step
+footprint_ds = 0.1 # Arc-length bucket of the footprint cache, unit: m
+footprint_dv = 0.5 # Speed bucket of the footprint cache (rounded up), unit: m/s
+footprint_cache_size = 200000 # The footprint cache is emptied when it holds this many entries
+res_check_batched = True # Test a whole requested trajectory against the reservation grid at once and write it only if it fits, False books and rolls back step by step
+res_counter_offer = True # A request that does not fit is answered with the earliest later arrival that does, False rejects it and the vehicle asks again
+res_search_step = 0.2 # Arrival times tried for a counter-offer are this far apart, unit: s
+res_search_horizon = 10 # and at most this much later than requested, unit: s
+collision_check = 'sat' # After a fault: 'sat' tests the vehicle rectangles against each other (spatial hash + separating axis test), 'grid' rasterises them on a 0.1 m grid
+collision_buffer = 0.4 # Margin around each vehicle rectangle for collision_check = 'sat', unit: m
+
+########################## Communication settings##################### #####
+com_queued = False # Send V2I/I2V/broadcast messages through ComSystem's queue, delivered at the end of each timestep, False calls the receiver directly
+com_latency = {'V2V': 0, 'V2I': 0, 'I2V': 0, 'broadcast': 0} # Delay of each link (com_queued only), unit: timestep, a (min, max) pair draws it per message
+com_loss = {'V2V': 0, 'V2I': 0, 'I2V': 0, 'broadcast': 0} # Probability that a message on each link is lost (com_queued only)
+com_timeout = 1 # A vehicle repeats a request that got no reply after this long, unit: s
 
 ########################## Xu’s simulation parameters#################### ######
 desired_cf_distance = 25 # Take 25 for single lane and 39 for three lanes
 virtual_lead_v = inter_v_lim
 kp = 0.15
 kv = 0.7
+xu_incremental = True # Keep XuManager's conflict tree up to date as vehicles arrive, False rebuilds it with networkx on every arrival
 
 # conflict_movements = {
 # 'Nt': ['Nt', 'Wt', 'Et'],
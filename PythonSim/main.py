@@ -1,26 +1,14 @@
 import sys
-import time
-import logging
-import os
-
 import lib.settings
 
+from headless import configure, init_log
+
 def exec_simulation():
     from PyQt5.QtWidgets import QApplication
     from my_main_window import MyMainWindow
     from cal_delay import cal_metrics
 
-    # Define the log directory and file name
-    log_dir = 'log'
-    log_fname = os.path.join(log_dir, 'log %s.log' % time.strftime("%Y-%m-%d %H-%M-%S"))
-
-    # Check if the log directory exists, and create it if it doesn't
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-
-    log_fname = 'log/log %s.log' % time.strftime("%Y-%m-%d %H-%M-%S")
-    logging.basicConfig(filename=log_fname, format='%(message)s', level=logging.DEBUG)
-    logging.debug('t, veh._id, zone, lane, x, v, a')
+    log_fname = init_log()
     print(log_fname)
 
     app = QApplication(sys.argv)
@@ -38,47 +26,19 @@ def exec_simulation():
 if __name__ == '__main__':
     # Adjustment plan
     mode = sys.argv[1]
-    if mode == 'Dresner':
-        lib.settings.arm_len = 100
-        lib.settings.inter_control_mode = 'Dresner'
-    elif mode == 'Xu':
-        lib.settings.arm_len = 200
-        lib.settings.inter_control_mode = 'Xu'
-    else:
-        lib.settings.arm_len = 100
-        lib.settings.inter_control_mode = 'traffic light'
-
     #Adjust traffic
     total_flow = int(sys.argv[2])
     #    # One lane is straight only
     #t_flow = total_flow / 4
-    # Balance
-    l_flow = total_flow / 16
-    t_flow = total_flow / 8
-    r_flow = total_flow / 16
+    # Balance: turn_split (0.25, 0.5, 0.25) gives l_flow = total_flow / 16, t_flow = total_flow / 8, r_flow = total_flow / 16
+    # See headless.configure. A headless run is: python headless.py <mode> <total_flow>
     # # unbalanced
     # N_flow = total_flow / 9
     # S_flow = total_flow / 9 * 2
     # E_flow = total_flow / 9 * 2
     # W_flow = total_flow / 9 * 4
-
-    lib.settings.veh_gen_rule_table = {
-        # Three lane balance
-        'Nl': [l_flow, 0, 0], 
-        'Nt': [0, t_flow, 0], 
-        'Nr': [0, 0, r_flow], 
-        'Sl': [l_flow, 0, 0], 
-        'St': [0, t_flow, 0], 
-        'Sr': [0, 0, r_flow], 
-        'El': [l_flow, 0, 0], 
-        'Et': [0, t_flow, 0], 
-        'Er': [0, 0, r_flow], 
-        'Wl': [l_flow, 0, 0], 
-        'Wt': [0, t_flow, 0], 
-        'Wr': [0, 0, r_flow]
-    }
+    l_flow, t_flow, r_flow = configure(mode, total_flow, turn_split=(0.25, 0.5, 0.25))
     print('## %d = 4 * (%d + %d + %d)' % (total_flow, l_flow, t_flow, r_flow))
     print(lib.settings.veh_gen_rule_table)
 
     exec_simulation()
-
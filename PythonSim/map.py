@@ -1,29 +1,30 @@
 import math
+import bisect
 
-from lib.settings import lane_width, turn_radius, arm_len, NS_lane_count, EW_lane_count, veh_gen_rule_table
+import numpy as np
 
 class Map:
-    _instance = None
-
     @staticmethod 
     def getInstance():
-        if Map._instance == None:
-            Map()
-        return Map._instance
-
-    def __init__(self):
-        if Map._instance != None:
-            raise Exception("This class is a singleton, but more than one objects are created.")
-        else:
-            Map._instance = self
+        '''Map of the default simulation context'''
+        from context import SimulationContext
+        return SimulationContext.get_default().map
 
-        self.lw = lane_width
-        self.tr = turn_radius
-        self.al = arm_len
-        self.NSl = NS_lane_count
-        self.EWl = EW_lane_count
+    def __init__(self, ctx):
+        self.ctx = ctx
+        s = ctx.settings
+        self.lw = s.lane_width
+        self.tr = s.turn_radius
+        self.al = s.arm_len
+        self.NSl = s.NS_lane_count
+        self.EWl = s.EW_lane_count
 
         self.ju_track_table = self.gen_ju_track_table()
+        # Arc length at the end of each segment of every track, shared by the vehicles on it
+        self.ju_shape_end_x_table = {track_key: tuple(Track.cal_ju_shape_end_x(ju_track)) for (track_key, ju_track) in self.ju_track_table.items()}
+        self.track_lookup = s.track_lookup
+        self.track_ds = s.track_ds
+        self.track_tables = self.compile_tracks()
         self.ex_arm_table = {
             'Nl': 'E', 'Nt': 'S', 'Nr': 'W', 
             'Sl': 'W', 'St': 'N', 'Sr': 'E', 
@@ -37,6 +38,106 @@ class Map:
     def get_ju_track(self, ap_arm, turn_dir, ap_lane, ex_lane):
         return self.ju_track_table[str(ap_arm) + str(turn_dir) + str(ap_lane) + str(ex_lane)]
 
+    def compile_tracks(self):
+        '''A TrackTable of every track of ju_track_table, sampled every track_ds m (or a little less) of arc length'''
+        track_tables = {}
+        for (track_key, ju_track) in self.ju_track_table.items():
+            track_tables[track_key] = TrackTable(ju_track, self.ju_shape_end_x_table[track_key], self.track_ds)
+        return track_tables
+
+    def pose_at(self, track_key, s):
+        '''
+        xy of the front wheel center and heading (degrees clockwise from north) at arc lengths s (a number or an array) along
+        the junction track track_key. Beyond either end the track goes on straight.
+        '''
+        if self.track_lookup:
+            return self.track_tables[track_key].pose_at(s)
+        ju_track = self.ju_track_table[track_key]
+        ju_shape_end_x = self.ju_shape_end_x_table[track_key]
+        if not hasattr(s, '__len__'):
+            return Map.segment_pose(ju_track, ju_shape_end_x, s)
+        poses = np.array([Map.segment_pose(ju_track, ju_shape_end_x, s_k) for s_k in s]).reshape(-1, 3)
+        return poses[:, 0], poses[:, 1], poses[:, 2]
+
+    def veh_poses(self, vehs):
+        '''pose_at of every vehicle in the junction area as (x, y, angle) arrays, one pose_at call per track'''
+        x, y, angle = np.zeros(len(vehs)), np.zeros(len(vehs)), np.zeros(len(vehs))
+        by_track = {}
+        for (k, veh) in enumerate(vehs):
+            by_track.setdefault(veh.track.key, []).append(k)
+        for (track_key, idx) in by_track.items():
+            x[idx], y[idx], angle[idx] = self.pose_at(track_key, np.array([vehs[k].inst_x for k in idx]))
+        return x, y, angle
+
+    def arm_poses(self, group, lane, x):
+        '''
+        The points and headings at which the canvas draws vehicles of an arm group ('Nap', 'Sex', ...) in lanes lane at positions x
+        (arrays), the same as the junction poses: the rectangle reaches veh_len_front ahead of the point
+        '''
+        y2 = self.lw * self.EWl + self.tr
+        x2 = self.lw * self.NSl + self.tr
+        offset = self.lw / 2 + self.lw * lane
+        if group == 'Nap':
+            x, y, angle = - offset, - (y2 - x), 180
+        elif group == 'Nex':
+            x, y, angle = offset, - (y2 + x), 0
+        elif group == 'Sap':
+            x, y, angle = offset, y2 - x, 0
+        elif group == 'Sex':
+            x, y, angle = - offset, y2 + x, 180
+        elif group == 'Wap':
+            x, y, angle = - (x2 - x), offset, 90
+        elif group == 'Wex':
+            x, y, angle = - (x2 + x), - offset, 270
+        elif group == 'Eap':
+            x, y, angle = x2 - x, - offset, 270
+        else:
+            x, y, angle = x2 + x, offset, 90
+        return x, y, np.full(len(lane), angle, dtype=float)
+
+    @staticmethod
+    def segment_pose(ju_track, ju_shape_end_x, x_1d):
+        '''
+        xy of the front wheel center and heading (degrees clockwise from north) at arc length x_1d along a junction track,
+        evaluated on its segment exactly
+        '''
+        seg_idx = min(bisect.bisect_left(ju_shape_end_x, x_1d), len(ju_track) - 1)
+        seg = ju_track[seg_idx]
+        if seg_idx > 0:
+            seg_x = x_1d - ju_shape_end_x[seg_idx - 1]  
+        else:
+            seg_x = x_1d
+        if seg[0] == 'line': # is a straight line
+            if abs(seg[1][0] - seg[2][0]) < 1e-5: # vertical bar
+                x = seg[1][0]
+                if seg[1][1] < seg[2][1]: # from top to bottom
+                    y = seg[1][1] + seg_x
+                    angle = 180 # angle is the number of degrees of clockwise rotation compared to "head to north"
+                else: # from bottom to top
+                    y = seg[1][1] - seg_x
+                    angle = 0
+            else: # Horizontal line
+                y = seg[1][1]
+                if seg[1][0] < seg[2][0]: # from left to right
+                    x = seg[1][0] + seg_x
+                    angle = 90 
+                else: # from right to left
+                    x = seg[1][0] - seg_x
+                    angle = 270
+        else:  # circular curve
+            # rotation is the polar angle of the vehicle around the center, counterclockwise on the screen (y points down)
+            if seg[5][0] < seg[5][1]: # Trajectory counterclockwise, the vehicle heads along the tangent 90 degrees ahead of the radius
+                rotation = seg[5][0] + seg_x / seg[4] * 180 / math.pi
+                angle = - rotation
+                x = seg[3][0] + seg[4] * math.cos(-rotation / 180 * math.pi)
+                y = seg[3][1] + seg[4] * math.sin(-rotation / 180 * math.pi)
+            else:
+                rotation = seg[5][0] - seg_x / seg[4] * 180 / math.pi
+                angle = 180 - rotation
+                x = seg[3][0] + seg[4] * math.cos(-rotation / 180 * math.pi)
+                y = seg[3][1] + seg[4] * math.sin(-rotation / 180 * math.pi)
+        return x, y, angle
+
     def gen_ju_track_table(self):
         '''generate vehicle tracks in junction area.'''
         x1 = self.lw * self.NSl
@@ -76,7 +177,7 @@ class Map:
                 ju_track_table['St'+str(i)+str(j)] = self.gen_ju_track(xa=x_start, ya=y2, xb=x_end, yb=-y2, ap_arm='S', dir='t')
         table_filtered = {}
         for dir, shape_list in ju_track_table.items():
-            if veh_gen_rule_table[dir[0:2]][int(dir[2])] != 0: # Complies with vehicle generation rules
+            if self.ctx.settings.veh_gen_rule_table[dir[0:2]][int(dir[2])] != 0: # Complies with vehicle generation rules
                 table_filtered[dir] = shape_list
 
         # print(table_filtered)
@@ -240,8 +341,53 @@ class Map:
                         ['arc', ((xa+xb)/2, (ya+yb)/2), (xb, yb), (xb, yb - r), r, (270 - alpha, 270)]
                     ]
 
+class TrackTable:
+    '''
+    Poses along a junction track (Map.segment_pose) sampled at evenly spaced arc lengths, so that pose_at only interpolates.
+    The heading is unwrapped (no jump of 360 degrees between samples) to interpolate it linearly as well.
+    '''
+    def __init__(self, ju_track, ju_shape_end_x, ds):
+        self.length = ju_shape_end_x[-1]
+        self.n = max(math.ceil(self.length / ds), 1) # Number of intervals between the samples
+        self.step = self.length / self.n
+        poses = np.array([Map.segment_pose(ju_track, ju_shape_end_x, k * self.step) for k in range(self.n + 1)])
+        self.x, self.y = poses[:, 0], poses[:, 1]
+        self.angle = np.rad2deg(np.unwrap(np.deg2rad(poses[:, 2])))
+        # Single poses are read from plain lists, indexing numpy arrays element by element is slower
+        self.x_list, self.y_list, self.angle_list = self.x.tolist(), self.y.tolist(), self.angle.tolist()
+
+    def pose_at(self, s):
+        '''Map.pose_at on this track, s is a number or an array of arc lengths'''
+        if not hasattr(s, '__len__'):
+            f = min(max(s / self.step, 0), self.n)
+            k = min(int(f), self.n - 1)
+            w = f - k
+            x = self.x_list[k] + w * (self.x_list[k + 1] - self.x_list[k])
+            y = self.y_list[k] + w * (self.y_list[k + 1] - self.y_list[k])
+            angle = self.angle_list[k] + w * (self.angle_list[k + 1] - self.angle_list[k])
+            beyond = min(s, 0) + max(s - self.length, 0)
+            if beyond:
+                x += beyond * math.sin(angle * math.pi / 180)
+                y -= beyond * math.cos(angle * math.pi / 180)
+            return x, y, angle
+        s = np.asarray(s, dtype=float)
+        f = np.clip(s / self.step, 0, self.n)
+        k = np.minimum(f.astype(int), self.n - 1)
+        w = f - k
+        x = self.x[k] + w * (self.x[k + 1] - self.x[k])
+        y = self.y[k] + w * (self.y[k + 1] - self.y[k])
+        angle = self.angle[k] + w * (self.angle[k + 1] - self.angle[k])
+        beyond = np.minimum(s, 0) + np.maximum(s - self.length, 0)
+        x += beyond * np.sin(np.deg2rad(angle))
+        y -= beyond * np.cos(np.deg2rad(angle))
+        return x, y, angle
+
 class Track:
-    def __init__(self, ap_arm, ap_lane, turn_dir):
+    '''The way of one vehicle through the intersection, ju_track and ju_shape_end_x are the map's (shared, never changed)'''
+    __slots__ = ('map', 'ap_arm', 'ap_lane', 'turn_dir', 'ju_track', 'key', 'ex_arm', 'ex_lane', 'is_complete', 'ju_shape_end_x')
+
+    def __init__(self, map, ap_arm, ap_lane, turn_dir):
+        self.map = map
         # approach arm ('NSEW') and lane 
         self.ap_arm = ap_arm
         self.ap_lane = ap_lane
@@ -249,19 +395,21 @@ class Track:
         # turning direction ('lrt') and track in junction area
         self.turn_dir = turn_dir
         self.ju_track = None
+        self.key = None # key of ju_track in Map.ju_track_table
 
         # exit arm and lane
-        self.ex_arm = Map.getInstance().get_ex_arm(ap_arm, turn_dir)
+        self.ex_arm = map.get_ex_arm(ap_arm, turn_dir)
         self.ex_lane = None
         
         self.is_complete = False
 
-        self.ju_shape_end_x = []
+        self.ju_shape_end_x = ()
     
     def confirm_ex_lane(self, ex_lane):
         self.ex_lane = ex_lane
-        self.ju_track = Map.getInstance().get_ju_track(self.ap_arm, self.turn_dir, self.ap_lane, self.ex_lane)
-        self.ju_shape_end_x = Track.cal_ju_shape_end_x(self.ju_track)
+        self.key = str(self.ap_arm) + str(self.turn_dir) + str(self.ap_lane) + str(self.ex_lane)
+        self.ju_track = self.map.get_ju_track(self.ap_arm, self.turn_dir, self.ap_lane, self.ex_lane)
+        self.ju_shape_end_x = self.map.ju_shape_end_x_table[self.key]
         self.is_complete = True
 
     @staticmethod
@@ -0,0 +1,105 @@
+import numpy as np
+
+class MetricsAccumulator:
+    '''
+    Delay and throughput of a running simulation, updated as vehicles are generated and leave the area (no log needed).
+    Per vehicle (indexed by _id, growing without limit): entry timestep, junction length, exit timestep and delay.
+    As in cal_delay.cal_metrics, the summary only counts the vehicles before the first one that has not left yet,
+    so that slow vehicles still on the road do not make the averages look better than they are.
+    The junction length is the last junction position the log has of the vehicle, as cal_metrics reads it (to 2 decimals
+    with the text log), so that the summary has the same values as cal_metrics of the run's log.
+    '''
+    def __init__(self, ctx, size=1024):
+        self.ctx = ctx
+        s = ctx.settings
+        self.converge_tol = s.metrics_converge_tol
+        self.converge_window = s.metrics_converge_window
+        self.start_time = - np.ones(size)
+        self.exit_time = - np.ones(size)
+        self.ju_entry_time = - np.ones(size)
+        self.ju_len = - np.ones(size)
+        self.ju_x_digits = 2 if s.log_format == 'text' else None # recorder.TextRecorder writes x with %.2f
+        self.delay = np.zeros(size)
+        self.finished = np.zeros(size, dtype=bool)
+        self.finish_count = 0
+        self.first_exit_time = None
+        self.prefix_count = 0 # vehicles 0 .. prefix_count - 1 have all left
+        self.prefix_delay_sum = [0.0] # prefix_delay_sum[n] = sum of the delays of vehicles 0 .. n - 1
+        self.prefix_first_exit_time = np.inf
+        self.longest_crash_list = []
+
+    def grow(self, veh_id):
+        size = len(self.start_time)
+        while size <= veh_id:
+            size *= 2
+        for name, fill in (('start_time', -1), ('exit_time', -1), ('ju_entry_time', -1), ('ju_len', -1), ('delay', 0), ('finished', False)):
+            column = getattr(self, name)
+            new_column = np.full(size, fill, dtype=column.dtype)
+            new_column[:len(column)] = column
+            setattr(self, name, new_column)
+
+    def on_generate(self, veh, timestep):
+        '''A vehicle was put into the simulation area at timestep, it is first moved (and logged) at the next one'''
+        if veh._id >= len(self.start_time):
+            self.grow(veh._id)
+        self.start_time[veh._id] = timestep + 1
+
+    def on_enter_junction(self, veh_id, timestep):
+        '''The move at timestep took the vehicle into the junction, that row is not logged'''
+        self.ju_entry_time[veh_id] = timestep
+
+    def on_leave_junction(self, veh_id, timestep, x):
+        '''The move at timestep took the vehicle out of the junction, x is its position before it, logged unless it entered at the move before'''
+        if timestep - 1 > self.ju_entry_time[veh_id]:
+            self.ju_len[veh_id] = x if self.ju_x_digits is None else round(x, self.ju_x_digits)
+
+    def on_remove(self, veh):
+        '''A vehicle left the simulation area, its last timestep is the exit time'''
+        s = self.ctx.settings
+        i = veh._id
+        self.exit_time[i] = veh.timestep
+        actual_time = (self.exit_time[i] - self.start_time[i]) * s.veh_dt
+        ideal_time = (s.arm_len * 2 + self.ju_len[i]) / s.cf_param['v0'] # Pass at a constant speed, ignore intersections and other vehicles
+        self.delay[i] = actual_time - ideal_time
+        self.finished[i] = True
+        self.finish_count += 1
+        if self.first_exit_time is None:
+            self.first_exit_time = self.exit_time[i]
+        while self.prefix_count < len(self.finished) and self.finished[self.prefix_count]:
+            self.prefix_delay_sum.append(self.prefix_delay_sum[-1] + self.delay[self.prefix_count])
+            self.prefix_first_exit_time = min(self.prefix_first_exit_time, self.exit_time[self.prefix_count])
+            self.prefix_count += 1
+
+    def on_crash(self, crashed_veh_ids):
+        if len(crashed_veh_ids) > len(self.longest_crash_list):
+            self.longest_crash_list = list(crashed_veh_ids)
+
+    def avg_delay(self, n=None):
+        '''Average delay of the first n vehicles (all that have left in order by default)'''
+        n = self.prefix_count if n is None else n
+        return self.prefix_delay_sum[n] / n if n else np.nan
+
+    def converged(self):
+        '''Whether the average delay changed by less than metrics_converge_tol (relative) over the last metrics_converge_window vehicles'''
+        if self.converge_tol is None or self.prefix_count < 2 * self.converge_window:
+            return False
+        avg_now, avg_before = self.avg_delay(), self.avg_delay(self.prefix_count - self.converge_window)
+        return abs(avg_now - avg_before) <= self.converge_tol * abs(avg_now)
+
+    def summary(self, timestep=None):
+        '''The metrics so far, with the keys of cal_metrics plus percentiles and the outflow over all vehicles that have left'''
+        veh_dt = self.ctx.settings.veh_dt
+        t = self.ctx.simulator.timestep if timestep is None else timestep
+        n = self.prefix_count
+        delay = self.delay[:n]
+        metrics = {}
+        metrics['veh_not_finish_min'] = n
+        metrics['actual_total_flow'] = n / ((t - self.prefix_first_exit_time) * veh_dt) * 3600 if n and t > self.prefix_first_exit_time else np.nan
+        metrics['avg_delay'] = np.mean(delay) if n else np.nan # summed as cal_metrics does, avg_delay's running sum rounds differently
+        metrics['max_delay'] = np.max(delay) if n else np.nan
+        metrics['p50_delay'], metrics['p95_delay'] = np.percentile(delay, [50, 95]) if n else (np.nan, np.nan)
+        metrics['finish_count'] = self.finish_count
+        metrics['outflow'] = self.finish_count / ((t - self.first_exit_time) * veh_dt) * 3600 \
+            if self.first_exit_time is not None and t > self.first_exit_time else np.nan
+        metrics['longest_crash_list'] = self.longest_crash_list
+        return metrics
@@ -3,7 +3,7 @@ from my_paint_canvas import MyPaintCanvas
 
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QIcon                
-from PyQt5.QtWidgets import QMainWindow, QWidget, QHBoxLayout, QMenu, QAction, QLabel, QMessageBox
+from PyQt5.QtWidgets import QMainWindow, QWidget, QHBoxLayout, QMenu, QAction, QLabel, QMessageBox, QSlider
 
 class MyMainWindow(QMainWindow):
     '''
@@ -13,8 +13,10 @@ class MyMainWindow(QMainWindow):
       └─QHBoxLayout
         └─canvas
     '''
-    def __init__(self):
+    def __init__(self, replay=None):
+        '''replay: a replay.Replay to show instead of running the simulation'''
         super().__init__()
+        self.replay = replay
 
         self.setWindowTitle('Intersection simulator (under development)')
         self.setGeometry(100, 100, 900, 900) # left, top, width, height Let’s fine-tune it later
@@ -28,7 +30,7 @@ class MyMainWindow(QMainWindow):
         self.main_widget = QWidget(self)
         self.main_widget.setFocus()
         self.setCentralWidget(self.main_widget)
-        self.canvas = MyPaintCanvas(parent=self.main_widget, mainw=self)
+        self.canvas = MyPaintCanvas(parent=self.main_widget, mainw=self, replay=replay)
 
         layout = QHBoxLayout(self.main_widget)
         layout.addWidget(self.canvas)
@@ -49,6 +51,17 @@ class MyMainWindow(QMainWindow):
         self.play_action = QAction(self.icons['pause'], "new", self)
         self.play_action.triggered.connect(self.play_triggered)
         self.toolbar.addAction(self.play_action)
+        if self.replay:
+            # Seek bar over the whole recorded run, see keyPressEvent for the keys
+            self.seek_slider = QSlider(Qt.Horizontal, self)
+            self.seek_slider.setRange(self.replay.first_t, self.replay.last_t)
+            self.seek_slider.setPageStep(int(10 / self.replay.settings.veh_dt))
+            self.seek_slider.valueChanged.connect(self.replay.seek)
+            self.seek_slider.setFocusPolicy(Qt.NoFocus)
+            self.toolbar.addWidget(self.seek_slider)
+            self.speed_lbl = QLabel(self)
+            self.toolbar.addWidget(self.speed_lbl)
+            self.show_speed()
 
     def setup_statusbar(self):
         self.step_lbl = QLabel("Timestep: 0000", self)
@@ -57,20 +70,61 @@ class MyMainWindow(QMainWindow):
         self.statusBar().addWidget(self.time_lbl)
         
     def play_triggered(self):
-        if self.canvas.disp_timer.isActive(): # Play->Pause, press the button again to play
-            self.canvas.disp_timer.stop()
-            self.canvas.veh_timer.stop()
+        if self.canvas.is_playing(): # Play->Pause, press the button again to play
+            self.canvas.pause()
             self.play_action.setIcon(self.icons['play'])
         else: # Pause->Play, press the button again to pause
-            self.canvas.disp_timer.start()
-            self.canvas.veh_timer.start()
+            self.canvas.play()
             self.play_action.setIcon(self.icons['pause'])
 
+    def show_replay_position(self, timestep):
+        '''Move the seek bar to the timestep drawn, without seeking'''
+        self.seek_slider.blockSignals(True)
+        self.seek_slider.setValue(timestep)
+        self.seek_slider.blockSignals(False)
+        if not self.replay.playing:
+            self.play_action.setIcon(self.icons['play'])
+
+    def show_speed(self):
+        self.speed_lbl.setText("  x%g" % self.replay.speed)
+
+    def keyPressEvent(self, event):
+        '''
+        Replay keys: Space play/pause, Left/Right one timestep back/forward, PageUp/PageDown 10 s back/forward, Home/End the start/end
+        of the run, Up/Down twice/half the speed, C the next timestep with a new collision
+        '''
+        if not self.replay:
+            return super().keyPressEvent(event)
+        replay = self.replay
+        key = event.key()
+        page = int(10 / replay.settings.veh_dt)
+        if key == Qt.Key_Space:
+            self.play_triggered()
+        elif key in (Qt.Key_Left, Qt.Key_Right):
+            replay.step(1 if key == Qt.Key_Right else -1)
+            self.play_action.setIcon(self.icons['play'])
+        elif key in (Qt.Key_PageUp, Qt.Key_PageDown):
+            replay.seek(replay.current() + (page if key == Qt.Key_PageDown else -page))
+        elif key == Qt.Key_Home:
+            replay.seek(replay.first_t)
+        elif key == Qt.Key_End:
+            replay.seek(replay.last_t)
+        elif key in (Qt.Key_Up, Qt.Key_Down):
+            replay.set_speed(replay.speed * (2 if key == Qt.Key_Up else 0.5))
+            self.show_speed()
+        elif key == Qt.Key_C:
+            later = [t for t in replay.crash_times() if t > replay.current()]
+            if later:
+                replay.seek(later[0])
+        else:
+            super().keyPressEvent(event)
+
     def fileQuit(self):
         self.close()
 
     def closeEvent(self, ce):
-        self.fileQuit()
+        # The simulation stops with the window, so that the log is complete when main.py reads it
+        self.canvas.stop()
 
     def about(self):
         QMessageBox.about(self, "About", "Todo")
\ No newline at end of file
@@ -1,34 +1,44 @@
 import yaml
 import math
 
-from map import Map
-from simulator import Simulator
-from lib.settings import lane_width, turn_radius, arm_len, NS_lane_count, EW_lane_count, veh_dt, disp_dt, simu_t, time_wrap
+from context import SimulationContext
+from snapshot import Snapshot, make_runner
 
 from PyQt5.QtCore import Qt, QTimer, QPointF, QRectF, QLineF
 from PyQt5.QtGui import QPainter, QColor, QPen, QFont
 from PyQt5.QtWidgets import QWidget
 
 class MyPaintCanvas(QWidget):
-    def __init__(self, parent=None, mainw=None):
+    def __init__(self, parent=None, mainw=None, ctx=None, replay=None):
         super().__init__(parent)
         self.mainw = mainw
+        # The simulation drawn by this canvas, the default context unless told otherwise. A replay.Replay of a recorded run
+        # stands in for both the context (its settings and map) and the runner
+        self.replay = replay
+        self.ctx = replay or ctx or SimulationContext.get_default()
+        s = self.ctx.settings
 
         self.disp_timer = QTimer(self)
-        self.disp_timer.start(int(disp_dt * 1000))
+        self.disp_timer.start(int(s.disp_dt * 1000))
         self.disp_timer.timeout.connect(self.update) # Each update triggers paintEvent
+        # With settings.gui_runner = 'thread' or 'process' the simulation is stepped by the runner and the canvas only draws
+        # the latest snapshot it published, with 'timer' veh_timer steps it here between paints
+        self.runner = replay or make_runner(self.ctx)
         self.veh_timer = QTimer(self)
-        self.veh_timer.start(int(veh_dt * 1000 / time_wrap))
-        self.veh_timer.timeout.connect(self.update_traffic)
+        if self.runner:
+            self.runner.start()
+        else:
+            self.veh_timer.start(int(s.veh_dt * 1000 / s.time_wrap))
+            self.veh_timer.timeout.connect(self.update_traffic)
 
-        self.lw = lane_width
-        self.tr = turn_radius
-        self.al = arm_len
-        self.NSl = NS_lane_count
-        self.EWl = EW_lane_count
+        self.lw = s.lane_width
+        self.tr = s.turn_radius
+        self.al = s.arm_len
+        self.NSl = s.NS_lane_count
+        self.EWl = s.EW_lane_count
 
         self.draw_road_shape = self.gen_draw_road()
-        self.draw_traj_shape = self.gen_draw_traj(Map.getInstance().ju_track_table)
+        self.draw_traj_shape = self.gen_draw_traj(self.ctx.map.ju_track_table)
 
        # Set background color
         self.setAutoFillBackground(True)
@@ -36,10 +46,48 @@ class MyPaintCanvas(QWidget):
         palette.setColor(self.backgroundRole(), QColor(247, 232, 232))
         self.setPalette(palette)
 
+    def is_playing(self):
+        if self.replay:
+            return self.replay.playing
+        return self.disp_timer.isActive()
+
+    def play(self):
+        if self.replay:
+            # A paused replay is still drawn, it can be moved around in
+            self.replay.resume()
+            return
+        self.disp_timer.start()
+        if self.runner:
+            self.runner.resume()
+        else:
+            self.veh_timer.start()
+
+    def pause(self):
+        if self.replay:
+            self.replay.pause()
+            return
+        self.disp_timer.stop()
+        if self.runner:
+            self.runner.pause()
+        else:
+            self.veh_timer.stop()
+
+    def stop(self):
+        '''Stop the simulation for good (closing the window)'''
+        self.veh_timer.stop()
+        self.disp_timer.stop()
+        if self.runner:
+            self.runner.stop()
+
+    def latest_snapshot(self):
+        if self.runner:
+            return self.runner.latest()
+        return Snapshot.take(self.ctx, self.ctx.simulator.get_sim_over())
+
     def update_traffic(self):
-        Simulator.getInstance().update()
-        if Simulator.getInstance().get_sim_over():
-            print('Simulation finished',Simulator.getInstance().get_sim_over())
+        self.ctx.simulator.update()
+        if self.ctx.simulator.get_sim_over():
+            print('Simulation finished',self.ctx.simulator.get_sim_over())
             self.veh_timer.stop()
             self.disp_timer.stop()
             self.mainw.close()
@@ -65,15 +113,23 @@ class MyPaintCanvas(QWidget):
         # setWindow(x, y, w, h) sets the logical coordinates, here the middle point is (0, 0)
         qp.setWindow(int(- window_wid / 2), int(- window_hgt / 2), int(window_wid),int( window_hgt))
 
+        snapshot = self.latest_snapshot()
+        if snapshot is None:
+            return
         self.draw_road(qp)
         # self.draw_traj(qp) # Display trajectory, for debugging
-        self.draw_vehs(qp)
+        self.draw_vehs(qp, snapshot)
 
-        ts = Simulator.getInstance().timestep
+        s = self.ctx.settings
+        ts = snapshot.timestep
         self.mainw.step_lbl.setText("Timestep: %4d" % ts)
-        self.mainw.time_lbl.setText("Elapsed time: %.1f s" % (ts * veh_dt))
+        self.mainw.time_lbl.setText("Elapsed time: %.1f s" % (ts * s.veh_dt))
         # print('ts = %d, simu_t/veh_dt = %d' % (ts, simu_t / veh_dt))
-        if ts >= simu_t / veh_dt:
+        if self.replay:
+            self.mainw.show_replay_position(ts)
+        elif ts >= s.simu_t / s.veh_dt or (self.runner and snapshot.finished):
+            if self.runner and snapshot.finished:
+                print('Simulation finished')
             self.mainw.close()
     
     def gen_draw_road(self):
@@ -186,155 +242,30 @@ class MyPaintCanvas(QWidget):
         for ele in self.draw_traj_shape['traj_Qarcs']:
             qp.drawArc(ele[0], ele[1], ele[2]) 
     
-    def draw_vehs(self, qp):
-        qp.setBrush(QColor(49, 58, 135))
+    def draw_vehs(self, qp, snapshot):
         qp.setPen(QPen(QColor(255, 152, 146), 0.1, Qt.SolidLine))
         qf = qp.font()
         qf.setPointSizeF(2.5)
         qf.setFamily('Consolas')
         qp.setFont(qf)
-        x1 = self.lw * self.NSl
-        x2 = x1 + self.tr 
-        y1 = self.lw * self.EWl
-        y2 = y1 + self.tr
-        for veh in Simulator.getInstance().all_veh['Nap']: 
-            if veh.faultyCar:
-                qp.setBrush(QColor(255, 0, 0))
-            else:
-                qp.setBrush(QColor(49, 58, 135))
-            x = - (self.lw / 2 + self.lw * veh.inst_lane)
-            y = - (y2 + (-veh.inst_x))
-            rect = QRectF(x - veh.veh_wid/2, y - veh.veh_len_back, veh.veh_wid, veh.veh_len)
-            qp.drawRect(rect)
-            # qp.drawText(rect.bottomLeft(), str(veh._id))
-        for veh in Simulator.getInstance().all_veh['Nex']: 
-            if veh.faultyCar:
-                qp.setBrush(QColor(255, 0, 0))
-            else:
-                qp.setBrush(QColor(49, 58, 135))
-            x = self.lw / 2 + self.lw * veh.inst_lane
-            y = - (y2 + (veh.inst_x))
-            rect = QRectF(x - veh.veh_wid/2, y - veh.veh_len_front, veh.veh_wid, veh.veh_len)
-            qp.drawRect(rect)
-            # qp.drawText(rect.bottomLeft(), str(veh._id))
-        for veh in Simulator.getInstance().all_veh['Sap']:
-            if veh.faultyCar:
-                qp.setBrush(QColor(255, 0, 0))
-            else:
-                qp.setBrush(QColor(49, 58, 135))
-            x = self.lw / 2 + self.lw * veh.inst_lane
-            y = y2 + (-veh.inst_x)
-            rect = QRectF(x - veh.veh_wid/2, y - veh.veh_len_front, veh.veh_wid, veh.veh_len)
-            qp.drawRect(rect)
-            # qp.drawText(rect.bottomLeft(), str(veh._id))
-        for veh in Simulator.getInstance().all_veh['Sex']:
-            if veh.faultyCar:
+        for k in range(len(snapshot)):
+            faulty, collided = snapshot.faulty[k], snapshot.collided[k]
+            if snapshot.in_junction[k] and faulty and collided:
                 qp.setBrush(QColor(255, 0, 0))
-            else:
-                qp.setBrush(QColor(49, 58, 135))
-            x = - (self.lw / 2 + self.lw * veh.inst_lane)
-            y = y2 + veh.inst_x
-            rect = QRectF(x - veh.veh_wid/2, y - veh.veh_len_back, veh.veh_wid, veh.veh_len)
-            qp.drawRect(rect)
-            # qp.drawText(rect.bottomLeft(), str(veh._id))
-        for veh in Simulator.getInstance().all_veh['Wap']:
-            if veh.faultyCar:
-                qp.setBrush(QColor(255, 0, 0))
-            else:
-                qp.setBrush(QColor(49, 58, 135))
-            x = - (x2 + (-veh.inst_x))
-            y = self.lw / 2 + self.lw * veh.inst_lane
-            rect = QRectF(x - veh.veh_len_back, y - veh.veh_wid/2, veh.veh_len, veh.veh_wid)
-            qp.drawRect(rect)
-            # qp.drawText(rect.bottomLeft(), str(veh._id))
-        for veh in Simulator.getInstance().all_veh['Wex']:
-            if veh.faultyCar:
-                qp.setBrush(QColor(255, 0, 0))
-            else:
-                qp.setBrush(QColor(49, 58, 135))
-            x = - (x2 + veh.inst_x)
-            y = - (self.lw / 2 + self.lw * veh.inst_lane)
-            rect = QRectF(x - veh.veh_len_front, y - veh.veh_wid/2, veh.veh_len, veh.veh_wid)
-            qp.drawRect(rect)
-            # qp.drawText(rect.bottomLeft(), str(veh._id))
-        for veh in Simulator.getInstance().all_veh['Eap']:
-            if veh.faultyCar:
-                qp.setBrush(QColor(255, 0, 0))
-            else:
-                qp.setBrush(QColor(49, 58, 135))
-            x = x2 + (-veh.inst_x)
-            y = - (self.lw / 2 + self.lw * veh.inst_lane)
-            rect = QRectF(x - veh.veh_len_front, y - veh.veh_wid/2, veh.veh_len, veh.veh_wid)
-            qp.drawRect(rect)
-            # qp.drawText(rect.bottomLeft(), str(veh._id))
-        for veh in Simulator.getInstance().all_veh['Eex']:
-            if veh.faultyCar:
-                qp.setBrush(QColor(255, 0, 0))
-            else:
-                qp.setBrush(QColor(49, 58, 135))
-            x = x2 + veh.inst_x
-            y = self.lw / 2 + self.lw * veh.inst_lane
-            rect = QRectF(x - veh.veh_len_back, y - veh.veh_wid/2, veh.veh_len, veh.veh_wid)
-            qp.drawRect(rect)
-            # qp.drawText(rect.bottomLeft(), str(veh._id))
-        for veh in Simulator.getInstance().all_veh['ju']:
-            if veh.faultyCar and veh.collidedCar:
-                qp.setBrush(QColor(255, 0, 0))
-            elif veh.faultyCar:
+            elif snapshot.in_junction[k] and faulty:
                 qp.setBrush(QColor(0, 255, 0))
-            elif veh.collidedCar:
+            elif snapshot.in_junction[k] and collided:
                 qp.setBrush(QColor(0, 0, 255))
+            elif faulty:
+                qp.setBrush(QColor(255, 0, 0))
             else:
                 qp.setBrush(QColor(49, 58, 135))
-            # Find on which paragraph
-            seg_idx = 0
-            for (i, end_x) in enumerate(veh.track.ju_shape_end_x):
-                if veh.inst_x > end_x: # is greater than the end point of the i-th segment, then it is in the (i+1) segment
-                    seg_idx = i + 1
-                    break
-            seg = veh.track.ju_track[seg_idx] #The shape of this segment
-            if seg_idx > 0:
-                seg_x = veh.inst_x - veh.track.ju_shape_end_x[seg_idx - 1] # The length of this segment
-            else:
-                seg_x = veh.inst_x
-            if seg[0] == 'line': # It's a straight line, great
-                if abs(seg[1][0] - seg[2][0]) < 1e-5: # vertical bar
-                    x = seg[1][0]
-                    if seg[1][1] < seg[2][1]: # from top to bottom
-                        y = seg[1][1] + seg_x
-                        rect = QRectF(x - veh.veh_wid/2, y - veh.veh_len_back, veh.veh_wid, veh.veh_len)
-                        qp.drawRect(rect)
-                        qp.drawText(rect.bottomLeft(), str(veh._id))
-                    else: # from bottom to top
-                        y = seg[1][1] - seg_x
-                        rect = QRectF(x - veh.veh_wid/2, y - veh.veh_len_front, veh.veh_wid, veh.veh_len)
-                        qp.drawRect(rect)
-                        qp.drawText(rect.bottomLeft(), str(veh._id))
-                else: #Horizontal line
-                    y = seg[1][1]
-                    if seg[1][0] < seg[2][0]: # from left to right
-                        x = seg[1][0] + seg_x
-                        rect = QRectF(x - veh.veh_len_back, y - veh.veh_wid/2, veh.veh_len, veh.veh_wid)
-                        qp.drawRect(rect)
-                        qp.drawText(rect.bottomLeft(), str(veh._id))
-                    else: # from right to left
-                        x = seg[1][0] - seg_x
-                        rect = QRectF(x - veh.veh_len_front, y - veh.veh_wid/2, veh.veh_len, veh.veh_wid)
-                        qp.drawRect(rect)
-                        qp.drawText(rect.bottomLeft(), str(veh._id))
-            else: # circular curve
-                qp.save()
-                qp.translate(seg[3][0], seg[3][1])
-                if seg[5][0] < seg[5][1]: # Trajectory counterclockwise
-                    rotation = seg[5][0] + seg_x / seg[4] * 180 / math.pi
-                    qp.rotate(- rotation) # rotate is the number of degrees clockwise
-                    rect = QRectF(seg[4] - veh.veh_wid/2, - veh.veh_len_front, veh.veh_wid, veh.veh_len)
-                    qp.drawRect(rect)
-                    qp.drawText(rect.bottomLeft(), str(veh._id))
-                else:
-                    rotation = seg[5][0] - seg_x / seg[4] * 180 / math.pi
-                    qp.rotate(- rotation)
-                    rect = QRectF(seg[4] - veh.veh_wid/2, - veh.veh_len_back, veh.veh_wid, veh.veh_len)
-                    qp.drawRect(rect)
-                    qp.drawText(rect.bottomLeft(), str(veh._id))
-                qp.restore()
\ No newline at end of file
+            # Rotate about the point of the pose, so that the vehicle heads to the north (-y) in the rotated frame
+            qp.save()
+            qp.translate(snapshot.x[k], snapshot.y[k])
+            qp.rotate(snapshot.angle[k]) # rotate is the number of degrees clockwise
+            rect = QRectF(- snapshot.veh_wid[k]/2, - snapshot.veh_len_front[k], snapshot.veh_wid[k], snapshot.veh_len[k])
+            qp.drawRect(rect)
+            if snapshot.in_junction[k]:
+                qp.drawText(rect.bottomLeft(), str(snapshot.veh_id[k]))
+            qp.restore()
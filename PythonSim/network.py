@@ -0,0 +1,260 @@
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+
+import numpy as np
+
+from context import snapshot_settings
+
+OPPOSITE = {'N': 'S', 'S': 'N', 'E': 'W', 'W': 'E'}
+# Where the vehicles leaving on each exit arm go: (row, col) step to the neighbouring intersection, row 0 is the northmost
+NEIGHBOR_STEP = {'N': (-1, 0), 'S': (1, 0), 'E': (0, 1), 'W': (0, -1)}
+
+def grid_links(rows, cols):
+    '''
+    (node, exit arm): (node, approach arm) of a rows x cols grid of intersections, nodes are (row, col).
+    The vehicles leaving a node on its E arm drive on to the W approach arm of the node east of it, and so on.
+    '''
+    links = {}
+    for row in range(rows):
+        for col in range(cols):
+            for (ex_arm, (d_row, d_col)) in NEIGHBOR_STEP.items():
+                if 0 <= row + d_row < rows and 0 <= col + d_col < cols:
+                    links[((row, col), ex_arm)] = ((row + d_row, col + d_col), OPPOSITE[ex_arm])
+    return links
+
+def partition(nodes, parts):
+    '''Split the nodes (row by row) into parts contiguous blocks of nearly equal size: strips of rows cut the fewest links of a grid'''
+    bounds = np.linspace(0, len(nodes), parts + 1).round().astype(int)
+    return [nodes[bounds[k]:bounds[k + 1]] for k in range(parts) if bounds[k + 1] > bounds[k]]
+
+def node_seed(seed, k):
+    '''The seed of the k-th intersection of a network seeded with seed, None keeps it unseeded'''
+    return None if seed is None else int(np.random.SeedSequence([seed, k]).generate_state(1)[0])
+
+def node_name(node):
+    return '%d-%d' % node
+
+class Shard:
+    '''
+    The intersections that one worker steps, each a SimulationContext of its own. Network talks to it through post and collect,
+    the same as to a ShardProcess, so that the network steps the same way in one process or in many.
+    '''
+    def __init__(self, specs):
+        # No window will ever be shown, so keep matplotlib away from any GUI backend
+        import matplotlib
+        matplotlib.use('Agg')
+        from context import SimulationContext
+
+        self.ctxs = {}
+        self.max_timestep = {}
+        for (node, seed, log_fname, overrides) in specs:
+            ctx = self.ctxs[node] = SimulationContext(seed=seed, log_fname=log_fname, **overrides)
+            self.max_timestep[node] = ctx.settings.simu_t / ctx.settings.veh_dt
+        self.result = None
+
+    def step(self, inbox):
+        '''
+        Hand in the vehicles of inbox ({(node, ap_arm): count}) and advance every running node one timestep.
+        Returns the vehicles handed off ({node: [(ex_arm, ex_lane, veh_id), ...]}), the vehicles handed to nodes that are over,
+        and the nodes that are over now
+        '''
+        dropped = 0
+        for ((node, ap_arm), count) in inbox.items():
+            sim = self.ctxs[node].simulator
+            if sim.timestep < self.max_timestep[node] and not sim.get_sim_over():
+                sim.hand_in(ap_arm, count)
+            else:
+                dropped += count
+        handoffs, over = {}, set()
+        for (node, ctx) in self.ctxs.items():
+            sim = ctx.simulator
+            if sim.timestep >= self.max_timestep[node] or sim.get_sim_over():
+                over.add(node)
+                continue
+            sim.update()
+            if sim.handoffs:
+                handoffs[node] = sim.handoffs
+                sim.handoffs = []
+        return handoffs, dropped, over
+
+    def post(self, inbox):
+        self.result = self.step(inbox)
+
+    def collect(self):
+        return self.result
+
+    def close(self):
+        '''Close the logs and return the metrics of every node'''
+        summaries = {}
+        for (node, ctx) in self.ctxs.items():
+            ctx.close()
+            summaries[node] = ctx.simulator.metrics.summary()
+        return summaries
+
+def shard_worker(conn, specs):
+    '''The loop of a ShardProcess: build the Shard, then step it for every inbox received, until None comes'''
+    try:
+        shard = Shard(specs)
+        conn.send(('ok', None))
+        while True:
+            inbox = conn.recv()
+            if inbox is None:
+                break
+            conn.send(('ok', shard.step(inbox)))
+        conn.send(('ok', shard.close()))
+    except BaseException:
+        conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+class ShardProcess:
+    '''A Shard in a worker process, one message each way per timestep'''
+    def __init__(self, index, specs, mp_context):
+        self.index = index
+        self.conn, child_conn = mp_context.Pipe()
+        self.process = mp_context.Process(target=shard_worker, args=(child_conn, specs), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.receive()
+
+    def receive(self):
+        status, payload = self.conn.recv()
+        if status == 'error':
+            self.process.join()
+            raise RuntimeError('Shard %d failed:\n%s' % (self.index, payload))
+        return payload
+
+    def post(self, inbox):
+        self.conn.send(inbox)
+
+    def collect(self):
+        return self.receive()
+
+    def close(self):
+        self.conn.send(None)
+        summaries = self.receive()
+        self.process.join()
+        return summaries
+
+class Network:
+    '''
+    A rows x cols grid of intersections (a corridor when rows = 1), every one with its own SimulationContext: map, manager,
+    reservation grid, vehicles and random streams. The exit arms of an intersection feed the approach arms of its neighbours
+    (grid_links), the arms at the edge of the grid take the demand of veh_gen_rule_table and let vehicles leave the network.
+    At every timestep each intersection hands in the vehicles that left its upstream neighbours on the timestep before, as point
+    queue arrivals on the linked approach arm (Simulator.hand_in), and takes one step. That is all they share, so the intersections
+    are split into strips (partition) stepped by settings.net_workers worker processes in lockstep, and the results do not depend
+    on the number of workers.
+    '''
+    def __init__(self, rows, cols, seed=None, log_dir=None, workers=None, **overrides):
+        '''
+        seed        the seed of the network, each intersection gets its own (node_seed)
+        log_dir     each intersection writes its log there, None means no logs
+        workers     worker processes, settings.net_workers by default, 1 steps all intersections in this process
+        overrides   settings of every intersection, as for SimulationContext
+        '''
+        self.settings = snapshot_settings(**overrides)
+        self.rows, self.cols = rows, cols
+        self.nodes = [(row, col) for row in range(rows) for col in range(cols)]
+        self.links = grid_links(rows, cols)
+        self.seed = seed
+        self.timestep = 0
+        self.handoff_count = 0
+        self.dropped_count = 0
+        self.inbox = {}
+
+        specs = [self.node_spec(k, node, log_dir, overrides) for (k, node) in enumerate(self.nodes)]
+        workers = min(workers or self.settings.net_workers, len(self.nodes))
+        if workers == 1:
+            self.shards = [Shard(specs)]
+            self.node_shard = {node: 0 for node in self.nodes}
+        else:
+            mp_context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+            spec_of = dict(zip(self.nodes, specs))
+            parts = partition(self.nodes, workers)
+            self.shards = [ShardProcess(k, [spec_of[node] for node in part], mp_context) for (k, part) in enumerate(parts)]
+            self.node_shard = {node: k for (k, part) in enumerate(parts) for node in part}
+        self.running = set(self.nodes)
+
+    @staticmethod
+    def corridor(n, seed=None, log_dir=None, workers=None, **overrides):
+        '''n intersections in a row from west to east'''
+        return Network(1, n, seed, log_dir, workers, **overrides)
+
+    def node_spec(self, k, node, log_dir, overrides):
+        '''(node, seed, log_fname, settings overrides) of an intersection, with the arms linked to its neighbours'''
+        linked_arms = ''.join(arm for arm in 'NSEW' if (node, arm) in self.links)
+        fed_arms = ''.join(arm for arm in 'NSEW' if (node, arm) in self.links.values())
+        log_fname = None
+        if log_dir and self.settings.log_format != 'none':
+            if not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+            ext = '.traj' if self.settings.log_format == 'binary' else '.log'
+            log_fname = os.path.join(log_dir, 'log %s node %s %s%s' % (time.strftime("%Y-%m-%d %H-%M-%S"), node_name(node), self.seed, ext))
+        return node, node_seed(self.seed, k), log_fname, dict(overrides, fed_arms=fed_arms, linked_arms=linked_arms)
+
+    def update(self):
+        '''One timestep of every running intersection, and the handoffs across the boundaries'''
+        for (k, shard) in enumerate(self.shards):
+            shard.post({key: count for (key, count) in self.inbox.items() if self.node_shard[key[0]] == k})
+        self.inbox = {}
+        for shard in self.shards:
+            handoffs, dropped, over = shard.collect()
+            self.dropped_count += dropped
+            self.running -= over
+            for (node, records) in handoffs.items():
+                for (ex_arm, ex_lane, veh_id) in records:
+                    key = self.links[(node, ex_arm)]
+                    self.inbox[key] = self.inbox.get(key, 0) + 1
+                self.handoff_count += len(records)
+        self.timestep += 1
+
+    def run(self):
+        '''Step until every intersection is over (simu_t reached, or the end after a crash), and return summary'''
+        while self.running:
+            self.update()
+        return self.close()
+
+    def close(self):
+        '''Stop the workers and return the metrics of the network (summary)'''
+        node_metrics = {}
+        for shard in self.shards:
+            node_metrics.update(shard.close())
+        self.shards = []
+        return self.summary(node_metrics)
+
+    def summary(self, node_metrics):
+        '''
+        The metrics of every intersection (MetricsAccumulator.summary, a vehicle handed in counts as a new one, so the delays are per
+        intersection passed), the vehicles handed from one intersection to the next, those handed to an intersection that was over,
+        the vehicles that left the network, and the average delay per intersection passed over all of them
+        '''
+        passed = sum(metrics['veh_not_finish_min'] for metrics in node_metrics.values())
+        delay_sum = sum(metrics['avg_delay'] * metrics['veh_not_finish_min'] for metrics in node_metrics.values() if metrics['veh_not_finish_min'])
+        finish_count = sum(metrics['finish_count'] for metrics in node_metrics.values())
+        return {
+            'nodes': {node_name(node): node_metrics[node] for node in self.nodes},
+            'timesteps': self.timestep,
+            'handoff_count': self.handoff_count,
+            'dropped_count': self.dropped_count,
+            'network_exit_count': finish_count - self.handoff_count,
+            'avg_delay': delay_sum / passed if passed else np.nan
+        }
+
+if __name__ == '__main__':
+    # python network.py Dresner 1440 2 3 [seed] [workers]
+    from headless import scenario_settings
+    mode, total_flow, rows, cols = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4])
+    seed = int(sys.argv[5]) if len(sys.argv) > 5 else None
+    workers = int(sys.argv[6]) if len(sys.argv) > 6 else None
+
+    start = time.time()
+    network = Network(rows, cols, seed, workers=workers, fault_veh_range=None, log_format='none', **scenario_settings(mode, total_flow))
+    summary = network.run()
+    for (name, metrics) in summary.pop('nodes').items():
+        print('%s: avg_delay = %.2f, finish_count = %d' % (name, metrics['avg_delay'], metrics['finish_count']))
+    for (key, value) in summary.items():
+        print(key, '=', value)
+    print('wall_time = %.1f s' % (time.time() - start))
@@ -1,61 +1,26 @@
-import subprocess
-import re
-
-def run_simulation(simulation_cmd):
-    # Run the simulation command and capture the output
-    result = subprocess.run(simulation_cmd, stdout=subprocess.PIPE, text=True, shell=True)
-    output = result.stdout
-
-    # Initialize metrics
-    metrics = {
-        'crash_list_length': 0,
-        'avg_delay': 0,
-        'max_delay': 0,
-        'actual_total_flow': 0,
-    }
-
-    # Extract metrics from the output
-    crash_list_pattern = re.compile(r'longest_crash_list = (\[.*?\])')
-    avg_delay_pattern = re.compile(r'avg_delay = ([\d\.]+)')
-    max_delay_pattern = re.compile(r'max_delay = ([\d\.]+)')
-    actual_total_flow_pattern = re.compile(r'actual_total_flow = ([\d\.]+)')
-
-    # Process patterns
-    for pattern, key in [(crash_list_pattern, 'crash_list_length'),
-                         (avg_delay_pattern, 'avg_delay'),
-                         (max_delay_pattern, 'max_delay'),
-                         (actual_total_flow_pattern, 'actual_total_flow')]:
-        match = pattern.search(output)
-        if match:
-            if key == 'crash_list_length':
-                crash_list = eval(match.group(1))  # Convert string representation of list to actual list
-                metrics[key] = len(crash_list)
-            else:
-                metrics[key] = float(match.group(1))
-
-    return metrics
-
-def main(simulation_cmd, num_runs):
-    # Initialize total metrics
-    total_metrics = {
-        'crash_list_length': 0,
-        'avg_delay': 0,
-        'max_delay': 0,
-        'actual_total_flow': 0,
-    }
-
-    for _ in range(num_runs):
-        metrics = run_simulation(simulation_cmd)
-        for key in total_metrics:
-            total_metrics[key] += metrics[key]
-
-    # Calculate and print averages
-    for key, total in total_metrics.items():
-        average = total / num_runs
-        print(f'Average {key.replace("_", " ")} over {num_runs} runs: {average}')
-
-if __name__ == '__main__':
-    simulation_command = 'python main.py Dresner 10000'
-    number_of_runs = 10  # Specify the number of times you want to run the simulation
-
-    main(simulation_command, number_of_runs)
+import os
+import time
+
+from sweep import make_grid, sweep, summarise, print_summary
+
+def repeat(mode, total_flow, num_runs, results_fname):
+    '''Repeat one scenario num_runs times on all cores and print the average of each metric'''
+    runs = make_grid([mode], [total_flow], seeds=range(num_runs))
+    results = sweep(runs, results_fname)
+    for row in summarise(results):
+        for key in ('crash_list_length', 'avg_delay', 'max_delay', 'actual_total_flow'):
+            print(f'Average {key.replace("_", " ")} over {row["runs"]} runs: {row[key]}')
+
+if __name__ == '__main__':
+    os.makedirs('log', exist_ok=True)
+
+    # Nightly resilience study: every manager over the whole flow range, 10 seeds each, on all cores.
+    # Re-running on the same day resumes an interrupted study.
+    simu_result_file = os.path.join('log', 'simu_result ' + time.strftime("%Y-%m-%d") + '.jsonl')
+    runs = make_grid(['Dresner', 'Xu', 'light'], [720, 1440, 2160, 2880, 3600, 4320, 5040, 5760], seeds=range(10))
+    results = sweep(runs, simu_result_file)
+    print_summary(summarise(results))
+
+    # Dresner far beyond saturation, averaged over 10 runs
+    number_of_runs = 10  # Specify the number of times you want to run the simulation
+    repeat('Dresner', 10000, number_of_runs, os.path.join('log', 'night_script Dresner 10000 ' + time.strftime("%Y-%m-%d") + '.jsonl'))
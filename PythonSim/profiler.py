@@ -0,0 +1,108 @@
+import time
+
+import numpy as np
+
+class PhaseProfiler:
+    '''
+    Wall time of each phase of Simulator.update, and what happened in it, at every timestep (settings.profile = True).
+    Per timestep: the vehicles in the area, the seconds spent in each phase, how many vehicles each phase handled
+    (collision: in the junction, position and control: all, regroup: changed group, spawn: generated, removal: left)
+    and the messages sent, from ComSystem.message_count: V2I and I2V messages, and the I2V replies to reservation requests.
+    The rows are kept in arrays that double in size when they are full, see summary, format_summary and save.
+    '''
+    phases = ('collision', 'position', 'regroup', 'spawn', 'removal', 'control', 'manager')
+    counters = (('V2I', None), ('I2V', None), ('I2V', 'confirm'), ('I2V', 'counter-offer'), ('I2V', 'reject'))
+    counter_names = ('V2I', 'I2V', 'confirm', 'counter_offer', 'reject')
+
+    def __init__(self, ctx, size=1024):
+        self.ctx = ctx
+        self.clock = time.perf_counter
+        self.n = 0
+        self.timestep = np.zeros(size, dtype=np.int64)
+        self.vehs = np.zeros(size, dtype=np.int64)
+        self.time = np.zeros((size, len(self.phases)))
+        self.calls = np.zeros((size, len(self.phases)), dtype=np.int64)
+        self.counts = np.zeros((size, len(self.counters)), dtype=np.int64)
+        self.last_counts = [0] * len(self.counters)
+        self.phase = 0
+        self.last_clock = None
+
+    def grow(self):
+        for name in ('timestep', 'vehs', 'time', 'calls', 'counts'):
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate([column, np.zeros_like(column)]))
+
+    def start(self):
+        '''Called at the start of Simulator.update'''
+        if self.n == len(self.timestep):
+            self.grow()
+        self.phase = 0
+        self.last_clock = self.clock()
+
+    def lap(self, calls):
+        '''The current phase has ended after handling calls vehicles, the next one starts'''
+        now = self.clock()
+        self.time[self.n, self.phase] = now - self.last_clock
+        self.calls[self.n, self.phase] = calls
+        self.phase += 1
+        self.last_clock = now
+
+    def stop(self, timestep, vehs):
+        '''Called at the end of Simulator.update, after the last lap'''
+        message_count = self.ctx.com.message_count
+        for (k, key) in enumerate(self.counters):
+            count = message_count.get(key, 0)
+            self.counts[self.n, k] = count - self.last_counts[k]
+            self.last_counts[k] = count
+        self.timestep[self.n] = timestep
+        self.vehs[self.n] = vehs
+        self.n += 1
+
+    def summary(self):
+        '''
+        One row per phase: total seconds, share of the total, mean and max milliseconds per timestep, vehicles handled,
+        and the totals of the message counters under 'messages'
+        '''
+        times, calls = self.time[:self.n], self.calls[:self.n]
+        total = times.sum()
+        rows = []
+        for (k, phase) in enumerate(self.phases):
+            rows.append({
+                'phase': phase,
+                'total_s': times[:, k].sum(),
+                'share': times[:, k].sum() / total if total else np.nan,
+                'mean_ms': times[:, k].mean() * 1000 if self.n else np.nan,
+                'max_ms': times[:, k].max() * 1000 if self.n else np.nan,
+                'calls': int(calls[:, k].sum())
+            })
+        return {
+            'timesteps': self.n,
+            'total_s': total,
+            'phases': rows,
+            'messages': {name: int(self.counts[:self.n, k].sum()) for (k, name) in enumerate(self.counter_names)}
+        }
+
+    def format_summary(self):
+        '''summary as a text table'''
+        return PhaseProfiler.format_table(self.summary())
+
+    @staticmethod
+    def format_table(summary):
+        '''A summary (also one returned by headless.run_headless as metrics['profile']) as a text table'''
+        lines = ['%d timesteps, %.3f s' % (summary['timesteps'], summary['total_s'])]
+        lines.append('%-10s %10s %7s %9s %9s %10s' % ('phase', 'total s', 'share', 'mean ms', 'max ms', 'calls'))
+        for row in summary['phases']:
+            lines.append('%-10s %10.3f %6.1f%% %9.3f %9.3f %10d' % (row['phase'], row['total_s'], row['share'] * 100, row['mean_ms'], row['max_ms'], row['calls']))
+        lines.append(', '.join('%s = %d' % (name, count) for (name, count) in summary['messages'].items()))
+        return '\n'.join(lines)
+
+    def save(self, fname):
+        '''The rows as a csv file: t, vehs, <phase>_s for each phase, <phase>_calls for each phase, then the message counters'''
+        header = ['t', 'vehs'] + ['%s_s' % phase for phase in self.phases] + ['%s_calls' % phase for phase in self.phases] + list(self.counter_names)
+        with open(fname, 'w') as f:
+            f.write(', '.join(header) + '\n')
+            for k in range(self.n):
+                f.write(', '.join(
+                    ['%d' % self.timestep[k], '%d' % self.vehs[k]] + ['%.6f' % t for t in self.time[k]] +
+                    ['%d' % c for c in self.calls[k]] + ['%d' % c for c in self.counts[k]]
+                ) + '\n')
@@ -0,0 +1,181 @@
+import os
+import json
+import logging
+
+import numpy as np
+
+ZONES = ('ap', 'ju', 'ex')
+ZONE_CODE = {'ap': 0, 'ju': 1, 'ex': 2}
+
+class TextRecorder:
+    '''
+    Writes the trajectory and the events through the context's logger as text lines, the log format read by cal_delay.cal_metrics.
+    Events without a text form (vehicle, reservation) are not written.
+    '''
+    messages = {
+        'crash': 'crashed_Vehicle_ID:%(veh_ids)s',
+        'fault': 'Faulty vehicle %(veh_id)d stopping in the intersection.',
+        'stop_ju': 'Vehicle %(veh_id)d stopping at max deceleration rate due to allStop broadcast.',
+        'stop_ap': 'Vehicle %(veh_id)d in approach zone rejecting reservations and stopping due to allStop broadcast.'
+    }
+    levels = {'crash': logging.DEBUG}
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def record(self, t, veh_id, zone, lane, x, v, a):
+        '''One vehicle at one timestep, zone is 'ap', 'ju' or 'ex' '''
+        self.logger.debug("%d, %d, %s, %d, %.2f, %.2f, %.2f" % (t, veh_id, zone, lane, x, v, a))
+
+    def record_many(self, t, veh_id, zone, lane, x, v, a):
+        '''Many vehicles at once, all arguments are arrays of the same length, zone holds ZONE_CODE values'''
+        if len(t):
+            rows = zip(t.tolist(), veh_id.tolist(), zone.tolist(), lane.tolist(), x.tolist(), v.tolist(), a.tolist())
+            self.logger.debug('\n'.join(["%d, %d, %s, %d, %.2f, %.2f, %.2f" % (t_, id_, ZONES[z_], l_, x_, v_, a_) for (t_, id_, z_, l_, x_, v_, a_) in rows]))
+
+    def event(self, stream, **fields):
+        if stream in self.messages:
+            self.logger.log(self.levels.get(stream, logging.INFO), self.messages[stream] % fields)
+
+    def close(self):
+        pass
+
+class BinaryRecorder:
+    '''
+    Columnar trajectory log in the directory path: the rows (t, veh_id, zone, lane, x, v, a) are collected in a preallocated
+    structured array that is saved as traj_00000.npy, traj_00001.npy, ... each time it is full. The events (vehicle, junction,
+    reservation, crash, fault, stop_ju, stop_ap, handoff) are kept as separate streams, those recorded since the last chunk are
+    saved with it as events_00000.json, events_00001.json, ... meta.json (the run settings and the counts of both) is rewritten
+    after every chunk, so a run that dies leaves a log that reads up to its last chunk. close marks it complete.
+    '''
+    dtype = np.dtype([('t', '<i4'), ('veh_id', '<i4'), ('zone', 'i1'), ('lane', 'i1'), ('x', '<f8'), ('v', '<f4'), ('a', '<f4')])
+
+    def __init__(self, path, settings, chunk_size=1 << 16):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.settings = settings
+        self.buffer = np.empty(chunk_size, dtype=self.dtype)
+        self.n = 0
+        self.chunk_count = 0
+        self.events = {} # The events recorded since the last flush
+        self.event_chunk_count = 0
+        self.write_meta(complete=False)
+
+    def record(self, t, veh_id, zone, lane, x, v, a):
+        if self.n == len(self.buffer):
+            self.flush()
+        self.buffer[self.n] = (t, veh_id, ZONE_CODE[zone], lane, x, v, a)
+        self.n += 1
+
+    def record_many(self, t, veh_id, zone, lane, x, v, a):
+        start = 0
+        while start < len(t):
+            if self.n == len(self.buffer):
+                self.flush()
+            end = min(len(t), start + len(self.buffer) - self.n)
+            rows = self.buffer[self.n: self.n + end - start]
+            rows['t'], rows['veh_id'], rows['zone'], rows['lane'] = t[start:end], veh_id[start:end], zone[start:end], lane[start:end]
+            rows['x'], rows['v'], rows['a'] = x[start:end], v[start:end], a[start:end]
+            self.n += end - start
+            start = end
+
+    def event(self, stream, **fields):
+        self.events.setdefault(stream, []).append({key: to_builtin(value) for key, value in fields.items()})
+
+    def flush(self):
+        '''Save the collected rows as the next chunk and the events recorded since the last flush, then the meta data'''
+        if not self.n and not self.events:
+            return
+        if self.n:
+            np.save(os.path.join(self.path, 'traj_%05d.npy' % self.chunk_count), self.buffer[:self.n])
+            self.chunk_count += 1
+            self.n = 0
+        if self.events:
+            with open(os.path.join(self.path, 'events_%05d.json' % self.event_chunk_count), 'w') as f:
+                json.dump(self.events, f)
+            self.event_chunk_count += 1
+            self.events = {}
+        self.write_meta(complete=False)
+
+    def write_meta(self, complete):
+        s = self.settings
+        meta = {
+            'columns': list(self.dtype.names),
+            'zones': list(ZONES),
+            'chunk_count': self.chunk_count,
+            'event_chunk_count': self.event_chunk_count,
+            'complete': complete,
+            'settings': {key: to_builtin(getattr(s, key)) for key in ('veh_dt', 'simu_t', 'arm_len', 'inter_control_mode',
+                'veh_param', 'cf_param', 'NS_lane_count', 'EW_lane_count', 'veh_gen_rule_table', 'lane_width', 'turn_radius')}
+        }
+        # Written aside and renamed, so that a reader never sees half of it
+        fname = os.path.join(self.path, 'meta.json')
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=1)
+        os.replace(fname + '.tmp', fname)
+
+    def close(self):
+        self.flush()
+        self.write_meta(complete=True)
+
+class NullRecorder:
+    '''No log at all, for runs that only need the metrics of SimulationContext.simulator.metrics'''
+    def record(self, t, veh_id, zone, lane, x, v, a):
+        pass
+
+    def record_many(self, t, veh_id, zone, lane, x, v, a):
+        pass
+
+    def event(self, stream, **fields):
+        pass
+
+    def close(self):
+        pass
+
+def to_builtin(value):
+    '''numpy scalars, arrays and tuples to plain json values'''
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (np.ndarray, list, tuple)):
+        return [to_builtin(v) for v in value]
+    if isinstance(value, dict):
+        return {k: to_builtin(v) for k, v in value.items()}
+    return value
+
+def make_recorder(ctx):
+    '''The recorder for the log format in the context's settings'''
+    if ctx.settings.log_format == 'none':
+        return NullRecorder()
+    if ctx.settings.log_format == 'binary':
+        if not ctx.log_fname:
+            raise ValueError("log_format = 'binary' needs a log_fname (the directory to write to)")
+        return BinaryRecorder(ctx.log_fname, ctx.settings)
+    return TextRecorder(ctx.logger)
+
+def is_binary_log(fname):
+    return os.path.isdir(fname)
+
+def load_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+def load_events(path, meta):
+    '''The event streams of a binary log, joined from its event chunks'''
+    events = {}
+    for i in range(meta.get('event_chunk_count', 0)):
+        with open(os.path.join(path, 'events_%05d.json' % i)) as f:
+            for (stream, records) in json.load(f).items():
+                events.setdefault(stream, []).extend(records)
+    return events
+
+def load_chunks(path, meta, mmap=True):
+    '''The trajectory chunks of a binary log in timestep order, memory-mapped unless mmap is False'''
+    return [np.load(os.path.join(path, 'traj_%05d.npy' % i), mmap_mode='r' if mmap else None) for i in range(meta['chunk_count'])]
+
+def load_trajectory(path, mmap=True):
+    '''
+    The rows of a binary log as the list of its chunks (load_chunks, each sorted by t and memory-mapped, so that only the rows
+    read are loaded), its event streams and its meta data
+    '''
+    meta = load_meta(path)
+    return load_chunks(path, meta, mmap), load_events(path, meta), meta
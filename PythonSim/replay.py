@@ -0,0 +1,193 @@
+import sys
+import time
+import types
+
+import numpy as np
+
+from context import snapshot_settings
+from map import Map
+from recorder import ZONE_CODE, is_binary_log, load_meta, load_events, load_chunks
+from snapshot import Snapshot
+
+class Replay:
+    '''
+    A run recorded with log_format = 'binary' (recorder.BinaryRecorder), played back as Snapshots for MyPaintCanvas.
+    Opening only reads meta.json and the events and memory-maps the trajectory chunks. The rows of settings.replay_window timesteps
+    around the shown one are read when they are needed, so a log of any length opens at once and seeking is a binary search.
+    The vehicle and junction events say on which arm and junction track each vehicle drives, the crash events which ones collided.
+    It stands in for the context of the canvas (settings and map of the recorded run) and for its runner: latest, pause,
+    resume, stop, plus seek, step and speed for moving around in the run.
+    '''
+    def __init__(self, path, window=None):
+        if not is_binary_log(path):
+            raise ValueError("%s is not a binary log, a replay needs one (log_format = 'binary'): a text log does not say on which arm a vehicle is" % path)
+        self.path = path
+        self.meta = load_meta(path)
+        self.events = load_events(path, self.meta)
+        self.settings = snapshot_settings(**self.meta['settings'])
+        self.map = Map(types.SimpleNamespace(settings=self.settings))
+        self.window = window or self.settings.replay_window
+
+        self.chunks = [chunk for chunk in load_chunks(path, self.meta) if len(chunk)]
+        self.chunk_first_t = np.array([chunk['t'][0] for chunk in self.chunks], dtype=np.int64)
+        self.chunk_last_t = np.array([chunk['t'][-1] for chunk in self.chunks], dtype=np.int64)
+        self.first_t = 0 # Before the first row, the arms are empty
+        self.last_t = int(self.chunk_last_t[-1]) if self.chunks else 0
+        self.init_vehicles()
+
+        self.rows = None # Rows of the timesteps rows_start .. rows_end - 1
+        self.rows_start = self.rows_end = None
+        self.cached = None # (timestep, Snapshot)
+
+        self.position = self.first_t # The timestep shown, fractional while playing
+        self.speed = self.settings.time_wrap # Simulated seconds per wall second
+        self.playing = False
+        self.wall_start = None
+        self.position_start = None
+
+    def init_vehicles(self):
+        '''Per vehicle (indexed by veh_id): approach and exit arm, junction track, faulty, first timestep listed in a crash'''
+        vehicles = self.events.get('vehicle', [])
+        n = max([event['veh_id'] for event in vehicles], default=-1) + 1
+        self.ap_arm = np.full(n, '', dtype='<U1')
+        self.ex_arm = np.full(n, '', dtype='<U1')
+        self.faulty = np.zeros(n, dtype=bool)
+        self.crash_t = np.full(n, np.inf)
+        self.tracks = {}
+        for event in vehicles:
+            k = event['veh_id']
+            self.ap_arm[k] = event['ap_arm']
+            self.ex_arm[k] = self.map.get_ex_arm(event['ap_arm'], event['turn_dir'])
+            self.faulty[k] = event['faulty']
+        for event in self.events.get('junction', []):
+            self.tracks[event['veh_id']] = event['track']
+        for event in self.events.get('crash', []):
+            for k in event['veh_ids']:
+                self.crash_t[k] = min(self.crash_t[k], event['t'])
+
+    def load_window(self, t):
+        '''Read the rows of the window of timesteps that holds t, and of one timestep on either side, from the chunks that overlap it'''
+        start = t - (t - self.first_t) % self.window
+        end = start + self.window
+        parts = []
+        for k in np.flatnonzero((self.chunk_last_t >= start - 1) & (self.chunk_first_t < end + 1)):
+            chunk_t = self.chunks[k]['t']
+            lo, hi = np.searchsorted(chunk_t, start - 1), np.searchsorted(chunk_t, end + 1)
+            parts.append(np.array(self.chunks[k][lo:hi]))
+        self.rows = np.concatenate(parts) if parts else np.zeros(0, dtype=self.chunks[0].dtype if self.chunks else None)
+        self.rows_start, self.rows_end = start, end
+
+    def frame_rows(self, t):
+        '''
+        The rows of timestep t. A vehicle has no row on the timestep it enters or leaves the junction (Vehicle.move), it is
+        kept at its row of the timestep before, so that it does not blink.
+        '''
+        if self.rows is None or not self.rows_start <= t < self.rows_end:
+            self.load_window(t)
+        lo, mid, hi, end = np.searchsorted(self.rows['t'], [t - 1, t, t + 1, t + 2])
+        rows, before, after = self.rows[mid:hi], self.rows[lo:mid], self.rows[hi:end]
+        switching = np.isin(before['veh_id'], after['veh_id']) & ~np.isin(before['veh_id'], rows['veh_id'])
+        if switching.any():
+            rows = np.concatenate([rows, before[switching]])
+        return rows
+
+    def snapshot(self, t):
+        '''The Snapshot of timestep t of the recorded run'''
+        t = int(min(max(t, self.first_t), self.last_t))
+        if self.cached and self.cached[0] == t:
+            return self.cached[1]
+        rows = self.frame_rows(t)
+        veh_id, zone, lane, x_1d = rows['veh_id'].astype(np.int64), rows['zone'], rows['lane'].astype(np.int64), rows['x']
+        n = len(rows)
+        x, y, angle = np.zeros(n), np.zeros(n), np.zeros(n)
+        for (code, zone_name, arm_of) in ((ZONE_CODE['ap'], 'ap', self.ap_arm), (ZONE_CODE['ex'], 'ex', self.ex_arm)):
+            in_zone = zone == code
+            if not in_zone.any():
+                continue
+            arms = arm_of[veh_id]
+            for arm in 'NSEW':
+                idx = np.flatnonzero(in_zone & (arms == arm))
+                if len(idx):
+                    x[idx], y[idx], angle[idx] = self.map.arm_poses(arm + zone_name, lane[idx], x_1d[idx])
+        in_junction = zone == ZONE_CODE['ju']
+        by_track = {}
+        for k in np.flatnonzero(in_junction):
+            by_track.setdefault(self.tracks.get(int(veh_id[k])), []).append(k)
+        for (track_key, idx) in by_track.items():
+            if track_key is not None:
+                x[idx], y[idx], angle[idx] = self.map.pose_at(track_key, x_1d[idx])
+        veh_param = self.settings.veh_param
+        snapshot = Snapshot(
+            t, False, veh_id, x, y, angle,
+            np.full(n, veh_param['veh_wid'], dtype=float), np.full(n, veh_param['veh_len'], dtype=float),
+            np.full(n, veh_param['veh_len_front'], dtype=float),
+            in_junction, self.faulty[veh_id], self.crash_t[veh_id] <= t
+        )
+        self.cached = (t, snapshot)
+        return snapshot
+
+    def current(self):
+        '''The timestep shown now'''
+        if self.playing:
+            self.position = self.position_start + (time.perf_counter() - self.wall_start) * self.speed / self.settings.veh_dt
+            if self.position >= self.last_t:
+                self.position = self.last_t
+                self.playing = False
+        return int(self.position)
+
+    def latest(self):
+        return self.snapshot(self.current())
+
+    def start(self):
+        self.resume()
+
+    def resume(self):
+        if self.position >= self.last_t:
+            self.position = self.first_t
+        self.position_start = self.position
+        self.wall_start = time.perf_counter()
+        self.playing = True
+
+    def pause(self):
+        self.current()
+        self.playing = False
+
+    def stop(self):
+        self.pause()
+
+    def seek(self, t):
+        '''Show timestep t from now on (playing on from there if playing)'''
+        self.position = min(max(t, self.first_t), self.last_t)
+        if self.playing:
+            self.resume()
+
+    def step(self, frames):
+        '''Pause and move frames timesteps forward (backward if negative)'''
+        self.pause()
+        self.seek(int(self.position) + frames)
+
+    def set_speed(self, speed):
+        '''Play speed in simulated seconds per wall second'''
+        self.current()
+        self.speed = speed
+        if self.playing:
+            self.resume()
+
+    def crash_times(self):
+        '''The timesteps at which vehicles first collided, to seek to'''
+        return sorted(set(self.crash_t[np.isfinite(self.crash_t)].astype(int).tolist()))
+
+if __name__ == '__main__':
+    # python replay.py <binary log directory> [speed] [start time (s)]
+    from PyQt5.QtWidgets import QApplication
+    from my_main_window import MyMainWindow
+
+    replay = Replay(sys.argv[1])
+    if len(sys.argv) > 2:
+        replay.set_speed(float(sys.argv[2]))
+    if len(sys.argv) > 3:
+        replay.seek(int(round(float(sys.argv[3]) / replay.settings.veh_dt)))
+    app = QApplication(sys.argv)
+    window = MyMainWindow(replay=replay)
+    window.show()
+    app.exec_()
@@ -1,8 +1,14 @@
-import subprocess
-import time 
+import os
+import time
 
-simu_result_file = 'log\simu_result' + time.strftime("%Y-%m-%d %H-%M-%S")
+import lib.settings
+from sweep import make_grid, sweep, summarise, print_summary
 
-for total_flow in [720, 1440, 2880, 4320, 5760]:
-    out_bytes = subprocess.check_output(['python', 'main.py', str(total_flow)])
-    
\ No newline at end of file
+if __name__ == '__main__':
+    # One run of the configured control mode (lib.settings.inter_control_mode) at each total flow, on all cores
+    simu_result_file = os.path.join('log', 'simu_result ' + time.strftime("%Y-%m-%d %H-%M-%S") + '.jsonl')
+    os.makedirs('log', exist_ok=True)
+
+    runs = make_grid([lib.settings.inter_control_mode], [720, 1440, 2880, 4320, 5760], seeds=range(1))
+    results = sweep(runs, simu_result_file)
+    print_summary(summarise(results))
@@ -1,33 +1,29 @@
-import copy
-import logging
-
-from vehicle import Vehicle
-from inter_manager import inter_manager
-from lib.settings import arm_len, veh_dt, veh_param, cf_param, NS_lane_count, EW_lane_count, veh_gen_rule_table, min_gen_hs, gen_init_v, crashValues
+import heapq
 import random
+import bisect
+from collections import deque
 
-import numpy as np
+from metrics import MetricsAccumulator
+from profiler import PhaseProfiler
+from demand import DemandSchedule
 
 class Simulator:
-    _instance = None
-
     @staticmethod 
     def getInstance():
-        if Simulator._instance == None:
-            Simulator()
-        return Simulator._instance
+        '''Simulator of the default simulation context'''
+        from context import SimulationContext
+        return SimulationContext.get_default().simulator
     
     def get_sim_over(self):
         return self.sim_over
 
-    def __init__(self):
-        if Simulator._instance != None:
-            raise Exception("This class is a singleton, but more than one objects are created.")
-        else:
-            Simulator._instance = self
+    def __init__(self, ctx):
+        self.ctx = ctx
 
         self.timestep = 0
-        self.random_count = random.randint(25, 35)
+        # The vehicleCount at which the faulty vehicle is generated, None when faults are disabled
+        fault_veh_range = ctx.settings.fault_veh_range
+        self.random_count = ctx.random.randint(*fault_veh_range) if fault_veh_range else None
         self.crash_count=0
         self.crash_time=2000
         self.sim_over=False
@@ -36,7 +32,9 @@ class Simulator:
         self.gen_veh_count = 0  
         # For vehicle queues that are not placed in the simulation area for each lane, refer to the Meng2018Analysis article
         self.point_queue_table = self.init_point_queue_table()
-        # Vehicles in the simulation area
+        # Arrivals at the point queues generated ahead (demand.py), None draws them every timestep in gen_new_veh
+        self.demand = DemandSchedule.from_settings(ctx)
+        # Vehicles in the simulation area, by group in the order they entered it (lane_queues keeps them in order along each lane)
         self.all_veh = {
             'Nap': [],
             'Sap': [],
@@ -48,9 +46,25 @@ class Simulator:
             'Wex': [],
             'ju': []
         }
+        # Vehicles that follow each other (same lane of an arm, same track in the junction), kept sorted by x, see queue_key
+        self.lane_queues = {}
+        self.veh_queue_key = {}
+        self.group_queue_keys = {group: [] for group in self.all_veh} # The keys of each group's queues, sorted
         self.vehicleCount=0
+        # Delay and throughput, updated as vehicles leave
+        self.metrics = MetricsAccumulator(ctx)
+        # Wall time of each phase of update, None unless settings.profile
+        self.profiler = PhaseProfiler(ctx) if ctx.settings.profile else None
+        # Boundaries with the other intersections of a network (network.py): vehicles leaving on linked_arms are collected in
+        # handoffs, vehicles from upstream join the point queues of fed_arms through hand_in
+        self.linked_arms = ctx.settings.linked_arms
+        self.handoffs = []
+        self.routes = self.init_routes()
+        self.route_random = random.Random('route %s' % ctx.seed) if self.routes else None
 
     def update(self):
+        if self.profiler:
+            return self.update_profiled()
         self.check_for_collisions()
         self.timestep += 1
         # print('Timestep: %d' % self.timestep)
@@ -65,18 +79,52 @@ class Simulator:
         self.update_all_control()
         # print('update_all_control')
 
-        inter_manager.update()
+        self.ctx.inter_manager.update()
+        if self.ctx.com.queued:
+            self.ctx.com.deliver(self.timestep)
 
         if self.check_for_finish():
             #finsh the simulation
             #insert code here 
             self.sim_over=True
 
+    def update_profiled(self):
+        '''update, with the wall time and the vehicles handled of each phase recorded by the profiler'''
+        profiler = self.profiler
+        profiler.start()
+        self.check_for_collisions()
+        profiler.lap(len(self.all_veh['ju']))
+        self.timestep += 1
+        to_switch_group = self.all_update_position()
+        veh_count = sum(len(vehs) for vehs in self.all_veh.values())
+        profiler.lap(veh_count)
+        self.update_group(to_switch_group)
+        profiler.lap(len(to_switch_group))
+        gen_veh_count = self.gen_veh_count
+        self.gen_new_veh()
+        profiler.lap(self.gen_veh_count - gen_veh_count)
+        finish_count = self.metrics.finish_count
+        self.remove_out_veh()
+        profiler.lap(self.metrics.finish_count - finish_count)
+        veh_count = sum(len(vehs) for vehs in self.all_veh.values())
+        self.update_all_control()
+        profiler.lap(veh_count)
+
+        self.ctx.inter_manager.update()
+        if self.ctx.com.queued:
+            self.ctx.com.deliver(self.timestep)
+        profiler.lap(0)
+        profiler.stop(self.timestep, veh_count)
+
+        if self.check_for_finish():
+            self.sim_over=True
+
     def check_for_collisions(self):
-        crashed_vehicles= inter_manager.check_for_collision(self.all_veh["ju"])
+        crashed_vehicles= self.ctx.inter_manager.check_for_collision(self.all_veh["ju"])
         
         self.crash_count= len(crashed_vehicles)
-        if inter_manager.check_for_collision_noCars() and self.crash_time==2000:
+        self.metrics.on_crash(crashed_vehicles)
+        if self.ctx.inter_manager.check_for_collision_noCars() and self.crash_time==2000:
             self.crash_time=self.timestep+100
 
 
@@ -87,11 +135,14 @@ class Simulator:
     def check_for_finish(self):
         if self.timestep >= self.crash_time:
             return True
+        if self.metrics.converged():
+            return True
         
 
     def all_update_position(self):
         '''For the vehicles in all_veh, update the location and record the vehicles whose grouping has changed'''
         to_switch_group = []
+        veh_dt = self.ctx.settings.veh_dt
         for group, vehs in self.all_veh.items():
             for veh in vehs:
                 switch_group = veh.update_position(veh_dt)
@@ -100,21 +151,83 @@ class Simulator:
         return to_switch_group
     
     def update_group(self, to_switch_group):
-        '''Update the group of vehicles and sort them by location within the lane'''
+        '''Move the vehicles that changed zone to their new group, and to their new queue in place by x (switch_queue)'''
+        self.reorder_queues()
         for veh, old_group in to_switch_group:
             if veh.zone == 'ju':
                 new_group = 'ju'
+                # The junction track is fixed from now on, replay.py places the vehicle on it
+                self.ctx.recorder.event('junction', t=self.timestep, veh_id=veh._id, track=veh.track.key)
             elif veh.zone == 'ex':
                 new_group = str(veh.track.ex_arm) + 'ex'
             self.all_veh[new_group].append(veh)
             self.all_veh[old_group].remove(veh)
+            self.switch_queue(veh)
 
-        for group, vehs in self.all_veh.items():
-            vehs.sort(key=lambda veh: veh.inst_x) # Sort by x from small to large
+    def queue_key(self, veh):
+        '''Vehicles with the same key follow each other: the same lane of an arm, or the same track in the junction'''
+        # At the intersection, there is no concept of lanes here, but in order to prevent two cars with the same trajectory from colliding, they are still considered to be in the same lane.
+        if veh.zone == 'ju':
+            track = veh.track
+            return 'ju' + track.ap_arm + track.turn_dir + str(track.ap_lane) + str(track.ex_lane)
+        elif veh.zone == 'ap':
+            return veh.track.ap_arm + 'ap' + str(veh.inst_lane)
+        return veh.track.ex_arm + 'ex' + str(veh.inst_lane)
+
+    def get_queue(self, key):
+        '''The queue of key, created empty on first use'''
+        queue = self.lane_queues.get(key)
+        if queue is None:
+            queue = self.lane_queues[key] = []
+            bisect.insort(self.group_queue_keys['ju' if key.startswith('ju') else key[:3]], key)
+        return queue
+
+    def add_to_queue(self, veh):
+        '''A new vehicle enters at the back (smallest x) of its lane'''
+        key = self.queue_key(veh)
+        self.get_queue(key).insert(0, veh)
+        self.veh_queue_key[veh._id] = key
+
+    def remove_from_queue(self, veh):
+        queue = self.lane_queues[self.veh_queue_key.pop(veh._id)]
+        if queue[-1] is veh: # Usually the front vehicle leaves
+            queue.pop()
+        else:
+            queue.remove(veh)
+
+    def reorder_queues(self):
+        '''
+        Vehicles in a queue hardly ever pass each other, but they can (Xu's vehicles on a junction track follow their virtual
+        platoon, not the vehicle in front). One insertion sort pass per queue moves the few that did, linear when none did
+        '''
+        for queue in self.lane_queues.values():
+            for i in range(1, len(queue)):
+                veh = queue[i]
+                k = i
+                while k > 0 and queue[k - 1].inst_x > veh.inst_x:
+                    k -= 1
+                if k < i:
+                    del queue[i]
+                    queue.insert(k, veh)
+
+    def switch_queue(self, veh):
+        '''
+        The vehicle changed zone, insert it by x into the queue of its new lane or junction track. It joins near the back (it just
+        entered), after reorder_queues the rest of the queue is in order
+        '''
+        self.remove_from_queue(veh)
+        key = self.queue_key(veh)
+        queue = self.get_queue(key)
+        k = 0
+        while k < len(queue) and queue[k].inst_x <= veh.inst_x:
+            k += 1
+        queue.insert(k, veh)
+        self.veh_queue_key[veh._id] = key
 
     def remove_out_veh(self):
         '''Delete vehicles that run out of the simulation area'''
         to_delete = []
+        arm_len = self.ctx.settings.arm_len
         for group, vehs in self.all_veh.items():
             if group[-2:] == 'ex':
                 for veh in vehs:
@@ -122,46 +235,86 @@ class Simulator:
                         to_delete.append([group, veh])
         for group, veh in to_delete:
             self.all_veh[group].remove(veh)
+            self.remove_from_queue(veh)
+            self.metrics.on_remove(veh)
+            self.hand_off(veh)
+
+    def hand_off(self, veh):
+        '''A vehicle that left on an exit arm leading to a downstream intersection is recorded as (ex_arm, ex_lane, veh_id)'''
+        ex_arm = veh.track.ex_arm
+        if ex_arm in self.linked_arms:
+            self.handoffs.append((ex_arm, veh.inst_lane, veh._id))
+            self.ctx.recorder.event('handoff', t=self.timestep, veh_id=veh._id, ex_arm=ex_arm, ex_lane=veh.inst_lane)
+
+    def init_routes(self):
+        '''
+        For each arm of settings.fed_arms, the (lane, turn_dir) choices of the vehicles handed in and their weights,
+        the flows of veh_gen_rule_table (which still has to hold a flow for every turn taken, the map only builds those tracks)
+        '''
+        s = self.ctx.settings
+        routes = {}
+        for ap_arm in s.fed_arms:
+            choices, weights = [], []
+            for turn_dir in 'lrt':
+                for (lane, flow) in enumerate(s.veh_gen_rule_table[ap_arm + turn_dir]):
+                    if flow > 0:
+                        choices.append((lane, turn_dir))
+                        weights.append(flow)
+            if not choices:
+                raise ValueError('Arm %s is fed by an upstream intersection but has no flow in veh_gen_rule_table' % ap_arm)
+            routes[ap_arm] = (choices, weights)
+        return routes
+
+    def hand_in(self, ap_arm, count):
+        '''count vehicles handed off by the upstream intersection join the point queues of ap_arm, with a lane and turn drawn by routes'''
+        choices, weights = self.routes[ap_arm]
+        for (lane, turn_dir) in self.route_random.choices(choices, weights, k=count):
+            self.point_queue_table[ap_arm + str(lane)].appendleft(turn_dir)
 
     def init_point_queue_table(self):
         point_queue_table = {}
-        for i in range(NS_lane_count):
-            point_queue_table['N' + str(i)] = [] # #The elements in the list are the steering directions of each vehicle to be generated
-            point_queue_table['S' + str(i)] = []
-        for i in range(EW_lane_count):
-            point_queue_table['E' + str(i)] = []
-            point_queue_table['W' + str(i)] = []
+        for i in range(self.ctx.settings.NS_lane_count):
+            point_queue_table['N' + str(i)] = deque() # #The elements are the steering directions of each vehicle to be generated, the next one on the right
+            point_queue_table['S' + str(i)] = deque()
+        for i in range(self.ctx.settings.EW_lane_count):
+            point_queue_table['E' + str(i)] = deque()
+            point_queue_table['W' + str(i)] = deque()
         return point_queue_table       
 
     def gen_new_veh(self): 
         '''Generate new vehicles in point_queue according to probability, and if feasible, put a vehicle into the simulation area'''
-        for ap_arm in 'NSEW': # Each import road
-            for turn_dir in 'lrt': # All directions
-                flows = veh_gen_rule_table[ap_arm + turn_dir]
-                for (lane, flow) in enumerate(flows):  # lane lane
-                    prob = flow / 3600 * veh_dt
-                    if np.random.rand() < prob:
-                        self.point_queue_table.get(ap_arm + str(lane),[]).insert(0, turn_dir)
+        s = self.ctx.settings
+        # Arms fed by an upstream intersection get their vehicles from hand_in only, their arrivals are drawn all the same
+        # so that the random streams do not depend on the network
+        if self.demand:
+            for (ap_arm, lane, turn_dir) in self.demand.arrivals(self.timestep):
+                if ap_arm not in s.fed_arms:
+                    self.point_queue_table.get(ap_arm + str(lane), deque()).appendleft(turn_dir)
+        else:
+            for ap_arm in 'NSEW': # Each import road
+                for turn_dir in 'lrt': # All directions
+                    flows = s.veh_gen_rule_table[ap_arm + turn_dir]
+                    for (lane, flow) in enumerate(flows):  # lane lane
+                        prob = flow / 3600 * s.veh_dt
+                        if self.ctx.np_random.rand() < prob and ap_arm not in s.fed_arms:
+                            self.point_queue_table.get(ap_arm + str(lane), deque()).appendleft(turn_dir)
         for ap_arm_lane, queue in self.point_queue_table.items():
             ap_arm = ap_arm_lane[0]
             lane = int(ap_arm_lane[1])
-            latest_veh = None 
-            for some_veh in self.all_veh[ap_arm + 'ap']:
-                if some_veh.inst_lane == lane:
-                    latest_veh = some_veh
-                    break
-            if not latest_veh or (latest_veh.inst_x - (-arm_len)) > min_gen_hs:
+            lane_queue = self.lane_queues.get(ap_arm + 'ap' + str(lane))
+            latest_veh = lane_queue[0] if lane_queue else None # The last vehicle that entered this lane
+            if not latest_veh or (latest_veh.inst_x - (-s.arm_len)) > s.min_gen_hs:
                 if len(queue) > 0: 
                     new_veh = self.make_veh(ap_arm, lane, queue.pop())
                     self.all_veh[ap_arm + 'ap'].insert(0, new_veh)
+                    self.add_to_queue(new_veh)
                     
     def make_veh(self, ap_arm, ap_lane, turn_dir):
         '''Create a vehicle object and return'''
+        s = self.ctx.settings
         self.vehicleCount+=1
-        new_veh_param = copy.deepcopy(veh_param)
-        new_veh_param['ap_arm'] = ap_arm
-        new_veh_param['ap_lane'] = ap_lane
-        new_veh_param['turn_dir'] = turn_dir
+        # veh_param only holds numbers, the vehicle reads it and keeps none of it
+        new_veh_param = dict(s.veh_param, ap_arm=ap_arm, ap_lane=ap_lane, turn_dir=turn_dir)
         faultCar=False
  
 
@@ -169,28 +322,26 @@ class Simulator:
             faultCar = True
 
 
-        new_veh = Vehicle(self.gen_veh_count, new_veh_param, cf_param, gen_init_v, self.timestep,faultCar,crashValues["crashOccured"])
+        new_veh = self.ctx.Vehicle(self.ctx, self.gen_veh_count, new_veh_param, s.cf_param, s.gen_init_v, self.timestep,faultCar,s.crashValues["crashOccured"])
+        self.metrics.on_generate(new_veh, self.timestep)
+        self.ctx.recorder.event('vehicle', t=self.timestep, veh_id=self.gen_veh_count, ap_arm=ap_arm, ap_lane=ap_lane, turn_dir=turn_dir, faulty=faultCar)
         self.gen_veh_count += 1
         return new_veh
 
+    def control_order(self):
+        '''
+        All vehicles with the vehicle in front of them in their queue (None at the front): group by group in all_veh order, and
+        within a group by x from small to large, merged from the group's queues (on a tie, the one with the larger key first)
+        '''
+        for group in self.all_veh:
+            queues = [self.lane_queues[key] for key in reversed(self.group_queue_keys[group])]
+            walks = [[(veh, queue[i + 1] if i + 1 < len(queue) else None) for (i, veh) in enumerate(queue)] for queue in queues if queue]
+            if len(walks) == 1:
+                yield from walks[0]
+            else:
+                yield from heapq.merge(*walks, key=lambda pair: pair[0].inst_x)
+
     def update_all_control(self):
-        '''All vehicles update their vehicle control status independently'''
-        for group, vehs in self.all_veh.items():
-            for (i, veh) in enumerate(vehs):
-                lead_veh = None
-                if group != 'ju': # entrance and exit
-                    for j in range(i+1, len(vehs)):
-                        if vehs[j].inst_lane == veh.inst_lane:
-                            lead_veh = vehs[j]
-                            break
-                else: # At the intersection, there is no concept of lanes here, but in order to prevent two cars with the same trajectory from colliding, they are still considered to be in the same lane.
-                    for j in range(i+1, len(vehs)):
-                        if vehs[j].track.ap_arm == veh.track.ap_arm and vehs[j].track.ap_lane == veh.track.ap_lane \
-                            and vehs[j].track.turn_dir == veh.track.turn_dir and vehs[j].track.ex_lane == veh.track.ex_lane:
-                            lead_veh = vehs[j]
-                            break
-                veh.update_control(lead_veh)
-
-
-
-    
\ No newline at end of file
+        '''All vehicles update their vehicle control status independently, in the order of control_order, each following the next one in its queue'''
+        for (veh, lead_veh) in self.control_order():
+            veh.update_control(lead_veh)
@@ -0,0 +1,207 @@
+import os
+import time
+import threading
+import multiprocessing
+
+import numpy as np
+
+class Snapshot:
+    '''
+    The vehicles of one timestep as read-only arrays, all that the canvas draws: the point and heading (degrees clockwise
+    from north) of each vehicle (Map.arm_poses, Map.veh_poses), its size, whether it is in the junction, faulty or collided.
+    finished is True for the last snapshot of a run.
+    '''
+    __slots__ = ('timestep', 'finished', 'veh_id', 'x', 'y', 'angle', 'veh_wid', 'veh_len', 'veh_len_front', 'in_junction', 'faulty', 'collided')
+
+    def __init__(self, timestep, finished, veh_id, x, y, angle, veh_wid, veh_len, veh_len_front, in_junction, faulty, collided):
+        self.timestep = timestep
+        self.finished = finished
+        self.veh_id = veh_id
+        self.x = x
+        self.y = y
+        self.angle = angle
+        self.veh_wid = veh_wid
+        self.veh_len = veh_len
+        self.veh_len_front = veh_len_front
+        self.in_junction = in_junction
+        self.faulty = faulty
+        self.collided = collided
+        for name in self.__slots__[2:]:
+            getattr(self, name).flags.writeable = False
+
+    def __len__(self):
+        return len(self.veh_id)
+
+    def __reduce__(self):
+        # Through __init__, so that the arrays are read-only in the receiving process too
+        return Snapshot, tuple(getattr(self, name) for name in self.__slots__)
+
+    @staticmethod
+    def take(ctx, finished=False):
+        '''The snapshot of the current timestep of ctx'''
+        sim = ctx.simulator
+        groups = [(group, vehs) for (group, vehs) in sim.all_veh.items() if vehs]
+        vehs = [veh for (group, group_vehs) in groups for veh in group_vehs]
+        n = len(vehs)
+        x, y, angle = np.zeros(n), np.zeros(n), np.zeros(n)
+        in_junction = np.zeros(n, dtype=bool)
+        start = 0
+        for (group, group_vehs) in groups:
+            end = start + len(group_vehs)
+            if group == 'ju':
+                x[start:end], y[start:end], angle[start:end] = ctx.map.veh_poses(group_vehs)
+                in_junction[start:end] = True
+            else:
+                lane = np.array([veh.inst_lane for veh in group_vehs])
+                inst_x = np.array([veh.inst_x for veh in group_vehs])
+                x[start:end], y[start:end], angle[start:end] = ctx.map.arm_poses(group, lane, inst_x)
+            start = end
+        return Snapshot(
+            sim.timestep, finished,
+            np.array([veh._id for veh in vehs], dtype=np.int64), x, y, angle,
+            np.array([veh.veh_wid for veh in vehs], dtype=float),
+            np.array([veh.veh_len for veh in vehs], dtype=float),
+            np.array([veh.veh_len_front for veh in vehs], dtype=float),
+            in_junction,
+            np.array([bool(veh.faultyCar) for veh in vehs], dtype=bool),
+            np.array([bool(veh.collidedCar) for veh in vehs], dtype=bool)
+        )
+
+class SnapshotBuffer:
+    '''
+    Double buffer of snapshots between one writer and any number of readers: publish fills the back slot and swaps it to the front,
+    latest returns the front one. The lock is only held for the swap, and a snapshot is never changed once published,
+    so a reader can keep drawing the one it got while the next ones come in.
+    '''
+    def __init__(self):
+        self.slots = [None, None]
+        self.front = 0
+        self.published = 0
+        self.lock = threading.Lock()
+
+    def publish(self, snapshot):
+        back = 1 - self.front
+        self.slots[back] = snapshot
+        with self.lock:
+            self.front = back
+            self.published += 1
+
+    def latest(self):
+        with self.lock:
+            return self.slots[self.front]
+
+def run_loop(ctx, publish, running, stopped, time_wrap):
+    '''
+    Step ctx until simu_t, the end after a crash, or until stopped is set, waiting while running is cleared.
+    The simulated time runs time_wrap times as fast as the wall clock (as fast as possible when the simulation cannot keep up,
+    or with time_wrap = None). A snapshot is published at most every disp_dt of wall time, and at the end.
+    '''
+    s = ctx.settings
+    sim = ctx.simulator
+    max_timestep = s.simu_t / s.veh_dt
+    tick = s.veh_dt / time_wrap if time_wrap else 0
+    clock = time.perf_counter
+    publish(Snapshot.take(ctx))
+    deadline = next_publish = clock()
+    while not stopped.is_set() and sim.timestep < max_timestep and not sim.get_sim_over():
+        if not running.is_set():
+            running.wait(0.1)
+            deadline = clock()
+            continue
+        sim.update()
+        now = clock()
+        if now >= next_publish:
+            publish(Snapshot.take(ctx))
+            next_publish = now + s.disp_dt
+        if tick:
+            deadline += tick
+            if deadline > now:
+                time.sleep(deadline - now)
+            elif now - deadline > 1:
+                # Too far behind to catch up, keep the pace from now on
+                deadline = now
+    publish(Snapshot.take(ctx, finished=True))
+    ctx.close()
+
+class SimulationThread:
+    '''Steps a context in a worker thread (run_loop) and keeps its snapshots in a SnapshotBuffer'''
+    def __init__(self, ctx, time_wrap=None):
+        self.buffer = SnapshotBuffer()
+        self.running = threading.Event()
+        self.running.set()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=run_loop, args=(ctx, self.buffer.publish, self.running, self.stopped, time_wrap), daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def latest(self):
+        return self.buffer.latest()
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def stop(self):
+        '''Stop stepping and wait for the last snapshot'''
+        self.stopped.set()
+        self.running.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+def process_main(ctx, conn, running, stopped, time_wrap):
+    run_loop(ctx, conn.send, running, stopped, time_wrap)
+    conn.close()
+
+class SimulationProcess(SimulationThread):
+    '''
+    Steps a context in a forked worker process, which takes the context over as it is (its log included). The snapshots come
+    through a pipe, a thread of this process receives them into the SnapshotBuffer, so neither side ever waits for the other.
+    The context in this process is not stepped any more.
+    '''
+    def __init__(self, ctx, time_wrap=None):
+        mp_context = multiprocessing.get_context('fork')
+        self.buffer = SnapshotBuffer()
+        self.running = mp_context.Event()
+        self.running.set()
+        self.stopped = mp_context.Event()
+        self.conn, child_conn = mp_context.Pipe(duplex=False)
+        self.process = mp_context.Process(target=process_main, args=(ctx, child_conn, self.running, self.stopped, time_wrap), daemon=True)
+        self.child_conn = child_conn
+        self.thread = threading.Thread(target=self.receive, daemon=True)
+
+    def start(self):
+        self.process.start()
+        self.child_conn.close()
+        self.thread.start()
+
+    def receive(self):
+        while True:
+            try:
+                snapshot = self.conn.recv()
+            except EOFError:
+                break
+            self.buffer.publish(snapshot)
+
+    def stop(self):
+        self.stopped.set()
+        self.running.set()
+        if self.process.is_alive():
+            self.process.join()
+        if self.thread.is_alive():
+            self.thread.join()
+
+def make_runner(ctx):
+    '''The runner of settings.gui_runner for ctx (not started yet), None for 'timer' '''
+    s = ctx.settings
+    if s.gui_runner == 'timer':
+        return None
+    if s.gui_runner == 'process' and hasattr(os, 'fork'):
+        return SimulationProcess(ctx, s.time_wrap)
+    if s.gui_runner == 'process':
+        print('gui_runner = \'process\' needs os.fork, the simulation runs in a thread')
+    elif s.gui_runner != 'thread':
+        raise ValueError('Unknown gui_runner: %s' % s.gui_runner)
+    return SimulationThread(ctx, s.time_wrap)
@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import itertools
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from recorder import to_builtin
+
+def make_grid(modes, total_flows, turn_splits=((0.25, 0.5, 0.25),), seeds=range(10), faults=((25, 35),), **overrides):
+    '''
+    Every combination of (control mode, total flow, turn split, seed, fault config) as a list of run descriptions.
+    A fault config is a fault_veh_range, None disables fault injection. overrides are extra settings shared by all runs.
+    '''
+    runs = []
+    for mode, total_flow, turn_split, seed, fault in itertools.product(modes, total_flows, turn_splits, seeds, faults):
+        runs.append({
+            'mode': mode,
+            'total_flow': total_flow,
+            'turn_split': list(turn_split),
+            'seed': seed,
+            'fault': list(fault) if fault else None,
+            'overrides': overrides
+        })
+    return runs
+
+def run_key(run):
+    '''Identifies a run in the results file, used to skip finished runs when a sweep is resumed'''
+    return json.dumps([run['mode'], run['total_flow'], run['turn_split'], run['seed'], run['fault'], run['overrides']], sort_keys=True)
+
+def run_one(run, log_dir='log', keep_logs=False, log_format='none'):
+    '''
+    Run a single simulation in this process and return the run description merged with its metrics (or the error).
+    The log format does not change the results, so it is not part of the run description.
+    '''
+    from headless import run_headless
+
+    result = dict(run)
+    start = time.time()
+    try:
+        overrides = dict(run['overrides'])
+        overrides['fault_veh_range'] = tuple(run['fault']) if run['fault'] else None
+        overrides['log_format'] = log_format
+        metrics = run_headless(run['mode'], run['total_flow'], run['seed'], log_dir, tuple(run['turn_split']), **overrides)
+        if not keep_logs:
+            if metrics['log_fname']:
+                for fname in (metrics['log_fname'], os.path.splitext(metrics['log_fname'])[0] + '.png'):
+                    if os.path.isdir(fname):
+                        shutil.rmtree(fname)
+                    elif os.path.exists(fname):
+                        os.remove(fname)
+            metrics.pop('log_fname')
+        metrics['crash_list_length'] = len(metrics['longest_crash_list'])
+        result['metrics'] = to_builtin(metrics)
+    except Exception:
+        result['error'] = traceback.format_exc()
+    result['wall_time'] = time.time() - start
+    return result
+
+def load_results(results_fname):
+    '''Results already in the file, keyed by run_key'''
+    results = {}
+    if os.path.exists(results_fname):
+        with open(results_fname) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    result = json.loads(line)
+                    results[run_key(result)] = result
+    return results
+
+def sweep(runs, results_fname, workers=None, log_dir='log', keep_logs=False, retry_errors=False, log_format='none'):
+    '''
+    Fan the runs out over a process pool (all cores by default). Every finished run is appended to results_fname as one json line,
+    so an interrupted sweep resumes where it stopped when called again with the same file. Returns all results of the runs.
+    '''
+    done = load_results(results_fname)
+    if retry_errors:
+        done = {key: result for key, result in done.items() if 'error' not in result}
+    todo = [run for run in runs if run_key(run) not in done]
+    print('%d runs, %d already done, %d to go' % (len(runs), len(runs) - len(todo), len(todo)))
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool, open(results_fname, 'a') as f:
+            futures = [pool.submit(run_one, run, log_dir, keep_logs, log_format) for run in todo]
+            for (i, future) in enumerate(as_completed(futures)):
+                result = future.result()
+                done[run_key(result)] = result
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+                status = 'error' if 'error' in result else 'avg_delay = %.2f' % result['metrics']['avg_delay']
+                print('[%d/%d] %s %d seed %s: %s (%.1f s)' % (i + 1, len(todo), result['mode'], result['total_flow'], result['seed'], status, result['wall_time']))
+    return [done[run_key(run)] for run in runs]
+
+def summarise(results, by=('mode', 'total_flow'), keys=('crash_list_length', 'avg_delay', 'max_delay', 'actual_total_flow')):
+    '''Average of each metric over the runs that share the same values of the "by" fields'''
+    groups = {}
+    for result in results:
+        if 'metrics' not in result:
+            continue
+        groups.setdefault(tuple(json.dumps(result[b]) for b in by), []).append(result['metrics'])
+    summary = []
+    for group, metrics_list in groups.items():
+        row = {b: json.loads(g) for b, g in zip(by, group)}
+        row['runs'] = len(metrics_list)
+        for key in keys:
+            row[key] = float(np.mean([m[key] for m in metrics_list]))
+        summary.append(row)
+    return summary
+
+def print_summary(summary):
+    for row in summary:
+        print(', '.join('%s = %s' % (key, value) for key, value in row.items()))
+
+if __name__ == '__main__':
+    # python sweep.py --modes Dresner Xu light --flows 720 1440 2160 2880 3600 4320 5040 5760 --seeds 10 --out log/sweep.jsonl
+    parser = argparse.ArgumentParser(description='Run a grid of headless simulations on all cores')
+    parser.add_argument('--modes', nargs='+', default=['Dresner'])
+    parser.add_argument('--flows', nargs='+', type=int, default=[720, 1440, 2880, 4320, 5760])
+    parser.add_argument('--splits', nargs='+', default=['0.25,0.5,0.25'], help='left,through,right shares of each arm')
+    parser.add_argument('--seeds', type=int, default=10, help='runs per combination, seeded 0..n-1')
+    parser.add_argument('--no-fault', action='store_true', help='disable fault injection')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--out', default=os.path.join('log', 'sweep.jsonl'))
+    parser.add_argument('--keep-logs', action='store_true')
+    parser.add_argument('--log-format', choices=['none', 'binary', 'text'], default='none', help='the metrics do not need a log')
+    parser.add_argument('--retry-errors', action='store_true')
+    args = parser.parse_args()
+
+    runs = make_grid(
+        args.modes, args.flows,
+        turn_splits=[tuple(float(v) for v in split.split(',')) for split in args.splits],
+        seeds=range(args.seeds),
+        faults=[None] if args.no_fault else [(25, 35)]
+    )
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    results = sweep(runs, args.out, args.workers, keep_logs=args.keep_logs, retry_errors=args.retry_errors, log_format=args.log_format)
+    print_summary(summarise(results, by=('mode', 'total_flow', 'turn_split', 'fault')))
+    if any('error' in result for result in results):
+        sys.exit(1)
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from headless import run_headless
+from recorder import load_trajectory
+
+def test_incremental_topology_matches_full(tmp_path):
+    '''settings.xu_incremental only changes how the conflict tree is kept, the trajectories are the same, ties in x included'''
+    logs = []
+    for incremental in (True, False):
+        metrics = run_headless('Xu', 5760, 0, log_dir=str(tmp_path / str(incremental)), log_format='binary', simu_t=200, xu_incremental=incremental)
+        chunks, events, meta = load_trajectory(metrics['log_fname'])
+        logs.append((np.concatenate(chunks), events))
+    (rows, events), (full_rows, full_events) = logs
+    assert len(rows) == len(full_rows)
+    assert np.array_equal(rows, full_rows)
+    assert events == full_events
@@ -1,17 +1,25 @@
 import math
-import logging
 
-from lib.settings import arm_len, inter_v_lim, arm_v_lim, inter_control_mode, veh_dt, desired_cf_distance, kp, kv
+import numpy as np
+
 from map import Track
-from inter_manager import ComSystem
-import random
+
+def array_min(x, y):
+    '''Elementwise min(x, y) on arrays that, like the built-in, returns x on ties (np.minimum returns y, which can flip the sign of a zero)'''
+    return np.where(y < x, y, x)
 
 class BaseVehicle:
     '''
     units: meter, second
     x is defined as the position of Front bumper
+    The vehicles have __slots__ instead of a __dict__, subclasses list their own attributes in __slots__ too.
     '''
-    def __init__(self, id, veh_param, cf_param, init_v, timestep):
+    __slots__ = ('ctx', '_id', 'veh_wid', 'veh_len', 'veh_len_front', 'veh_len_back', 'max_v', 'max_acc', 'max_dec', 'track',
+        'timestep', 'inst_a', 'inst_v', 'zone', 'inst_lane', 'inst_x', 'cf_model', 'faultyCar', 'crashOccured', 'collidedCar')
+
+    def __init__(self, ctx, id, veh_param, cf_param, init_v, timestep, faultyCar=False, crashHappenOnInit=False):
+        # The simulation context this vehicle lives in (settings, map, communication system)
+        self.ctx = ctx
         # static
         self._id = id
         self.veh_wid = veh_param['veh_wid']
@@ -21,7 +29,7 @@ class BaseVehicle:
         self.max_v = veh_param['max_v']
         self.max_acc = veh_param['max_acc']
         self.max_dec = veh_param['max_dec']
-        self.track = Track(veh_param['ap_arm'], veh_param['ap_lane'], veh_param['turn_dir'])
+        self.track = Track(ctx.map, veh_param['ap_arm'], veh_param['ap_lane'], veh_param['turn_dir'])
 
         # dynamic
         self.timestep = timestep
@@ -29,11 +37,15 @@ class BaseVehicle:
         self.inst_v = init_v
         self.zone = 'ap'                       # 'ap' = approach lane, 'ju' = junction area, 'ex' = exit lane
         self.inst_lane = veh_param['ap_lane']  # When zone == 'ap' or 'ex', the current lane
-        self.inst_x = -arm_len                 # When zone == 'ap', it is (- the distance to the parking line); zone == 'ju', it is the distance traveled along the trajectory in the intersection; zone == 'ex', it is Distance traveled along exit road
+        self.inst_x = -ctx.settings.arm_len    # When zone == 'ap', it is (- the distance to the parking line); zone == 'ju', it is the distance traveled along the trajectory in the intersection; zone == 'ex', it is Distance traveled along exit road
+
+        #Set car following parameters, the model is shared by all vehicles with the same parameters
+        self.cf_model = CFModel.shared(min(self.max_v, cf_param['v0']), cf_param['T'], cf_param['s0'], cf_param['a'], cf_param['b'])
 
-        #Set car following parameters
-        cf_param['v0'] = min(self.max_v, cf_param['v0'])
-        self.cf_model = CFModel(cf_param=cf_param)
+        # Fault injection state, only acted upon by DresnerVehicle but drawn for every vehicle
+        self.faultyCar = faultyCar
+        self.crashOccured = crashHappenOnInit
+        self.collidedCar = False
 
         # self.track.confirm_ex_lane(0)
 
@@ -41,6 +53,10 @@ class BaseVehicle:
         # Operator overloading, after testing, it seems that it can be passed to descendants
         return self._id == vehicle._id
 
+    def change_cf_model(self, cf_model):
+        '''Follow with another car-following model from now on (one of CFModel.shared, they must not be changed in place)'''
+        self.cf_model = cf_model
+
     def acc_with_lead_veh(self, lead_veh):
         '''Only consider the acceleration when following a car'''
         if not lead_veh:
@@ -60,7 +76,33 @@ class BaseVehicle:
 
     def update_position(self, dt):
         '''It's equivalent to doing points and updating position and speed. Returns: whether the zone has changed'''
+        self.before_move(dt)
+        switch_group = self.move(dt)
+        self.after_move(dt, switch_group)
+        return switch_group
+
+    def before_move(self, dt):
+        '''Called before each update of position and speed, for subclasses'''
+        pass
+
+    def after_move(self, dt, switch_group):
+        '''Called after each update of position and speed (switch_group: whether the zone has changed), for subclasses'''
+        pass
+
+    @classmethod
+    def fleet_control(cls, fleet, slots, lead, vehs, acc_lead, acc_stop):
+        '''
+        update_control of many vehicles at once, for the fleet engine. vehs are the vehicles (in all_veh order) at rows slots of fleet,
+        lead the row of their lead vehicle (-1 for none), acc_lead and acc_stop the IDM acceleration behind the lead vehicle and towards the stop bar.
+        Returns the new accelerations and a mask of the vehicles that need their own update_control instead
+        '''
+        acc = array_min(np.maximum(acc_lead, - fleet.max_dec[slots]), fleet.max_acc[slots])
+        return acc, np.zeros(len(slots), dtype=bool)
+
+    def move(self, dt):
+        '''Update position and speed with the current acceleration. Returns: whether the zone has changed'''
         self.timestep += 1
+        x = self.inst_x
 
         if self.inst_v <= 0 and self.inst_a <= 0: # When the vehicle is stopped, the vehicle cannot reverse even if the acceleration is negative.
             self.inst_a = 0
@@ -71,14 +113,16 @@ class BaseVehicle:
         if self.zone == 'ap' and self.inst_x >= 0:
             self.zone = 'ju'
             self.inst_lane = -1
+            self.ctx.simulator.metrics.on_enter_junction(self._id, self.timestep)
             return True
         elif self.zone == 'ju' and self.inst_x >= self.track.ju_shape_end_x[-1]: 
+            self.ctx.simulator.metrics.on_leave_junction(self._id, self.timestep, x)
             self.zone = 'ex'
             self.inst_x -= self.track.ju_shape_end_x[-1]
             self.inst_lane = self.track.ex_lane
             return True
         
-        logging.debug("%d, %d, %s, %d, %.2f, %.2f, %.2f" % (self.timestep, self._id, self.zone, self.inst_lane, self.inst_x, self.inst_v, self.inst_a))
+        self.ctx.recorder.record(self.timestep, self._id, self.zone, self.inst_lane, self.inst_x, self.inst_v, self.inst_a)
         return False
 
     def receive_broadcast(self, message):
@@ -89,8 +133,10 @@ class BaseVehicle:
 
 class HumanDrivenVehicle(BaseVehicle):
     '''Manually driven cars only respond to traffic lights'''
-    def __init__(self, id, veh_param, cf_param, init_v, timestep):
-        super().__init__(id, veh_param, cf_param, init_v, timestep)
+    __slots__ = ('traffic_light', 'cf_v0_backup', 'cf_T_backup')
+
+    def __init__(self, ctx, id, veh_param, cf_param, init_v, timestep, faultyCar=False, crashHappenOnInit=False):
+        super().__init__(ctx, id, veh_param, cf_param, init_v, timestep, faultyCar, crashHappenOnInit)
         
         # One lane situation
         self.track.confirm_ex_lane(0) # Temporarily single exit lane, which is 0
@@ -118,19 +164,21 @@ class HumanDrivenVehicle(BaseVehicle):
         # Limit the maximum and minimum values
         self.inst_a = min(max(self.inst_a, - self.max_dec), self.max_acc)
 
-    def update_position(self, dt):
-        switch_group = super().update_position(dt)
+    @classmethod
+    def fleet_control(cls, fleet, slots, lead, vehs, acc_lead, acc_stop):
+        red = (fleet.zone[slots] == fleet.zone_code['ap']) & np.array([veh.traffic_light != 'G' for veh in vehs], dtype=bool)
+        acc = np.where(red, array_min(acc_lead, acc_stop), acc_lead)
+        return super().fleet_control(fleet, slots, lead, vehs, acc, acc_stop)
+
+    def after_move(self, dt, switch_group):
         if self.zone == 'ap' and self.inst_x > -50 and not self.cf_v0_backup:
             # When the distance to the intersection is closer, the desired speed is changed to the intersection speed limit, and the headway is changed to a smaller value.
             self.cf_v0_backup = self.cf_model.v0
             self.cf_T_backup = self.cf_model.T
-            self.cf_model.v0 = min(self.cf_model.v0, inter_v_lim)
-            self.cf_model.T = min(self.cf_model.T, 1)
+            self.change_cf_model(self.cf_model.replace(v0=min(self.cf_model.v0, self.ctx.settings.inter_v_lim), T=min(self.cf_model.T, 1)))
         elif self.zone == 'ex' and switch_group:
             # Just changed from the intersection area to the exit road, and changed back to the following parameters
-            self.cf_model.v0 = self.cf_v0_backup
-            self.cf_model.T = self.cf_T_backup
-        return switch_group
+            self.change_cf_model(self.cf_model.replace(v0=self.cf_v0_backup, T=self.cf_T_backup))
 
     def receive_broadcast(self, message):
         if self.zone == 'ap':
@@ -142,21 +190,23 @@ class HumanDrivenVehicle(BaseVehicle):
 
 class DresnerVehicle(BaseVehicle):
     '''corresponds to the self-driving car in Dresner's article and responds to DresnerManager'''
-    def __init__(self, id, veh_param, cf_param, init_v, timestep, faultyCar,crashHappenOnInit):
-        super().__init__(id, veh_param, cf_param, init_v, timestep)
+    __slots__ = ('reservation', 'timeout', 'optimism', 'ap_acc_profile', 'request_t', 'faultTime')
+
+    def __init__(self, ctx, id, veh_param, cf_param, init_v, timestep, faultyCar=False, crashHappenOnInit=False):
+        super().__init__(ctx, id, veh_param, cf_param, init_v, timestep, faultyCar, crashHappenOnInit)
         #Control information
         self.reservation = None
         self.timeout = 0 # Unit: s
         # optimistic and pessimistic in the text
         self.optimism = True
         self.ap_acc_profile = None
-        self.faultyCar = faultyCar
-        self.crashOccured=crashHappenOnInit
+        self.request_t = None # Timestep of the request that has no reply yet
         self.faultTime=0
-        self.collidedCar=False
 
     def plan_arr(self):
         '''According to the maximum arr_v, the earliest planned arrival time and speed of arr_t. Because only the leading car in a lane can plan this, so as long as the reservation is obtained, the plan can definitely be executed'''
+        inter_v_lim = self.ctx.settings.inter_v_lim
+        veh_dt = self.ctx.settings.veh_dt
         if self.inst_v < inter_v_lim:
             acc_distance = (inter_v_lim**2 - self.inst_v**2) / 2 / self.max_acc # The distance required to accelerate to v_lim
             if acc_distance >= (-self.inst_x):
@@ -164,17 +214,17 @@ class DresnerVehicle(BaseVehicle):
                 arr_v = math.sqrt(self.inst_v**2 + 2*self.max_acc*(-self.inst_x))
                 t1 = (arr_v - self.inst_v) / self.max_acc
                 arr_t = self.timestep + t1 / veh_dt
-                self.ap_acc_profile = [[self.timestep, self.max_acc]]
+                self.ap_acc_profile = ((self.timestep, self.max_acc),)
             else:
                 # It's enough to accelerate before reaching the parking line. Let's accelerate-constant speed for now. Acceleration-deceleration is too difficult to calculate.
                 arr_v = inter_v_lim
                 t1 = (inter_v_lim - self.inst_v) / self.max_acc
                 t2 = ((-self.inst_x) - acc_distance) / inter_v_lim
                 arr_t = self.timestep + (t1+t2) / veh_dt
-                self.ap_acc_profile = [
-                    [self.timestep, self.max_acc],
-                    [self.timestep + t1/veh_dt, 0]
-                ]
+                self.ap_acc_profile = (
+                    (self.timestep, self.max_acc),
+                    (self.timestep + t1/veh_dt, 0)
+                )
         else:
             # Now the speed exceeds v_lim, constant speed - slow down (there should not be a situation where the speed cannot be reduced)
             dec_distance = (inter_v_lim**2 - self.inst_v**2) / 2 / -(self.max_dec)
@@ -182,25 +232,26 @@ class DresnerVehicle(BaseVehicle):
                 print('Error: veh %d is unable to brake at stop bar' % self._id)
                 arr_v = self.inst_v
                 arr_t = self.timestep + ((-self.inst_x) / self.inst_v) / veh_dt
-                self.ap_acc_profile = [[self.timestep, 0]]
+                self.ap_acc_profile = ((self.timestep, 0),)
             else:
                 arr_v = inter_v_lim
                 t2 = (self.inst_v - inter_v_lim) / self.max_dec
                 t1 = ((-self.inst_x) - dec_distance) / self.inst_v
                 arr_t = self.timestep + (t1+t2) / veh_dt
-                self.ap_acc_profile = [
-                    [self.timestep, 0],
-                    [self.timestep + t1/veh_dt, -self.max_dec]
-                ]
+                self.ap_acc_profile = (
+                    (self.timestep, 0),
+                    (self.timestep + t1/veh_dt, -self.max_dec)
+                )
         return [arr_t, arr_v]
     
     def update_control(self, lead_veh):
         if self.zone == 'ap':
-            if not lead_veh and not self.reservation and not self.crashOccured:
+            if not lead_veh and not self.reservation and not self.crashOccured and not self.awaiting_reply():
                 # There is no car ahead, so make a reservation
                 [arr_t, arr_v] = self.plan_arr()
+                self.request_t = self.timestep
                 # logging.debug("veh %d, arr_t = %d, arr_v = %d, ap_acc_profile = %s" % (self._id, arr_t, arr_v, self.ap_acc_profile))
-                ComSystem.V2I(self, {
+                self.ctx.com.V2I(self, {
                     'type': 'request',
                     'veh_id': self._id, 
                     'arr_t': arr_t, 
@@ -212,7 +263,10 @@ class DresnerVehicle(BaseVehicle):
                     'veh_wid': self.veh_wid, 
                     'veh_len_front': self.veh_len_front,
                     'max_acc': self.max_acc,
-                    'max_dec': self.max_dec
+                    'max_dec': self.max_dec,
+                    'timestep': self.timestep, 
+                    'inst_x': self.inst_x, 
+                    'inst_v': self.inst_v
                 })
             if self.reservation :
                 # and and not self.crashOccured
@@ -227,18 +281,18 @@ class DresnerVehicle(BaseVehicle):
         elif self.zone == 'ju':
             # Check if the vehicle is marked as faulty
             if self.faultyCar and self.timestep >= self.faultTime:
-                ComSystem.V2I(self, {
+                self.ctx.com.V2I(self, {
                     'type': 'fault',
                     'veh_id': self._id
                 })
                 # If the vehicle is faulty, initiate an immediate stop by applying maximum safe deceleration
                 self.inst_a = -10
                 # Optionally, log this event or take additional actions as necessary
-                logging.info(f"Faulty vehicle {self._id} stopping in the intersection.")
+                self.ctx.recorder.event('fault', t=self.timestep, veh_id=self._id)
             else:
                 # If the vehicle is not faulty, run according to the acceleration requirements of the reservation
                 if not self.crashOccured:
-                    for t, a in self.reservation['acc']:
+                    for t, a in self.reservation.acc:
                         if self.timestep >= t:
                             self.inst_a = a
         else:
@@ -248,28 +302,54 @@ class DresnerVehicle(BaseVehicle):
         # if self.inst_x > -50 and self.inst_v > 0:
         #     self.inst_a = -6
 
-    def update_position(self, dt):
-        switch_group = super().update_position(dt)
+    @classmethod
+    def fleet_control(cls, fleet, slots, lead, vehs, acc_lead, acc_stop):
+        # Only the two plain car-following cases are vectorised, reservations and crashes are handled by update_control
+        zone = fleet.zone[slots]
+        no_res = np.array([not veh.reservation for veh in vehs], dtype=bool)
+        crashed = np.array([veh.crashOccured for veh in vehs], dtype=bool)
+        ex = zone == fleet.zone_code['ex']
+        stop = (zone == fleet.zone_code['ap']) & no_res & ((lead >= 0) | crashed)
+        acc, _ = super().fleet_control(fleet, slots, lead, vehs, acc_lead, acc_stop)
+        acc = np.where(stop, array_min(acc_lead, acc_stop), acc)
+        return acc, ~(ex | stop)
+
+    def after_move(self, dt, switch_group):
         if switch_group and self.zone == 'ex':
-            ComSystem.V2I(self, {
+            self.ctx.com.V2I(self, {
                 'type': 'done',
                 'veh_id': self._id, 
-                'res_id': self.reservation['res_id']
+                'res_id': self.reservation.res_id
             })
-        return switch_group
+
+    def awaiting_reply(self):
+        '''Whether a request was sent less than com_timeout ago and is still unanswered (only possible with com_queued)'''
+        s = self.ctx.settings
+        return self.request_t is not None and (self.timestep - self.request_t) * s.veh_dt < s.com_timeout
 
     def receive_I2V(self, message):
         if message['type'] == 'acknowledge':
-            if message['res_id'] != self.reservation['res_id']:
+            if message['res_id'] != self.reservation.res_id:
                 print('Error: ack message with [\'res_id\'] = %d is sent to veh %d' % (message['res_id'], self._id))
-        elif message['type'] == 'confirm':
+        elif message['type'] in ('confirm', 'counter-offer'):
+            self.request_t = None
+            if self.reservation:
+                # A late reply to a repeated request, the first reservation is kept
+                return
             self.reservation = message['reservation']
-            self.track.confirm_ex_lane(self.reservation['ex_lane'])
-            self.faultTime = random.uniform(float(self.reservation["arr_t"]), float(self.reservation["exit_time"]))
+            if message['type'] == 'counter-offer':
+                # A later arrival than requested, approached as the manager planned it
+                self.ap_acc_profile = self.reservation.ap_acc
+            self.track.confirm_ex_lane(self.reservation.ex_lane)
+            self.faultTime = self.ctx.random.uniform(float(self.reservation.arr_t), float(self.reservation.exit_time))
+            if self.ctx.settings.fault_time_frac is not None:
+                # Drawn above all the same, so that the random stream does not depend on fault_time_frac
+                self.faultTime = self.reservation.arr_t + self.ctx.settings.fault_time_frac * (self.reservation.exit_time - self.reservation.arr_t)
             if self.faultyCar:
-                print("Start time is arr_t: ",self.reservation["arr_t"],"End time is exit_time: ",self.reservation["exit_time"])
+                print("Start time is arr_t: ",self.reservation.arr_t,"End time is exit_time: ",self.reservation.exit_time)
                 print(f"Faulty vehicle {self._id} will crash at time {self.faultTime}")
         elif message['type'] == 'reject':
+            self.request_t = None
             self.timeout = message['timeout']
         elif message["type"] =="collision":
             self.crashOccured=True
@@ -284,12 +364,12 @@ class DresnerVehicle(BaseVehicle):
                 # Set the vehicle's acceleration to the maximum safe deceleration rate
                 self.inst_a = -self.max_dec
                 # Optionally, log this event or take additional actions as necessary
-                logging.info(f"Vehicle {self._id} stopping at max deceleration rate due to allStop broadcast.")
+                self.ctx.recorder.event('stop_ju', t=self.timestep, veh_id=self._id)
             elif self.zone == 'ap':  # Vehicle is in the approach zone
                 # self.reservation = None  # Clear any existing reservations
                 # Set acceleration to max deceleration rate to stop at the stop line
                 # self.inst_a = -self.max_dec
-                logging.info(f"Vehicle {self._id} in approach zone rejecting reservations and stopping due to allStop broadcast.")
+                self.ctx.recorder.event('stop_ap', t=self.timestep, veh_id=self._id)
 
 
 
@@ -303,13 +383,16 @@ class DresnerVehicle(BaseVehicle):
 
 
 class XuVehicle(BaseVehicle):
-    def __init__(self, id, veh_param, cf_param, init_v, timestep):
-        super().__init__(id, veh_param, cf_param, init_v, timestep)
+    __slots__ = ('reported', 'depth', 'virtual_lead_x', 'virtual_lead_v', 'neighbor_list', 'neighbor_depth_list', 'l_q_list')
+
+    def __init__(self, ctx, id, veh_param, cf_param, init_v, timestep, faultyCar=False, crashHappenOnInit=False):
+        super().__init__(ctx, id, veh_param, cf_param, init_v, timestep, faultyCar, crashHappenOnInit)
         self.reported = False
         self.depth = None
         self.virtual_lead_x = None
         self.virtual_lead_v = None
         self.neighbor_list = None
+        self.neighbor_depth_list = None # The neighbours' depths as the manager computed them, their own may still be on the way
         self.l_q_list = None
 
         # One lane situation
@@ -341,22 +424,29 @@ class XuVehicle(BaseVehicle):
     
     def acc_from_feedback(self): 
         '''The final simplified result in Ch 3.4'''
+        s = self.ctx.settings
+        desired_cf_distance, kp, kv = s.desired_cf_distance, s.kp, s.kv
         acc = 0
         for j in range(len(self.l_q_list)):
-            x_bar_j_1 = (self.neighbor_list[j].inst_x - self.virtual_lead_x) - desired_cf_distance * (0 - self.neighbor_list[j].depth)
+            x_bar_j_1 = (self.neighbor_list[j].inst_x - self.virtual_lead_x) - desired_cf_distance * (0 - self.neighbor_depth_list[j])
             x_bar_j_2 = self.neighbor_list[j].inst_v - self.virtual_lead_v
             acc += (-kp) * (self.l_q_list[j] * x_bar_j_1) + (-kv) * (self.l_q_list[j] * x_bar_j_2)
         return acc
 
-    def update_position(self, dt):
+    @classmethod
+    def fleet_control(cls, fleet, slots, lead, vehs, acc_lead, acc_stop):
+        acc, _ = super().fleet_control(fleet, slots, lead, vehs, acc_lead, acc_stop)
+        feedback = (fleet.zone[slots] == fleet.zone_code['ap']) & np.array([bool(veh.depth) for veh in vehs], dtype=bool)
+        return acc, feedback
+
+    def before_move(self, dt):
         if not self.reported:
             if self.track.turn_dir != 'r':
-                ComSystem.V2I(self, {'type': 'appear'})
+                self.ctx.com.V2I(self, {'type': 'appear'})
             self.reported = True
             
         if self.virtual_lead_x and self.zone == 'ap':
             self.virtual_lead_x += self.virtual_lead_v * dt
-        return super().update_position(dt)
 
     def receive_I2V(self, message):
         if message['type'] == 'coordination':
@@ -364,15 +454,21 @@ class XuVehicle(BaseVehicle):
             self.virtual_lead_x = message['virtual_lead_x']
             self.virtual_lead_v = message['virtual_lead_v']
             self.neighbor_list = message['neighbor_list']
+            self.neighbor_depth_list = message['neighbor_depth_list']
             self.l_q_list = message['l_q_list']
 
     def receive_broadcast(self, message):
-        if message['type'] == 'request report':
+        if message['type'] == 'virtual lead':
+            # Every vehicle XuManager coordinates follows the same virtual lead vehicle, those in the approach zone
+            if self.zone == 'ap' and self.inst_x < 0:
+                self.virtual_lead_x = message['virtual_lead_x']
+                self.virtual_lead_v = message['virtual_lead_v']
+        elif message['type'] == 'request report':
             # Single lane will only be reported in approach zone
             if self.inst_x < 0:
             # # # Three lanes, right turn not reported
             # if self.inst_x < 0 and self.track.turn_dir in 'lt':
-                ComSystem.V2I(self, {
+                self.ctx.com.V2I(self, {
                     'type': 'report', 
                     'veh_id': self._id,
                     'inst_x': self.inst_x, 
@@ -382,16 +478,25 @@ class XuVehicle(BaseVehicle):
                     'ex_lane': self.track.ex_lane
                 })
 
-# Choose an implementation based on your settings
-if inter_control_mode == 'traffic light':
-    Vehicle = HumanDrivenVehicle
-elif inter_control_mode == 'Dresner':
-    Vehicle = DresnerVehicle
-elif inter_control_mode == 'Xu':
-    Vehicle = XuVehicle
+def vehicle_class(inter_control_mode):
+    '''Choose an implementation based on your settings'''
+    if inter_control_mode == 'traffic light':
+        return HumanDrivenVehicle
+    elif inter_control_mode == 'Dresner':
+        return DresnerVehicle
+    elif inter_control_mode == 'Xu':
+        return XuVehicle
+    raise ValueError('Unknown inter_control_mode: %s' % inter_control_mode)
 
 class CFModel:
-    '''Car-following model, here we use IDM model'''
+    '''
+    Car-following model, here we use IDM model.
+    Vehicles share one model per set of parameters (shared), so a model is never changed in place: a vehicle that drives with
+    other parameters switches to the model replace returns, see BaseVehicle.change_cf_model
+    '''
+    __slots__ = ('v0', 'T', 's0', 'a', 'b', 'delta')
+    _shared = {}
+
     def __init__(self, cf_param):
         self.v0 = cf_param['v0']    # desired speed
         self.T = cf_param['T']      # desired time headway
@@ -400,6 +505,21 @@ class CFModel:
         self.b = cf_param['b']      # deceleration rate
         self.delta = 4
 
+    @staticmethod
+    def shared(v0, T, s0, a, b):
+        '''The model with these parameters, one object for all vehicles (and contexts) that use them'''
+        key = (v0, T, s0, a, b)
+        cf_model = CFModel._shared.get(key)
+        if cf_model is None:
+            cf_model = CFModel._shared[key] = CFModel({'v0': v0, 'T': T, 's0': s0, 'a': a, 'b': b})
+        return cf_model
+
+    def replace(self, **params):
+        '''The shared model with some of the parameters of this one changed'''
+        values = {'v0': self.v0, 'T': self.T, 's0': self.s0, 'a': self.a, 'b': self.b}
+        values.update(params)
+        return CFModel.shared(**values)
+
     def acc_from_model(self, v, s, v_l):
         '''
         v       speed